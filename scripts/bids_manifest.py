@@ -0,0 +1,169 @@
+"""
+Cached manifest of the subjects, sessions and files in a BIDS-style dataset.
+
+The manifest maps every subject to its sessions and the files in each session's
+modality directories (anat/, mixed/, dwi/, ...). It is stored as JSON together
+with the modification time of every scanned directory, and a subject is only
+scanned again when one of its directories has changed, so building the DAG costs
+one stat per directory instead of one per file.
+
+Existence checks of pipeline outputs go through `DirectoryListing`, which lists
+each directory once and answers all later checks from memory.
+"""
+
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+MANIFEST_VERSION = 1
+
+
+def _mtime(path: Path) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _subdirectories(path: Path, prefix: str = "") -> list[str]:
+    with os.scandir(path) as entries:
+        return sorted(e.name for e in entries if e.is_dir() and e.name.startswith(prefix))
+
+
+def scan_subject(root: Path, subject: str) -> dict:
+    """Sessions, files and directory mtimes of one subject."""
+    subject_dir = root / subject
+    mtimes = {subject: _mtime(subject_dir)}
+    sessions = {}
+    for session in _subdirectories(subject_dir, "ses-"):
+        session_dir = subject_dir / session
+        mtimes[f"{subject}/{session}"] = _mtime(session_dir)
+        files = []
+        for modality in _subdirectories(session_dir):
+            mtimes[f"{subject}/{session}/{modality}"] = _mtime(session_dir / modality)
+            with os.scandir(session_dir / modality) as entries:
+                files += sorted(f"{modality}/{e.name}" for e in entries if e.is_file())
+        sessions[session] = files
+    return {"sessions": sessions, "mtimes": mtimes}
+
+
+def _is_current(root: Path, entry: dict) -> bool:
+    return all(_mtime(root / relative) == mtime for relative, mtime in entry["mtimes"].items())
+
+
+class Manifest:
+    def __init__(self, root: Path, subjects: dict):
+        self.root = Path(root)
+        self._subjects = subjects
+
+    @property
+    def subjects(self) -> list[str]:
+        return sorted(self._subjects)
+
+    def _sessions(self, subject: str) -> dict:
+        try:
+            return self._subjects[subject]["sessions"]
+        except KeyError:
+            raise ValueError(
+                f"No subject {subject} in {self.root}; found {', '.join(self.subjects) or 'none'}"
+            ) from None
+
+    def sessions(self, subject: str) -> list[str]:
+        return sorted(self._sessions(subject))
+
+    def files(self, subject: str, session: str) -> list[str]:
+        return self._sessions(subject)[session]
+
+    def has(self, subject: str, session: str, relative_path: str) -> bool:
+        return relative_path in self._sessions(subject).get(session, [])
+
+
+def load_manifest(root: Path, cache: Path) -> Manifest:
+    """Manifest of the dataset at root, rescanning only the subjects whose
+    directories changed since the cached manifest was written."""
+    root, cache = Path(root), Path(cache)
+    try:
+        cached = json.loads(cache.read_text())
+        if cached.get("version") != MANIFEST_VERSION or cached.get("root") != str(root.resolve()):
+            cached = {}
+    except (FileNotFoundError, json.JSONDecodeError):
+        cached = {}
+
+    old_subjects = cached.get("subjects", {})
+    subjects = {}
+    changed = cached.get("root_mtime") != _mtime(root)
+    for subject in _subdirectories(root, "sub-") if root.exists() else []:
+        entry = old_subjects.get(subject)
+        if entry is None or not _is_current(root, entry):
+            entry = scan_subject(root, subject)
+            changed = True
+        subjects[subject] = entry
+    changed |= set(subjects) != set(old_subjects)
+
+    if changed:
+        cache.parent.mkdir(exist_ok=True, parents=True)
+        # Written to a unique file and renamed, as concurrent Snakemake runs may share the cache.
+        with tempfile.NamedTemporaryFile(
+            "w", dir=cache.parent, prefix=f".{cache.stem}.", suffix=".tmp", delete=False
+        ) as f:
+            json.dump(
+                {
+                    "version": MANIFEST_VERSION,
+                    "root": str(root.resolve()),
+                    "root_mtime": _mtime(root),
+                    "subjects": subjects,
+                },
+                f,
+            )
+        Path(f.name).replace(cache)
+    return Manifest(root, subjects)
+
+
+class DirectoryListing:
+    """Existence checks answered from a single listing per directory."""
+
+    def __init__(self):
+        self._listings: dict[Path, frozenset] = {}
+
+    def exists(self, path) -> bool:
+        path = Path(path)
+        parent = path.parent
+        if parent not in self._listings:
+            try:
+                self._listings[parent] = frozenset(os.listdir(parent))
+            except FileNotFoundError:
+                self._listings[parent] = frozenset()
+        return path.name in self._listings[parent]
+
+
+def leaf_templates(leaves: list[str], subject: str, sessions: list[str]) -> list[str]:
+    """Turn the leaf files of one subject into templates with {subject} and,
+    for files that exist for every session, {session} placeholders."""
+    by_template: dict[str, set] = {}
+    for leaf in leaves:
+        template = leaf.replace(subject, "{subject}")
+        session = next((s for s in sessions if s in template), None)
+        if session is not None:
+            by_template.setdefault(template.replace(session, "{session}"), set()).add(session)
+        else:
+            by_template.setdefault(template, set())
+    templates = []
+    for template, found in by_template.items():
+        if "{session}" in template and found != set(sessions):
+            # Only some sessions have this file; keep them as explicit paths.
+            templates += sorted(template.replace("{session}", s) for s in found)
+        else:
+            templates.append(template)
+    return templates
+
+
+def subject_leaves(templates: list[str], subject: str, sessions: list[str]) -> list[str]:
+    leaves = []
+    for template in templates:
+        if "{session}" in template:
+            leaves += [template.format(subject=subject, session=s) for s in sessions]
+        else:
+            leaves.append(template.format(subject=subject))
+    return leaves
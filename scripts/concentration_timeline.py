@@ -0,0 +1,127 @@
+"""
+Per-subject time series store of the concentration images.
+
+The store is an HDF5 file holding the concentrations in the voxels of the
+intracranial mask as a chunked (time, voxels) array, together with the flat
+voxel indices of the mask, the image grid, and the session labels and
+acquisition times (s, relative to injection) from timetable.tsv. The store is
+created empty when only --mask is given, and each session is appended as it
+becomes available, so adding a session costs one row instead of a rebuild, and
+re-appending a session overwrites its row. Readers get either whole time slices
+(as volumes) or the trajectories of selected voxels, ordered by acquisition
+time.
+"""
+
+from pathlib import Path
+from typing import Optional
+
+import click
+import h5py
+import numpy as np
+
+from nifti_io import load_nifti, session_info
+from timetable import load_timetable
+
+VOXEL_CHUNK = 2**16
+
+
+def create_store(path: Path, mask: np.ndarray, affine: np.ndarray):
+    voxels = np.flatnonzero(np.asarray(mask).reshape(-1))
+    path.parent.mkdir(exist_ok=True, parents=True)
+    with h5py.File(path, "w") as f:
+        f.create_dataset("voxels", data=voxels)
+        f.create_dataset("shape", data=np.array(mask.shape[:3]))
+        f.create_dataset("affine", data=affine)
+        f.create_dataset(
+            "data",
+            shape=(0, len(voxels)),
+            maxshape=(None, len(voxels)),
+            dtype=np.float32,
+            chunks=(1, max(1, min(len(voxels), VOXEL_CHUNK))),
+        )
+        f.create_dataset("times", shape=(0,), maxshape=(None,), dtype=np.float64)
+        f.create_dataset("sessions", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+
+
+def append_session(path: Path, session: str, time: float, image: np.ndarray, affine: np.ndarray):
+    with h5py.File(path, "r+") as f:
+        if tuple(f["shape"][()]) != image.shape[:3] or not np.allclose(f["affine"][()], affine):
+            raise ValueError(f"Image for {session} is not on the grid of the store {path}")
+        values = np.asarray(image).reshape(-1)[f["voxels"][()]]
+        sessions = [s.decode() if isinstance(s, bytes) else s for s in f["sessions"][()]]
+        if session in sessions:
+            row = sessions.index(session)
+        else:
+            row = len(sessions)
+            for name in ("data", "times", "sessions"):
+                f[name].resize(row + 1, axis=0)
+        f["data"][row] = values
+        f["times"][row] = time
+        f["sessions"][row] = session
+
+
+class Timeline:
+    """Read access to a store, with the sessions ordered by acquisition time."""
+
+    def __init__(self, path: Path):
+        self.file = h5py.File(path, "r")
+        self.voxels = self.file["voxels"][()]
+        self.shape = tuple(self.file["shape"][()])
+        self.affine = self.file["affine"][()]
+        times = self.file["times"][()]
+        self.order = np.argsort(times, kind="stable")
+        self.times = times[self.order]
+        self.sessions = [
+            s.decode() if isinstance(s, bytes) else s for s in self.file["sessions"][()][self.order]
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+    def time_slice(self, idx: int, fill_value: float = np.nan) -> np.ndarray:
+        """The volume of the idx-th session in time, filled outside the mask."""
+        volume = np.full(int(np.prod(self.shape)), fill_value, dtype=np.float32)
+        volume[self.voxels] = self.file["data"][self.order[idx]]
+        return volume.reshape(self.shape)
+
+    def trajectories(self, voxels: Optional[np.ndarray] = None) -> np.ndarray:
+        """(time, voxels) array for the given flat voxel indices, which must lie
+        in the mask, or for all voxels of the mask."""
+        data = self.file["data"]
+        if voxels is None:
+            return data[()][self.order]
+        columns = np.searchsorted(self.voxels, voxels)
+        valid = columns < len(self.voxels)
+        if not np.all(valid) or not np.array_equal(self.voxels[columns], voxels):
+            raise ValueError("Some voxels are outside the mask of the timeline")
+        unique, inverse = np.unique(columns, return_inverse=True)
+        return data[:, unique][self.order][:, inverse]
+
+
+@click.command()
+@click.option("--store", type=Path, required=True, help="HDF5 time series store")
+@click.option("--image", "images", type=Path, multiple=True, help="Concentration image(s) to append")
+@click.option("--mask", type=Path, required=True, help="Mask of the stored voxels, used on creation")
+@click.option("--timetable", type=Path, help="Required with --image")
+@click.option("--timelabel", type=str, default="looklocker")
+def main(store: Path, images: list[Path], mask: Path, timetable: Optional[Path], timelabel: str):
+    if images and timetable is None:
+        raise click.UsageError("--timetable is required to append images")
+    mask_data, affine = load_nifti(mask)
+    if not store.exists():
+        create_store(store, mask_data, affine)
+    with Timeline(store) as timeline:
+        if not np.array_equal(timeline.voxels, np.flatnonzero(np.asarray(mask_data).reshape(-1))):
+            raise ValueError(f"The mask has changed since {store} was created; remove it to rebuild.")
+    times = load_timetable(timetable) if images else None
+    for path in images:
+        subject, session = session_info(path)
+        data, affine = load_nifti(path)
+        append_session(store, session, times.time(subject, session, timelabel), data, affine)
+
+
+if __name__ == "__main__":
+    main()
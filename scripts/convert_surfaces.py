@@ -1,50 +1,137 @@
+"""
+Convert FreeSurfer surfaces to binary STL in scanner coordinates.
+
+The surfaces are read directly from the FreeSurfer triangle files, and their
+vertices are mapped from tkregister (surface) RAS to scanner RAS using the volume
+geometry stored in the surface footer, which is what `mris_convert --to-scanner`
+does. All surfaces are converted concurrently in one process. Surfaces without
+valid volume geometry, or all surfaces if --container is given, are converted
+with mris_convert in the FreeSurfer container instead.
+"""
+
 import shlex
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
-from loguru import logger
 
 import click
+import nibabel.freesurfer
+import numpy as np
+from loguru import logger
+
+# Direction cosines of the conformed (LIA) volume defining tkregister RAS.
+TKR_DIRECTIONS = np.array([[-1.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, -1.0, 0.0]])
+
+STL_TRIANGLE = np.dtype(
+    [("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")]
+)
+
+
+def read_surface(path: Path) -> tuple[np.ndarray, np.ndarray, dict]:
+    vertices, faces, volume_info = nibabel.freesurfer.read_geometry(path, read_metadata=True)
+    return vertices, faces, volume_info
+
+
+def tkr_to_scanner(volume_info: dict) -> np.ndarray:
+    """4x4 map from tkregister RAS to scanner RAS of the volume the surface was
+    created from."""
+    if volume_info.get("valid", "").split(" ")[0] != "1":
+        raise ValueError("The surface has no valid volume geometry")
+    voxelsize = np.asarray(volume_info["voxelsize"], dtype=float)
+    directions = np.column_stack([volume_info[key] for key in ("xras", "yras", "zras")])
+    vox2ras = directions * voxelsize
+    vox2ras_tkr = TKR_DIRECTIONS * voxelsize
+    # Both maps are centered at the middle voxel, where tkregister RAS is 0 and
+    # scanner RAS is c_ras.
+    transform = np.eye(4)
+    transform[:3, :3] = vox2ras @ np.linalg.inv(vox2ras_tkr)
+    transform[:3, 3] = volume_info["cras"]
+    return transform
+
+
+def write_stl(path: Path, vertices: np.ndarray, faces: np.ndarray, header: str = ""):
+    triangles = np.empty(len(faces), dtype=STL_TRIANGLE)
+    corners = vertices[faces]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    triangles["normal"] = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+    triangles["vertices"] = corners
+    triangles["attribute"] = 0
+    path.parent.mkdir(exist_ok=True, parents=True)
+    with open(path, "wb") as f:
+        f.write(header.encode("ascii", "replace")[:80].ljust(80, b" "))
+        f.write(np.array(len(faces), dtype="<u4").tobytes())
+        triangles.tofile(f)
+
+
+def convert_surface(surface: Path, output: Path):
+    vertices, faces, volume_info = read_surface(surface)
+    transform = tkr_to_scanner(volume_info)
+    scanner_vertices = vertices @ transform[:3, :3].T + transform[:3, 3]
+    write_stl(output, scanner_vertices, faces, header=f"{surface.name} (scanner RAS)")
+
+
+def container_convert(surface: Path, output: Path, license: Path, verbose: bool = False):
+    singularity_cmd = f"""
+        singularity exec -e
+        --no-mount home,cwd
+        --cwd /
+        -B "{surface.parent.resolve()}:/data"
+        -B "{output.parent.resolve()}:/output"
+        -B "{license.resolve()}:/usr/local/freesurfer/.license"
+        docker://freesurfer/freesurfer:7.4.1
+    """
+    redirect = ">> /dev/null" if not verbose else ""
+    cmd = f"{singularity_cmd} mris_convert --to-scanner /data/{surface.name} /output/{output.name} {redirect}"
+    print(" ".join(shlex.split(cmd)))
+    subprocess.run(
+        " ".join(shlex.split(cmd)),
+        shell=True,
+    ).check_returncode()
 
 
 @click.command()
 @click.option("-s", "fs_surface_dir", type=Path, required=True)
 @click.option("-o", "output_dir", type=Path, required=True)
-@click.option("-l", "license", type=Path, required=True)
+@click.option("-l", "license", type=Path, help="FreeSurfer license, needed for the container fallback")
 @click.option("--suffix", type=str, default="")
+@click.option("--workers", type=int, default=4)
+@click.option("--container", type=bool, is_flag=True, help="Convert with mris_convert in the FreeSurfer container")
 @click.option("--verbose", type=bool, is_flag=True)
 def run_fastsurfer(
     fs_surface_dir: Path,
     output_dir: Path,
-    license: Path,
+    license: Optional[Path],
     suffix: Optional[str] = None,
+    workers: int = 4,
+    container: bool = False,
     verbose: bool = False,
 ):
     suffix = "" if suffix is None else suffix
-    singularity_cmd = f"""
-        singularity exec -e
-        --no-mount home,cwd 
-        --cwd /
-        -B "{fs_surface_dir.resolve()}:/data" 
-        -B "{output_dir.resolve()}:/output" 
-        -B "{license.resolve()}:/usr/local/freesurfer/.license"
-        docker://freesurfer/freesurfer:7.4.1
-    """
+    if container and license is None:
+        raise click.UsageError("A FreeSurfer license (-l) is needed with --container")
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    def convert(surface: str):
+        input = fs_surface_dir / surface
+        output = output_dir / f"{surface.replace('.', '_') + suffix}.stl"
+        if not container:
+            try:
+                convert_surface(input, output)
+                return output
+            except ValueError as e:
+                if license is None:
+                    raise
+                logger.warning(f"{input}: {e}, falling back to mris_convert")
+        container_convert(input, output, license, verbose)
+        return output
 
     fs_surfaces = ["rh.pial", "lh.pial", "rh.white", "lh.white"]
     logger.info("Converting FS-surfaces to .stl")
-    for surface in fs_surfaces:
-        input = f"/data/{surface}"
-        output = Path(f"/output/{surface.replace('.', '_') + suffix}").with_suffix(
-            ".stl"
-        )
-        redirect = ">> /dev/null" if not verbose else ""
-        cmd = f"{singularity_cmd} mris_convert --to-scanner {input} {output} {redirect}"
-        print(" ".join(shlex.split(cmd)))
-        subprocess.run(
-            " ".join(shlex.split(cmd)),
-            shell=True,
-        ).check_returncode()
+    with ThreadPoolExecutor(max_workers=1 if container else workers) as executor:
+        for output in executor.map(convert, fs_surfaces):
+            logger.info(f"Wrote {output}")
 
 
 if __name__ == "__main__":
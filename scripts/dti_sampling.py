@@ -0,0 +1,179 @@
+"""
+Map the diffusion tensor, MD and FA images onto a mesh, as `gmri2fem i2m dti2mesh`.
+
+All three are mapped to DG0 on the mesh. The nine tensor components of every cell
+are taken from the valid tensor voxel nearest to the cell midpoint, in one gather
+of a (voxels x 9) array. MD and FA are stacked into a (voxels x 2) array and
+reduced to the median over the ten nearest voxels with a valid MD, so the
+neighbour search and the median are done once for both. The nearest-voxel search
+is the one of mesh_sampling.py.
+
+The voxel indices of the tensor selection and of the median neighbourhoods only
+depend on the mesh, the image grid and the masks of valid voxels. Like the
+sampling operator of mesh_sampling.py, they are stored as a `DTIOperator` next to
+the mesh, keyed by `operator_key`, and reused by later runs.
+
+Values are placed through the dofmaps of the function spaces, instead of
+assuming that the DG0 dofs are numbered like the cells.
+"""
+
+import dataclasses
+from pathlib import Path
+from typing import Optional
+
+import click
+import numpy as np
+from loguru import logger
+
+from mesh_sampling import nearest_voxels, operator_key, to_voxel_coordinates, write_npz
+from nifti_io import load_nifti
+
+
+@dataclasses.dataclass
+class DTIOperator:
+    nearest: np.ndarray
+    neighbours: np.ndarray
+    shape: tuple[int, ...]
+
+    def tensors(self, dti: np.ndarray) -> np.ndarray:
+        """Tensor (cells x 9) of the nearest valid voxel of every cell."""
+        return extend_to_9_components(dti).reshape(-1, 9)[self.nearest]
+
+    def medians(self, md: np.ndarray, fa: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Median MD and FA (cells,) over the neighbour voxels of every cell."""
+        scalars = np.stack([md.reshape(-1), fa.reshape(-1)], axis=-1)
+        medians = np.median(scalars[self.neighbours], axis=1)
+        return medians[:, 0], medians[:, 1]
+
+
+def extend_to_9_components(dti: np.ndarray) -> np.ndarray:
+    """Row-major 3x3 tensors from the 6 upper-triangular components
+    (xx, xy, xz, yy, yz, zz), as dti.clean_dti_data.extend_to_9_component_array."""
+    if dti.shape[-1] == 9:
+        return dti
+    if dti.shape[-1] != 6:
+        raise ValueError(f"Data has shape {dti.shape}, should have last dim 6 or 9")
+    return dti[..., [0, 1, 2, 1, 3, 4, 2, 4, 5]]
+
+
+def valid_masks(dti: np.ndarray, md: np.ndarray, brain_mask: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Voxels with a finite tensor, and voxels with a valid MD, within the brain."""
+    dti_mask = np.isfinite(dti).all(axis=-1).reshape(md.shape) & brain_mask
+    md_mask = (md > 1e-5) & brain_mask
+    return dti_mask, md_mask
+
+
+def build_dti_operator(
+    midpoints: np.ndarray, affine: np.ndarray, dti_mask: np.ndarray, md_mask: np.ndarray, N: int = 10
+) -> DTIOperator:
+    voxels = to_voxel_coordinates(midpoints, affine)
+    return DTIOperator(
+        nearest=nearest_voxels(voxels, dti_mask, N=1)[:, 0],
+        neighbours=nearest_voxels(voxels, md_mask, N=N),
+        shape=md_mask.shape,
+    )
+
+
+def save_dti_operator(path: Path, operator: DTIOperator):
+    write_npz(path, nearest=operator.nearest, neighbours=operator.neighbours, shape=operator.shape)
+
+
+def load_dti_operator(path: Path) -> DTIOperator:
+    with np.load(path) as f:
+        return DTIOperator(
+            nearest=f["nearest"],
+            neighbours=f["neighbours"],
+            shape=tuple(int(n) for n in f["shape"]),
+        )
+
+
+def sample_dti(
+    midpoints: np.ndarray,
+    affine: np.ndarray,
+    dti: np.ndarray,
+    md: np.ndarray,
+    fa: np.ndarray,
+    brain_mask: np.ndarray,
+    N: int = 10,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Tensor (cells x 9), MD and FA (cells,) of the cells with the given midpoints
+    in scanner coordinates."""
+    operator = build_dti_operator(midpoints, affine, *valid_masks(dti, md, brain_mask), N=N)
+    return (operator.tensors(dti), *operator.medians(md, fa))
+
+
+def map_dti(
+    mesh: Path,
+    dti: Path,
+    md: Path,
+    fa: Path,
+    mask: Path,
+    output: Path,
+    N: int = 10,
+    cache_dir: Optional[Path] = None,
+):
+    import dolfin as df
+    import panta_rhei as pr
+
+    dti_data, affine = load_nifti(dti, dtype=np.float64)
+    md_data, md_affine = load_nifti(md, dtype=np.float64)
+    fa_data, _ = load_nifti(fa, dtype=np.float64)
+    mask_data, _ = load_nifti(mask)
+    dti_data = dti_data.reshape(*md_data.shape, -1)
+    if not np.allclose(affine, md_affine):
+        raise ValueError(f"{dti} is not on the grid of {md}")
+
+    hdf = df.HDF5File(df.MPI.comm_world, str(mesh), "r")
+    domain = pr.read_domain(hdf)
+    hdf.close()
+    DG0 = df.FunctionSpace(domain, "DG", 0)
+    DG09 = df.TensorFunctionSpace(domain, "DG", 0)
+
+    # Dofs of every cell, ordered by cell; the tensor dofs in row-major component order.
+    tdim = domain.topology().dim()
+    cell_dofs = DG0.dofmap().entity_dofs(domain, tdim)
+    tensor_cell_dofs = DG09.dofmap().entity_dofs(domain, tdim).reshape(-1, 9)
+
+    dti_mask, md_mask = valid_masks(dti_data, md_data, mask_data != 0)
+    key = operator_key(mesh, affine, dti_mask, md_mask, kind="dti", N=N)
+    path = (cache_dir or mesh.parent / "mesh_sampling") / f"{key}.npz"
+    if path.exists():
+        operator = load_dti_operator(path)
+        logger.info(f"Loaded DTI sampling operator {path}")
+    else:
+        midpoints = np.array([cell.midpoint().array() for cell in df.cells(domain)])
+        operator = build_dti_operator(midpoints, affine, dti_mask, md_mask, N=N)
+        save_dti_operator(path, operator)
+        logger.info(f"Stored DTI sampling operator {path}")
+
+    tensors = operator.tensors(dti_data)
+    md_values, fa_values = operator.medians(md_data, fa_data)
+    D, MD, FA = df.Function(DG09), df.Function(DG0), df.Function(DG0)
+    for function, dofs, values in [(D, tensor_cell_dofs, tensors), (MD, cell_dofs, md_values), (FA, cell_dofs, fa_values)]:
+        array = np.empty(function.function_space().dim())
+        array[dofs] = values
+        function.vector()[:] = array
+
+    output.parent.mkdir(exist_ok=True, parents=True)
+    hdf = df.HDF5File(domain.mpi_comm(), str(output), "w")
+    pr.write_domain(hdf, domain)
+    pr.write_function(hdf, D, "DTI")
+    pr.write_function(hdf, MD, "MD")
+    pr.write_function(hdf, FA, "FA")
+    hdf.close()
+
+
+@click.command()
+@click.option("--mesh", type=Path, required=True)
+@click.option("--dti", type=Path, required=True)
+@click.option("--md", type=Path, required=True)
+@click.option("--fa", type=Path, required=True)
+@click.option("--mask", type=Path, required=True)
+@click.option("--output", type=Path, required=True)
+@click.option("--cache_dir", type=Path, help="Defaults to mesh_sampling/ next to the mesh")
+def main(**kwargs):
+    map_dti(**kwargs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+"""
+Content hashes of files, for the caches of the pipeline scripts.
+"""
+
+import hashlib
+from pathlib import Path
+
+
+def content_hash(path: Path) -> str:
+    """SHA-256 of the file content, read in chunks of 1 MiB."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(2**20):
+            sha.update(chunk)
+    return sha.hexdigest()
@@ -0,0 +1,123 @@
+"""
+Cached voxel index of a segmentation.
+
+The index holds the flat indices of all labelled voxels sorted by label, the
+offsets of every label's group, and the bounding box of every label, so that the
+voxels of a label are a slice instead of a comparison over the full volume. When
+a cache directory is given, it is stored there as `<name>.labelindex.npz`
+together with the SHA-256 of the segmentation file, and rebuilt whenever the
+segmentation changes.
+"""
+
+import dataclasses
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from hashing import content_hash
+from nifti_io import load_nifti
+
+INDEX_VERSION = 1
+
+
+@dataclasses.dataclass
+class LabelIndex:
+    shape: tuple[int, ...]
+    labels: np.ndarray  # (L,) sorted labels, without 0
+    offsets: np.ndarray  # (L + 1,) voxels[offsets[i]:offsets[i + 1]] have labels[i]
+    voxels: np.ndarray  # (N,) flat (C-order) voxel indices, sorted by label
+    bboxes: np.ndarray  # (L, ndim, 2) inclusive min and exclusive max voxel index
+
+    @property
+    def counts(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def position(self, label: int) -> int:
+        i = np.searchsorted(self.labels, label)
+        if i == len(self.labels) or self.labels[i] != label:
+            raise KeyError(f"Label {label} not in segmentation")
+        return int(i)
+
+    def voxels_of(self, label: int) -> np.ndarray:
+        i = self.position(label)
+        return self.voxels[self.offsets[i] : self.offsets[i + 1]]
+
+    def bbox(self, label: int) -> tuple[slice, ...]:
+        return tuple(slice(lo, hi) for lo, hi in self.bboxes[self.position(label)])
+
+    def mask(self, label: int) -> np.ndarray:
+        mask = np.zeros(int(np.prod(self.shape)), dtype=bool)
+        mask[self.voxels_of(label)] = True
+        return mask.reshape(self.shape)
+
+
+def build_label_index(segmentation: np.ndarray) -> LabelIndex:
+    seg = np.asarray(segmentation).reshape(-1)
+    voxels = np.flatnonzero(seg)
+    voxels = voxels[np.argsort(seg[voxels], kind="stable")]
+    labels, starts = np.unique(seg[voxels], return_index=True)
+    offsets = np.append(starts, len(voxels))
+    if len(voxels) > 0:
+        coordinates = np.stack(np.unravel_index(voxels, segmentation.shape), axis=1)
+        lower = np.minimum.reduceat(coordinates, starts, axis=0)
+        upper = np.maximum.reduceat(coordinates, starts, axis=0) + 1
+        bboxes = np.stack([lower, upper], axis=-1)
+    else:
+        bboxes = np.zeros((0, segmentation.ndim, 2), dtype=np.int64)
+    return LabelIndex(segmentation.shape, labels, offsets, voxels, bboxes)
+
+
+def sidecar_path(path: Path, cache_dir: Path) -> Path:
+    name = Path(path).name.removesuffix(".gz").removesuffix(".nii").removesuffix(".mgz")
+    return Path(cache_dir) / f"{name}.labelindex.npz"
+
+
+def load_label_index(path: Path, cache_dir: Optional[Path] = None) -> LabelIndex:
+    """Label index of the segmentation at path. With a cache directory, it is read
+    from the cached index if that matches the current content of the file, and
+    otherwise built and stored there."""
+    if cache_dir is None:
+        seg, _ = load_nifti(path)
+        return build_label_index(np.asarray(seg).astype(int))
+
+    digest = f"v{INDEX_VERSION}:{content_hash(path)}"
+    sidecar = sidecar_path(path, cache_dir)
+    try:
+        with np.load(sidecar) as cached:
+            if str(cached["digest"]) == digest:
+                return LabelIndex(
+                    tuple(cached["shape"]),
+                    cached["labels"],
+                    cached["offsets"],
+                    cached["voxels"],
+                    cached["bboxes"],
+                )
+    except (FileNotFoundError, KeyError, ValueError, OSError):
+        pass
+
+    seg, _ = load_nifti(path)
+    index = build_label_index(np.asarray(seg).astype(int))
+    save_label_index(sidecar, index, digest)
+    return index
+
+
+def save_label_index(sidecar: Path, index: LabelIndex, digest: str):
+    # Written atomically, as several rules may read the same segmentation.
+    sidecar.parent.mkdir(exist_ok=True, parents=True)
+    with tempfile.NamedTemporaryFile(
+        dir=sidecar.parent, prefix=f".{sidecar.name}.", suffix=".tmp", delete=False
+    ) as f:
+        np.savez(
+            f,
+            digest=digest,
+            shape=np.array(index.shape),
+            labels=index.labels,
+            offsets=index.offsets,
+            voxels=index.voxels,
+            bboxes=index.bboxes,
+        )
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, sidecar)
@@ -0,0 +1,171 @@
+"""
+Voxelwise T1 maps from Look-Locker inversion recovery series.
+
+The signal in every voxel of the 4D series is fitted to
+    |x1 (1 - (1 + x2^2) exp(-x3^2 t))|,
+with the trigger times t in seconds, and the Look-Locker corrected T1 in ms is
+(x2 / x3)^2 * 1000, capped at 10000 ms as in `gmri2fem mri looklocker-t1map`.
+Only voxels with a positive peak intensity inside the mask (--mask, or the head
+mask of the first volume with --head_mask), and above the threshold, are fitted.
+They are split into chunks that are fitted with the vectorized fitter from
+mri_noise_analysis/look_locker.py on a process pool, and only the chunks in
+flight are held in memory as floating point arrays.
+
+Curves where no fit has a relative residual norm below 0.1, which in noisy
+voxels is most of them, are refitted by the fallback of `curve_fit_batch`: by
+default the batched global search, which keeps the best converged fit like
+gmri2fem does. With --fallback none they are left as NaN. A map of the relative
+residual norm of every fit can be written with --quality.
+"""
+
+import sys
+from pathlib import Path
+from typing import Optional
+
+import click
+import numpy as np
+import scipy.ndimage
+import skimage.filters
+from loguru import logger
+
+from nifti_io import load_nifti, save_nifti
+
+sys.path.insert(0, str(Path(__file__).parent / "mri_noise_analysis"))
+from look_locker import curve_fit_batch  # noqa: E402
+from scheduler import chunk_slices, run_chunks  # noqa: E402
+
+
+T1_ROOF = 10000
+
+
+def f(t, x1, x2, x3):
+    return np.abs(x1 * (1.0 - (1 + x2**2) * np.exp(-(x3**2) * t)))
+
+
+def head_mask(volume: np.ndarray, smoothing_level: float = 5) -> np.ndarray:
+    """Head mask of a volume, as gmri2fem's mri_facemask: triangle threshold,
+    filled holes, Gaussian smoothing and an isodata threshold."""
+    binary = volume > skimage.filters.threshold_triangle(volume)
+    binary = scipy.ndimage.binary_fill_holes(binary)
+    smoothed = skimage.filters.gaussian(binary, sigma=smoothing_level)
+    return smoothed > skimage.filters.threshold_isodata(smoothed)
+
+
+def fit_chunk(t, Y, fallback="global"):
+    """T1 in ms and relative residual norm for every row of Y."""
+    popt = curve_fit_batch(f, t, Y, initial_guess="grid", fallback=fallback)
+    x1, x2, x3 = (p[:, None] for p in popt.T)
+    with np.errstate(all="ignore"):
+        T1 = np.minimum((x2 / x3) ** 2 * 1000.0, T1_ROOF)[:, 0]
+        residual = np.linalg.norm(f(t[None, :], x1, x2, x3) - Y, axis=1) / np.max(Y, axis=1)
+    return T1, residual
+
+
+def fit_voxels(
+    t: np.ndarray,
+    data: np.ndarray,
+    voxels: np.ndarray,
+    chunk_size: int = 4096,
+    workers: Optional[int] = None,
+    fallback: Optional[str] = "global",
+):
+    """Fit the curves data[voxels] of an (N, len(t)) array, chunk by chunk. The
+    chunks are only converted to floating point when they are handed to a worker."""
+    T1 = np.full(len(voxels), np.nan)
+    residual = np.full(len(voxels), np.nan)
+    chunks = chunk_slices(len(voxels), chunk_size)
+    tasks = (
+        (t, data[voxels[chunk]].astype(float), fallback) for chunk in chunks
+    )
+    for n, (chunk, result) in enumerate(
+        zip(chunks, run_chunks(fit_chunk, tasks, workers=workers)), start=1
+    ):
+        T1[chunk], residual[chunk] = result
+        if n % 50 == 0 or n == len(chunks):
+            logger.info(f"Fitted {chunk.stop} / {len(voxels)} voxels")
+    return T1, residual
+
+
+def select_voxels(data: np.ndarray, mask: Optional[np.ndarray], threshold: Optional[float]):
+    """Flat indices of the voxels in the mask whose peak intensity over time is
+    above the threshold. Without either, all voxels with a positive signal."""
+    peak = np.max(data, axis=1)
+    selected = peak > (0.0 if threshold is None else threshold)
+    if mask is not None:
+        selected &= mask.reshape(-1) != 0
+    return np.flatnonzero(selected)
+
+
+def estimate_t1map(
+    data: np.ndarray,
+    timestamps: np.ndarray,
+    mask: Optional[np.ndarray] = None,
+    threshold: Optional[float] = None,
+    chunk_size: int = 4096,
+    workers: Optional[int] = None,
+    fallback: Optional[str] = "global",
+):
+    if data.ndim != 4 or data.shape[-1] != len(timestamps):
+        raise ValueError(
+            f"Expected a 4D series with {len(timestamps)} time points, got shape {data.shape}"
+        )
+    if mask is not None and mask.shape != data.shape[:3]:
+        raise ValueError(f"Mask shape {mask.shape} does not match the series {data.shape[:3]}")
+    series = data.reshape(-1, data.shape[-1])
+    voxels = select_voxels(series, mask, threshold)
+    logger.info(f"Fitting {len(voxels)} of {len(series)} voxels")
+
+    T1, residual = fit_voxels(
+        timestamps, series, voxels, chunk_size, workers, fallback
+    )
+    T1map = np.full(len(series), np.nan, dtype=np.float32)
+    quality = np.full(len(series), np.nan, dtype=np.float32)
+    T1map[voxels] = T1
+    quality[voxels] = residual
+    return T1map.reshape(data.shape[:3]), quality.reshape(data.shape[:3])
+
+
+@click.command()
+@click.option("--input", "input_path", type=Path, required=True, help="4D Look-Locker series")
+@click.option("--timestamps", type=Path, required=True, help="Trigger times in ms")
+@click.option("--output", type=Path, required=True, help="T1 map in ms")
+@click.option("--quality", type=Path, help="Relative residual norm of every fit")
+@click.option("--mask", type=Path, help="Only fit voxels where the mask is nonzero")
+@click.option("--head_mask", "use_head_mask", is_flag=True, help="Only fit voxels in the head mask of the first volume")
+@click.option("--threshold", type=float, help="Only fit voxels with a peak intensity above this")
+@click.option("--chunk_size", default=4096, help="Number of voxels per chunk")
+@click.option("--workers", type=int, help="Number of worker processes (default: all CPUs)")
+@click.option(
+    "--fallback",
+    type=click.Choice(["global", "direct", "none"]),
+    default="global",
+    help="Refit of voxels without an acceptable fit, see curve_fit_batch",
+)
+def main(
+    input_path: Path,
+    timestamps: Path,
+    output: Path,
+    quality: Optional[Path],
+    mask: Optional[Path],
+    use_head_mask: bool,
+    threshold: Optional[float],
+    chunk_size: int,
+    workers: Optional[int],
+    fallback: str,
+):
+    LL, affine = load_nifti(input_path)
+    time_s = np.loadtxt(timestamps) / 1000.0
+    mask_data = load_nifti(mask)[0] != 0 if mask is not None else None
+    if use_head_mask:
+        head = head_mask(np.asarray(LL[..., 0], dtype=np.float32))
+        mask_data = head if mask_data is None else mask_data & head
+    T1map, residual = estimate_t1map(
+        LL, time_s, mask_data, threshold, chunk_size, workers, None if fallback == "none" else fallback
+    )
+    save_nifti(output, T1map, affine)
+    if quality is not None:
+        save_nifti(quality, residual, affine)
+
+
+if __name__ == "__main__":
+    main()
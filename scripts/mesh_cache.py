@@ -0,0 +1,158 @@
+"""
+Content-addressed cache for the surface processing and meshing steps.
+
+A step is identified by its command, its parameters and the content (sha256) of
+its input files, not by their timestamps. If an entry for the key exists in the
+cache directory, the outputs are restored from it (hard-linked where possible,
+and with their modification times set to now) instead of running the command
+again; otherwise the command is run and its outputs are stored. Outputs may be
+files or directories.
+
+This lets a resolution sweep, or a rerun after upstream files were rewritten with
+the same content, reuse the repaired and refined surfaces and previous meshes,
+and only redo the volume meshing for new resolutions. The least recently used
+entries are evicted when the cache directory grows beyond --cache_max_mb
+(default MESH_CACHE_MAX_MB, or 4096).
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+import click
+from loguru import logger
+
+from hashing import content_hash
+
+CACHE_MAX_BYTES = int(float(os.environ.get("MESH_CACHE_MAX_MB", 4096)) * 2**20)
+
+
+def cache_key(command: list[str], inputs: list[Path], params: dict[str, str]) -> str:
+    description = {
+        "command": list(command),
+        "params": dict(sorted(params.items())),
+        "inputs": [content_hash(path) for path in inputs],
+    }
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+
+def _remove(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists() or path.is_symlink():
+        path.unlink()
+
+
+def _link_or_copy(source: Path, target: Path):
+    _remove(target)
+    target.parent.mkdir(exist_ok=True, parents=True)
+    if source.is_dir():
+        shutil.copytree(source, target, copy_function=_link_file)
+    else:
+        _link_file(source, target)
+
+
+def _link_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _touch(path: Path):
+    # Restored hard links share the timestamps of the cache entry, which predate
+    # the inputs the step is rerun for.
+    if path.is_dir():
+        for child in path.rglob("*"):
+            os.utime(child)
+    os.utime(path)
+
+
+def restore(entry: Path, outputs: list[Path]) -> bool:
+    if not (entry / "complete").exists():
+        return False
+    try:
+        for idx, output in enumerate(outputs):
+            _link_or_copy(entry / str(idx), output)
+            _touch(output)
+    except FileNotFoundError:
+        # Evicted by a concurrent job.
+        return False
+    os.utime(entry)  # Mark as recently used.
+    return True
+
+
+def store(entry: Path, outputs: list[Path]):
+    tmp = entry.with_name(entry.name + ".tmp")
+    _remove(tmp)
+    tmp.mkdir(parents=True)
+    for idx, output in enumerate(outputs):
+        _link_or_copy(output, tmp / str(idx))
+    (tmp / "complete").touch()
+    _remove(entry)
+    tmp.replace(entry)
+
+
+def _size(entry: Path) -> int:
+    return sum(path.stat().st_size for path in entry.rglob("*") if path.is_file())
+
+
+def evict(cache_dir: Path, max_bytes: int, keep: Optional[Path] = None):
+    # Entries being written (.tmp) are left alone.
+    entries = [entry for entry in cache_dir.iterdir() if entry.is_dir() and entry.suffix != ".tmp"]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    sizes = {entry: _size(entry) for entry in entries}
+    total = sum(sizes.values())
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
+
+
+def cached_run(
+    command: list[str],
+    inputs: list[Path],
+    outputs: list[Path],
+    cache_dir: Path,
+    params: dict[str, str],
+    max_bytes: int = CACHE_MAX_BYTES,
+):
+    key = cache_key(command, inputs, params)
+    entry = cache_dir / key
+    if restore(entry, outputs):
+        logger.info(f"Restored {len(outputs)} outputs from {entry}")
+        return
+    # Outputs may be hard links into the cache, and must not be written in place.
+    for output in outputs:
+        _remove(output)
+    logger.info(" ".join(command))
+    subprocess.run(command).check_returncode()
+    missing = [output for output in outputs if not output.exists()]
+    if missing:
+        raise FileNotFoundError(f"Command did not create {missing}")
+    store(entry, outputs)
+    logger.info(f"Stored {len(outputs)} outputs in {entry}")
+    evict(cache_dir, max_bytes, keep=entry)
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.option("--input", "inputs", type=Path, multiple=True, help="Input file, hashed by content")
+@click.option("--output", "outputs", type=Path, multiple=True, required=True, help="Output file or directory")
+@click.option("--param", "params", type=(str, str), multiple=True, help="Extra key and value of the cache key")
+@click.option("--cache_dir", type=Path, required=True)
+@click.option("--cache_max_mb", type=float, help="Size limit of the cache directory")
+@click.argument("command", nargs=-1, type=click.UNPROCESSED, required=True)
+def main(inputs, outputs, params, cache_dir: Path, cache_max_mb: Optional[float], command):
+    max_bytes = CACHE_MAX_BYTES if cache_max_mb is None else int(cache_max_mb * 2**20)
+    cached_run(list(command), list(inputs), list(outputs), cache_dir, dict(params), max_bytes)
+
+
+if __name__ == "__main__":
+    main()
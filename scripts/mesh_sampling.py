@@ -0,0 +1,305 @@
+"""
+Map concentration images onto a mesh with a precomputed sampling operator.
+
+`gmri2fem i2m concentrations2mesh` locates the quadrature points and boundary
+DOFs of the mesh in voxel space, searches for their nearest valid voxels and
+assembles the L2-projection for every image. All of this only depends on the
+mesh, the image grid and the masks, so it is done once here and stored next to
+the mesh as a sparse operator:
+
+- `projection` (DOFs x voxels): the assembled right-hand side of the
+  L2-projection of the nearest-voxel quadrature values, i.e. b = P x,
+- `mass` (DOFs x DOFs): the mass matrix of the projection,
+- `boundary_neighbours`: the flat indices of the N nearest CSF voxels of every
+  boundary DOF, of which the median gives the boundary concentration.
+
+All sessions are then mapped together: the images are stacked as the columns of a
+(voxels x sessions) array, and the projection is a single sparse product followed
+by a solve with many right-hand sides, with the mass matrix factorized once per
+operator. The operator applies equally to multi-component images, with one
+column per component.
+
+dolfin and panta_rhei are only imported by the functions working on the mesh.
+"""
+
+import dataclasses
+import functools
+import hashlib
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import click
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.spatial
+from loguru import logger
+
+from hashing import content_hash
+from nifti_io import erode_ball, load_nifti, session_info
+from timetable import load_timetable
+
+
+@dataclasses.dataclass
+class SamplingOperator:
+    projection: scipy.sparse.csr_matrix
+    mass: scipy.sparse.csr_matrix
+    boundary_dofs: np.ndarray
+    boundary_neighbours: np.ndarray
+    shape: tuple[int, ...]
+
+    @functools.cached_property
+    def mass_factorization(self) -> scipy.sparse.linalg.SuperLU:
+        return scipy.sparse.linalg.splu(self.mass.tocsc())
+
+    def project(self, volumes: np.ndarray) -> np.ndarray:
+        """DOF values (DOFs x n) of the L2-projection of n volumes, given as a
+        (voxels x n) array."""
+        rhs = self.projection @ volumes
+        return self.mass_factorization.solve(np.asarray(rhs, dtype=np.float64))
+
+    def boundary(self, volumes: np.ndarray) -> np.ndarray:
+        """Median over the neighbour voxels of every boundary DOF, (boundary DOFs x n)."""
+        return np.nanmedian(volumes[self.boundary_neighbours], axis=1)
+
+
+def csf_boundary_mask(csf_mask: np.ndarray) -> np.ndarray:
+    """The CSF mask eroded by one voxel, like skimage's binary_erosion with ball(1)
+    in gmri2fem: voxels outside of the image count as CSF, so the mask is not
+    eroded along the image border."""
+    return erode_ball(np.asarray(csf_mask).astype(bool), 1)
+
+
+def session_timestamps(times, paths: list[Path], sequence_label: str = "looklocker") -> np.ndarray:
+    """Acquisition times of the sessions, with the times before the injection
+    clipped to 0 as in gmri2fem."""
+    return np.maximum(0, [times.time(*session_info(path), sequence_label) for path in paths])
+
+
+def stack_volumes(volumes: list[np.ndarray]) -> np.ndarray:
+    return np.stack([np.asarray(v, dtype=np.float64).reshape(-1) for v in volumes], axis=-1)
+
+
+def nearest_voxels(voxel_coordinates: np.ndarray, mask: np.ndarray, N: int) -> np.ndarray:
+    """Flat indices (points x N) of the N voxels in mask nearest to each point."""
+    valid = np.argwhere(mask)
+    _, indices = scipy.spatial.KDTree(valid).query(voxel_coordinates, k=N)
+    indices = indices.reshape(len(voxel_coordinates), N)
+    return np.ravel_multi_index(tuple(valid[indices].T), mask.shape).T
+
+
+def selection_matrix(flat_indices: np.ndarray, num_voxels: int) -> scipy.sparse.csr_matrix:
+    rows = np.arange(len(flat_indices))
+    return scipy.sparse.csr_matrix(
+        (np.ones(len(flat_indices)), (rows, flat_indices)), shape=(len(flat_indices), num_voxels)
+    )
+
+
+def to_scipy(matrix) -> scipy.sparse.csr_matrix:
+    import dolfin as df
+
+    petsc = df.as_backend_type(matrix).mat()
+    indptr, indices, data = petsc.getValuesCSR()
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=petsc.getSize())
+
+
+def to_voxel_coordinates(points: np.ndarray, affine: np.ndarray) -> np.ndarray:
+    return points @ np.linalg.inv(affine)[:3, :3].T + np.linalg.inv(affine)[:3, 3]
+
+
+def build_operator(
+    V: "df.FunctionSpace",
+    affine: np.ndarray,
+    internal_mask: np.ndarray,
+    boundary_mask: np.ndarray,
+    quad_degree: int,
+    boundary_npoints: int,
+) -> SamplingOperator:
+    import dolfin as df
+
+    domain = V.mesh()
+    quad_element = df.FiniteElement(
+        "Quadrature", domain.ufl_cell(), degree=quad_degree, quad_scheme="default"
+    )
+    Q = df.FunctionSpace(domain, quad_element)
+    quad_voxels = to_voxel_coordinates(Q.tabulate_dof_coordinates(), affine)
+    selection = selection_matrix(
+        nearest_voxels(quad_voxels, internal_mask, N=1)[:, 0], internal_mask.size
+    )
+
+    dx = df.Measure("dx", metadata={"quadrature_degree": quad_degree})
+    u, v, q = df.TrialFunction(V), df.TestFunction(V), df.TrialFunction(Q)
+    mass = to_scipy(df.assemble(u * v * dx))
+    rhs = to_scipy(df.assemble(q * v * dx))
+
+    boundary_dofs = np.array(
+        sorted(df.DirichletBC(V, df.Constant(0), "on_boundary").get_boundary_values().keys()),
+        dtype=np.int64,
+    )
+    dof_voxels = to_voxel_coordinates(V.tabulate_dof_coordinates()[boundary_dofs], affine)
+    return SamplingOperator(
+        projection=(rhs @ selection).tocsr(),
+        mass=mass,
+        boundary_dofs=boundary_dofs,
+        boundary_neighbours=nearest_voxels(dof_voxels, boundary_mask, N=boundary_npoints),
+        shape=internal_mask.shape,
+    )
+
+
+def write_npz(path: Path, **arrays):
+    path.parent.mkdir(exist_ok=True, parents=True)
+    # Written to a unique file and renamed, as concurrent jobs may share the operator.
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f".{path.stem}.", suffix=".tmp", delete=False) as f:
+        np.savez(f, **arrays)
+    Path(f.name).replace(path)
+
+
+def save_operator(path: Path, operator: SamplingOperator):
+    write_npz(
+        path,
+        projection_data=operator.projection.data,
+        projection_indices=operator.projection.indices,
+        projection_indptr=operator.projection.indptr,
+        projection_shape=operator.projection.shape,
+        mass_data=operator.mass.data,
+        mass_indices=operator.mass.indices,
+        mass_indptr=operator.mass.indptr,
+        mass_shape=operator.mass.shape,
+        boundary_dofs=operator.boundary_dofs,
+        boundary_neighbours=operator.boundary_neighbours,
+        shape=operator.shape,
+    )
+
+
+def load_operator(path: Path) -> SamplingOperator:
+    with np.load(path) as f:
+
+        def csr(name):
+            return scipy.sparse.csr_matrix(
+                (f[f"{name}_data"], f[f"{name}_indices"], f[f"{name}_indptr"]),
+                shape=tuple(f[f"{name}_shape"]),
+            )
+
+        return SamplingOperator(
+            projection=csr("projection"),
+            mass=csr("mass"),
+            boundary_dofs=f["boundary_dofs"],
+            boundary_neighbours=f["boundary_neighbours"],
+            shape=tuple(int(n) for n in f["shape"]),
+        )
+
+
+def operator_key(meshpath: Path, affine: np.ndarray, *arrays, **params) -> str:
+    m = hashlib.sha256(content_hash(meshpath).encode())
+    m.update(np.ascontiguousarray(affine, dtype=np.float64).tobytes())
+    for array in arrays:
+        m.update(repr(array.shape).encode())
+        m.update(np.packbits(array.reshape(-1)).tobytes())
+    m.update(repr(sorted(params.items())).encode())
+    return m.hexdigest()
+
+
+def map_concentrations(
+    concentration_paths: list[Path],
+    meshpath: Path,
+    csfmask_path: Path,
+    timetable: Path,
+    output: Path,
+    femfamily: str,
+    femdegree: int,
+    visualdir: Optional[Path] = None,
+    quad_degree: int = 6,
+    boundary_npoints: int = 10,
+    cache_dir: Optional[Path] = None,
+):
+    import dolfin as df
+    import panta_rhei as pr
+
+    csf_mask_data, affine = load_nifti(csfmask_path)
+    csf_mask = csf_boundary_mask(csf_mask_data)
+    timestamps = session_timestamps(load_timetable(timetable), concentration_paths)
+
+    volumes = []
+    for path in concentration_paths:
+        data, image_affine = load_nifti(path, dtype=np.float32)
+        if data.shape != csf_mask.shape or not np.allclose(image_affine, affine):
+            raise ValueError(f"{path} is not on the grid of {csfmask_path}")
+        volumes.append(data)
+    # The nearest valid voxels depend on which voxels are finite, which is the
+    # same for all sessions; otherwise there is one operator per distinct set.
+    valid = [np.isfinite(data) for data in volumes]
+    groups: dict[bytes, list[int]] = {}
+    for idx, mask in enumerate(valid):
+        groups.setdefault(hashlib.sha256(np.packbits(mask)).digest(), []).append(idx)
+
+    domain = pr.hdf2fenics(meshpath, pack=True)
+    V = df.FunctionSpace(domain, femfamily, femdegree)
+    cache_dir = cache_dir or meshpath.parent / "mesh_sampling"
+
+    internal = np.empty((V.dim(), len(volumes)))
+    boundary_values = np.empty((V.dim(), len(volumes)))
+    for members in groups.values():
+        internal_mask = ~csf_mask & valid[members[0]]
+        boundary_mask = csf_mask & valid[members[0]]
+        key = operator_key(
+            meshpath, affine, internal_mask, boundary_mask,
+            femfamily=femfamily, femdegree=femdegree, quad_degree=quad_degree, N=boundary_npoints,
+        )
+        path = cache_dir / f"{key}.npz"
+        if path.exists():
+            operator = load_operator(path)
+            logger.info(f"Loaded sampling operator {path}")
+        else:
+            operator = build_operator(
+                V, affine, internal_mask, boundary_mask, quad_degree, boundary_npoints
+            )
+            save_operator(path, operator)
+            logger.info(f"Stored sampling operator {path}")
+        stacked = stack_volumes([volumes[idx] for idx in members])
+        boundary_dofs = operator.boundary_dofs
+        internal[:, members] = operator.project(stacked)
+        boundary_values[boundary_dofs[:, None], members] = operator.boundary(stacked)
+
+    outfile = pr.FenicsStorage(str(output), "w")
+    outfile.write_domain(domain)
+    for idx, ti in enumerate(timestamps):
+        u_boundary = df.Function(V)
+        u_boundary.vector()[boundary_dofs] = boundary_values[boundary_dofs, idx]
+        outfile.write_checkpoint(u_boundary, name="boundary_concentration", t=ti)
+        u_internal = df.Function(V)
+        u_internal.vector()[:] = internal[:, idx]
+        outfile.write_checkpoint(u_internal, name="concentration", t=ti)
+    outfile.close()
+
+    if visualdir is not None:
+        pr.fenicsstorage2xdmf(
+            pr.FenicsStorage(outfile.filepath, "r"),
+            "concentration",
+            "internal",
+            lambda _: visualdir / "concentrations_internal.xdmf",
+        )
+        pr.fenicsstorage2xdmf(
+            pr.FenicsStorage(outfile.filepath, "r"),
+            "boundary_concentration",
+            "boundary",
+            lambda _: visualdir / "concentrations_boundary.xdmf",
+        )
+
+
+@click.command()
+@click.argument("concentration_paths", type=Path, nargs=-1, required=True)
+@click.option("--meshpath", type=Path, required=True)
+@click.option("--csfmask_path", type=Path, required=True)
+@click.option("--timetable", type=Path, required=True)
+@click.option("--output", type=Path, required=True)
+@click.option("--femfamily", type=str, default="CG")
+@click.option("--femdegree", type=int, default=1)
+@click.option("--visualdir", type=Path)
+@click.option("--cache_dir", type=Path, help="Defaults to mesh_sampling/ next to the mesh")
+def main(concentration_paths, **kwargs):
+    map_concentrations(list(concentration_paths), **kwargs)
+
+
+if __name__ == "__main__":
+    main()
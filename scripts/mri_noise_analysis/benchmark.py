@@ -0,0 +1,226 @@
+"""
+Benchmarks for the T1 estimation kernels on synthetic volumes.
+
+Every (kernel, size) measurement runs in a fresh process. The wall time is the
+best of --repeats untraced runs, and the peak memory is measured with tracemalloc
+in one more run, counting only the memory allocated by the kernel on top of its
+inputs (NumPy reports its array allocations to tracemalloc). Wall time, peak
+memory and voxels per second are appended to a JSON history file, and compared
+against a stored baseline to flag regressions.
+"""
+
+import json
+import multiprocessing as mp
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import click
+import numpy as np
+
+from common import compute_T1, compute_c
+from look_locker import curve_fit_batch, curve_fit_wrapper
+from mixed import (
+    LOOKUP_INVERTER,
+    compute_ir_signal,
+    compute_se_signal,
+    extract_mixed_t1,
+    metadata,
+    T1_lookup_table,
+)
+from plot_noise_look_locker import f
+
+
+def synthetic_T1(n, rng):
+    return compute_T1(rng.uniform(0.0, 0.3, n))
+
+
+def synthetic_look_locker(n, rng, snr=25):
+    t = np.linspace(0, 2.6, 14)
+    x2 = np.sqrt(0.5)
+    x3 = np.sqrt((0.1 + x2**2) / (synthetic_T1(n, rng) * 0.001))
+    y = f(t[None, :], 1.0, x2, x3[:, None])
+    scale = np.max(y, axis=1, keepdims=True) / snr
+    noise = np.sqrt(rng.normal(0, scale, y.shape) ** 2 + rng.normal(0, scale, y.shape) ** 2)
+    return t, y + noise
+
+
+def setup_curve_fit_wrapper(n, rng):
+    t, Y = synthetic_look_locker(n, rng)
+    return (t, Y), n
+
+
+def run_curve_fit_wrapper(t, Y):
+    return [curve_fit_wrapper(f, t, y, None) for y in Y]
+
+
+def setup_curve_fit_batch(n, rng):
+    t, Y = synthetic_look_locker(n, rng)
+    return (t, Y), n
+
+
+def run_curve_fit_batch(t, Y):
+    return curve_fit_batch(f, t, Y)
+
+
+def run_curve_fit_batch_global(t, Y):
+    return curve_fit_batch(f, t, Y, fallback="global")
+
+
+def setup_extract_mixed_t1(n, rng):
+    T1 = synthetic_T1(n, rng)
+    return (compute_ir_signal(T1, rng=rng), compute_se_signal(T1, rng=rng)), n
+
+
+def run_extract_mixed_t1(IR, SE):
+    return extract_mixed_t1(IR, SE, LOOKUP_INVERTER)
+
+
+# Kernels whose number of voxels does not depend on the requested size.
+FIXED_VOXELS = {"T1_lookup_table": 10000}
+
+
+def voxel_count(name, size):
+    return FIXED_VOXELS.get(name, size)
+
+
+def setup_T1_lookup_table(n, rng):
+    # The table has a fixed size, independent of the volume.
+    return (metadata["TR_se"], metadata["TI"], metadata["TE"], 1, 10000), FIXED_VOXELS["T1_lookup_table"]
+
+
+def setup_compute_c(n, rng):
+    return (synthetic_T1(n, rng),), n
+
+
+def setup_compute_T1(n, rng):
+    return (rng.uniform(0.0, 0.3, n),), n
+
+
+# name: (setup, kernel, largest size run by default)
+KERNELS = {
+    "curve_fit_wrapper": (setup_curve_fit_wrapper, run_curve_fit_wrapper, 10**3),
+    "curve_fit_batch": (setup_curve_fit_batch, run_curve_fit_batch, 10**3),
+    "curve_fit_batch_global": (setup_curve_fit_batch, run_curve_fit_batch_global, 10**4),
+    "extract_mixed_t1": (setup_extract_mixed_t1, run_extract_mixed_t1, 10**7),
+    "T1_lookup_table": (setup_T1_lookup_table, T1_lookup_table, 10**7),
+    "compute_c": (setup_compute_c, compute_c, 10**7),
+    "compute_T1": (setup_compute_T1, compute_T1, 10**7),
+}
+
+
+def measure(name, size, repeats, seed):
+    setup, kernel, _ = KERNELS[name]
+    args, voxels = setup(size, np.random.default_rng(seed))
+    wall_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        kernel(*args)
+        wall_times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    kernel(*args)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    wall_time = min(wall_times)
+    return {
+        "kernel": name,
+        "voxels": voxels,
+        "wall_time_s": wall_time,
+        "peak_memory_mb": peak_bytes / 2**20,
+        "voxels_per_s": voxels / wall_time if wall_time > 0 else float("inf"),
+    }
+
+
+def measure_in_subprocess(name, size, repeats, seed):
+    with mp.get_context("spawn").Pool(1) as pool:
+        return pool.apply(measure, (name, size, repeats, seed))
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_json(path: Path, default):
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return default
+
+
+def find_regressions(records, baseline, tolerance):
+    regressions = []
+    for record in records:
+        reference = baseline.get(f"{record['kernel']}@{record['voxels']}")
+        if reference is None:
+            continue
+        if record["voxels_per_s"] < reference["voxels_per_s"] * (1 - tolerance):
+            regressions.append((record, reference, "voxels_per_s"))
+        if "peak_memory_mb" in reference and record["peak_memory_mb"] > reference["peak_memory_mb"] * (1 + tolerance):
+            regressions.append((record, reference, "peak_memory_mb"))
+    return regressions
+
+
+@click.command()
+@click.option("--kernel", "kernels", multiple=True, type=click.Choice(list(KERNELS)), help="Kernels to run (default: all)")
+@click.option("--size", "sizes", multiple=True, type=float, default=[1e3, 1e4, 1e5, 1e6, 1e7], help="Number of voxels")
+@click.option("--repeats", default=3, help="Timed runs per measurement; the fastest is recorded")
+@click.option("--all_sizes", is_flag=True, help="Also run sizes above each kernel's default limit")
+@click.option("--history", type=Path, default=Path("benchmark_history.json"), help="JSON file the results are appended to")
+@click.option("--baseline", type=Path, default=Path("benchmark_baseline.json"), help="JSON file with the reference results")
+@click.option("--save_baseline", is_flag=True, help="Store these results as the new baseline")
+@click.option("--tolerance", default=0.2, help="Relative slowdown or memory growth flagged as a regression")
+@click.option("--seed", default=0)
+def main(kernels, sizes, repeats, all_sizes, history, baseline, save_baseline, tolerance, seed):
+    kernels = kernels or list(KERNELS)
+    run = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "host": platform.node(),
+        "machine": platform.machine(),
+        "results": [],
+    }
+    measured = set()
+    for name in kernels:
+        for size in sorted({int(s) for s in sizes}):
+            if size > KERNELS[name][2] and not all_sizes:
+                print(f"{name}: skipping {size} voxels (use --all_sizes)")
+                continue
+            # Checked before measuring, as measurements of the same voxels are duplicates.
+            if (name, voxel_count(name, size)) in measured:
+                continue
+            measured.add((name, voxel_count(name, size)))
+            record = measure_in_subprocess(name, size, repeats, seed)
+            run["results"].append(record)
+            print(
+                f"{name:>18} {record['voxels']:>10d} voxels {record['wall_time_s']:10.4f} s"
+                f" {record['peak_memory_mb']:9.1f} MB {record['voxels_per_s']:12.4g} voxels/s"
+            )
+
+    runs = load_json(history, [])
+    runs.append(run)
+    history.write_text(json.dumps(runs, indent=2))
+
+    reference = load_json(baseline, {})
+    regressions = find_regressions(run["results"], reference, tolerance)
+    for record, ref, metric in regressions:
+        print(
+            f"REGRESSION {record['kernel']}@{record['voxels']}: {metric}"
+            f" {record[metric]:.4g} vs baseline {ref[metric]:.4g}"
+        )
+    if save_baseline:
+        reference.update({f"{r['kernel']}@{r['voxels']}": r for r in run["results"]})
+        baseline.write_text(json.dumps(reference, indent=2))
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Content-addressed cache for the results of the noise simulations.
+
+Entries are stored as .npy files named by a hash of all simulation parameters and
+of the source code of the model, generator and fitter, so changing any of them
+gives a new entry. Writes are atomic, reads are memory-mapped, and the least
+recently used entries are evicted when the cache directory grows beyond its size
+limit. The directory and the limit can be set with the environment variables
+MRI_NOISE_CACHE_DIR and MRI_NOISE_CACHE_MAX_MB, or with `configure_cache`.
+"""
+
+import dataclasses
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+@dataclasses.dataclass
+class CacheSettings:
+    directory: Path = Path(os.environ.get("MRI_NOISE_CACHE_DIR", ".mri_noise_cache"))
+    max_bytes: int = int(float(os.environ.get("MRI_NOISE_CACHE_MAX_MB", 2048)) * 2**20)
+    enabled: bool = True
+
+
+SETTINGS = CacheSettings()
+
+
+def configure_cache(directory=None, max_mb=None, enabled=None):
+    if directory is not None:
+        SETTINGS.directory = Path(directory)
+    if max_mb is not None:
+        SETTINGS.max_bytes = int(max_mb * 2**20)
+    if enabled is not None:
+        SETTINGS.enabled = enabled
+
+
+def fingerprint(obj) -> str:
+    """Hash of the source code of a function or module, falling back to the
+    compiled bytecode when the source is not available."""
+    try:
+        source = inspect.getsource(obj).encode()
+    except (OSError, TypeError):
+        code = getattr(obj, "__code__", None)
+        source = code.co_code if code is not None else repr(obj).encode()
+    return hashlib.sha256(source).hexdigest()
+
+
+def cache_key(params: dict, dependencies=()) -> str:
+    m = hashlib.sha256()
+    m.update(f"v{CACHE_VERSION}".encode())
+    m.update(json.dumps(params, sort_keys=True, default=repr).encode())
+    for dependency in dependencies:
+        m.update(fingerprint(dependency).encode())
+    return m.hexdigest()
+
+
+def load_entry(key: str, settings: CacheSettings = SETTINGS):
+    path = settings.directory / f"{key}.npy"
+    try:
+        array = np.load(path, mmap_mode="r")
+    except (FileNotFoundError, ValueError, EOFError):
+        return None
+    os.utime(path)  # Mark as recently used.
+    return array
+
+
+def save_entry(key: str, array: np.ndarray, settings: CacheSettings = SETTINGS):
+    settings.directory.mkdir(parents=True, exist_ok=True)
+    path = settings.directory / f"{key}.npy"
+    with tempfile.NamedTemporaryFile(
+        dir=settings.directory, prefix=f".{key}.", suffix=".tmp", delete=False
+    ) as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+    evict(settings, keep=path)
+
+
+def evict(settings: CacheSettings = SETTINGS, keep=None):
+    entries = sorted(settings.directory.glob("*.npy"), key=lambda p: p.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= settings.max_bytes:
+            break
+        if entry == keep:
+            continue
+        size = entry.stat().st_size
+        try:
+            entry.unlink()
+        except FileNotFoundError:
+            continue
+        total -= size
+
+
+def cached(compute, params: dict, dependencies=(), settings: CacheSettings = SETTINGS):
+    """Return the cached result of compute() for the given parameters and
+    dependencies, computing and storing it if it is not in the cache."""
+    if not settings.enabled:
+        return compute()
+    key = cache_key(params, dependencies)
+    array = load_entry(key, settings)
+    if array is not None:
+        print(f"Loaded cached values ({key[:12]}).")
+        return array
+    print("Cache entry not found. Computing values...")
+    array = compute()
+    save_entry(key, np.asarray(array), settings)
+    print(f"Computed and cached values ({key[:12]}).")
+    return array
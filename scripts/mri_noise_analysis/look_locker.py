@@ -1,5 +1,5 @@
 import warnings
-from functools import wraps
+from functools import lru_cache, wraps
 from time import time
 
 import numpy as np
@@ -19,6 +19,7 @@ def time_this_function(f):
 
 
 X3_CANDIDATES = [np.sqrt(1 / T1) for T1 in [1.0, 2.0, 3.0, 4.0, 0.5]]
+X_BOUNDS = [(0, 5), (0, 5), (0, 3)]
 
 
 def curve_fit_kernel(f, t, data, minimizer, **kwargs):
@@ -54,10 +55,355 @@ def curve_fit_wrapper(f, t, y, p0):
 
         if found_solution is False:
             popt, _ = curve_fit_kernel(
-                f, t=t, data=y, minimizer=direct, bounds=[(0, 5), (0, 5), (0, 3)]
+                f, t=t, data=y, minimizer=direct, bounds=X_BOUNDS
             )
 
         # scale back
         popt[0] *= ymax
 
     return popt
+
+
+def _residuals(f, t, Y, P):
+    return f(t[None, :], *(p[:, None] for p in P.T)) - Y
+
+
+def _jacobian(f, t, Y, P, r):
+    # Forward differences with the same step as MINPACK's fdjac2.
+    eps = np.sqrt(np.finfo(float).eps)
+    J = np.empty(r.shape + (P.shape[1],))
+    for j in range(P.shape[1]):
+        h = eps * np.abs(P[:, j])
+        h[h == 0.0] = eps
+        P_h = P.copy()
+        P_h[:, j] += h
+        J[:, :, j] = (_residuals(f, t, Y, P_h) - r) / h[:, None]
+    return J
+
+
+def _lm_parameter(lam, V, g, delta, par):
+    """Vectorized version of MINPACK's lmpar in the eigenbasis of the scaled
+    normal equations. Returns the scaled step z = D p and the LM parameter."""
+    dwarf = np.finfo(float).tiny
+    threshold = np.finfo(float).eps * lam[:, -1:] * lam.shape[1]
+    lam_safe = np.where(lam > threshold, lam, np.inf)
+
+    rank_deficient = lam[:, 0] <= threshold[:, 0]
+
+    def step(alpha):
+        denom = lam_safe + alpha[:, None]
+        w = -g / denom
+        znorm = np.linalg.norm(w, axis=1)
+        dnorm = np.sum(g**2 / denom**3, axis=1)
+        return w, znorm, dnorm
+
+    w, znorm, dnorm = step(np.zeros_like(delta))
+    fp = znorm - delta
+    done = fp <= 0.1 * delta
+    par = np.where(done, 0.0, par)
+
+    parl = fp / delta * znorm**2 / np.where(dnorm == 0.0, 1.0, dnorm)
+    parl = np.where(rank_deficient | (dnorm == 0.0), 0.0, np.maximum(parl, 0.0))
+    gnorm = np.linalg.norm(g, axis=1)
+    paru = gnorm / delta
+    paru = np.where(paru == 0.0, dwarf / np.minimum(delta, 0.1), paru)
+    par = np.where(done, par, np.minimum(np.maximum(par, parl), paru))
+    par = np.where(~done & (par == 0.0), gnorm / np.where(znorm == 0.0, 1.0, znorm), par)
+
+    for _ in range(10):
+        if np.all(done):
+            break
+        par = np.where(~done & (par == 0.0), np.maximum(dwarf, 0.001 * paru), par)
+        w_par, znorm_par, dnorm_par = step(par)
+        w = np.where(done[:, None], w, w_par)
+        temp = fp
+        fp = np.where(done, fp, znorm_par - delta)
+        done |= (np.abs(fp) <= 0.1 * delta) | ((parl == 0.0) & (fp <= temp) & (temp < 0.0))
+        parc = fp / delta * znorm_par**2 / np.where(dnorm_par == 0.0, 1.0, dnorm_par)
+        parl = np.where(~done & (fp > 0.0), np.maximum(parl, par), parl)
+        paru = np.where(~done & (fp < 0.0), np.minimum(paru, par), paru)
+        par = np.where(done, par, np.maximum(parl, par + parc))
+
+    return np.einsum("nij,nj->ni", V, w), par
+
+
+def levenberg_marquardt_batch(
+    f, t, Y, P0, ftol=1.49012e-8, xtol=1.49012e-8, factor=100.0
+):
+    """Least-squares fit of f(t, *p) to every row of Y simultaneously.
+
+    Follows the trust-region strategy of MINPACK's lmdif, which is what
+    `scipy.optimize.curve_fit` uses for unbounded problems, including its
+    function evaluation budget and convergence tests. Returns the fitted
+    parameters (N, P), the residuals at the solution and a boolean array marking
+    the rows that converged."""
+    epsmch = np.finfo(float).eps
+    P = np.array(P0, dtype=float)
+    n_curves, n_params = P.shape
+    maxfev = 200 * (n_params + 1)
+
+    r = _residuals(f, t, Y, P)
+    fnorm = np.linalg.norm(r, axis=1)
+    nfev = np.ones(n_curves, dtype=int)
+    diag = np.zeros((n_curves, n_params))
+    delta = np.zeros(n_curves)
+    xnorm = np.zeros(n_curves)
+    par = np.zeros(n_curves)
+    first = np.ones(n_curves, dtype=bool)
+    need_jacobian = np.ones(n_curves, dtype=bool)
+    J = np.zeros(r.shape + (n_params,))
+    info = np.zeros(n_curves, dtype=int)
+    info[~np.isfinite(fnorm)] = 5
+
+    active = np.flatnonzero(info == 0)
+    while active.size > 0:
+        update = active[need_jacobian[active]]
+        if update.size > 0:
+            J[update] = _jacobian(f, t, Y[update], P[update], r[update])
+            nfev[update] += n_params
+            acnorm = np.linalg.norm(J[update], axis=1)
+            init = first[update]
+            fresh = update[init]
+            diag[fresh] = np.where(acnorm[init] == 0.0, 1.0, acnorm[init])
+            xnorm[fresh] = np.linalg.norm(diag[fresh] * P[fresh], axis=1)
+            delta[fresh] = np.where(xnorm[fresh] == 0.0, factor, factor * xnorm[fresh])
+            diag[update] = np.maximum(diag[update], acnorm)
+            need_jacobian[update] = False
+
+        J_a, r_a, D = J[active], r[active], diag[active]
+        B = np.einsum("nmi,nmj->nij", J_a, J_a) / (D[:, :, None] * D[:, None, :])
+        lam, V = np.linalg.eigh(B)
+        g = np.einsum("nji,nj->ni", V, np.einsum("nmi,nm->ni", J_a, r_a) / D)
+        step_scaled, par[active] = _lm_parameter(lam, V, g, delta[active], par[active])
+        step = step_scaled / D
+        pnorm = np.linalg.norm(step_scaled, axis=1)
+        delta[active] = np.where(first[active], np.minimum(delta[active], pnorm), delta[active])
+
+        P_trial = P[active] + step
+        r_trial = _residuals(f, t, Y[active], P_trial)
+        nfev[active] += 1
+        fnorm_old = fnorm[active]
+        fnorm1 = np.linalg.norm(r_trial, axis=1)
+        fnorm1 = np.where(np.isfinite(fnorm1), fnorm1, np.inf)
+        actred = np.where(0.1 * fnorm1 < fnorm_old, 1.0 - (fnorm1 / fnorm_old) ** 2, -1.0)
+        temp1 = np.linalg.norm(np.einsum("nmi,ni->nm", J_a, step), axis=1) / fnorm_old
+        temp2 = np.sqrt(par[active]) * pnorm / fnorm_old
+        prered = temp1**2 + temp2**2 / 0.5
+        dirder = -(temp1**2 + temp2**2)
+        ratio = np.where(prered != 0.0, actred / np.where(prered != 0.0, prered, 1.0), 0.0)
+
+        shrink = ratio <= 0.25
+        scale = np.where(actred >= 0.0, 0.5, 0.5 * dirder / (dirder + 0.5 * actred))
+        scale = np.where((0.1 * fnorm1 >= fnorm_old) | (scale < 0.1), 0.1, scale)
+        grow = ~shrink & ((par[active] == 0.0) | (ratio >= 0.75))
+        delta[active] = np.where(
+            shrink,
+            scale * np.minimum(delta[active], pnorm / 0.1),
+            np.where(grow, pnorm / 0.5, delta[active]),
+        )
+        par[active] = np.where(
+            shrink, par[active] / scale, np.where(grow, 0.5 * par[active], par[active])
+        )
+
+        success = ratio >= 1e-4
+        accepted = active[success]
+        P[accepted] = P_trial[success]
+        r[accepted] = r_trial[success]
+        fnorm[accepted] = fnorm1[success]
+        xnorm[accepted] = np.linalg.norm(diag[accepted] * P[accepted], axis=1)
+        first[accepted] = False
+        need_jacobian[accepted] = True
+
+        converged_f = (np.abs(actred) <= ftol) & (prered <= ftol) & (0.5 * ratio <= 1.0)
+        converged_x = delta[active] <= xtol * xnorm[active]
+        status = np.where(converged_f, 1, 0) + np.where(converged_x, 2, 0)
+        status = np.where(status == 0, np.where(nfev[active] >= maxfev, 5, 0), status)
+        stagnated = (
+            ((np.abs(actred) <= epsmch) & (prered <= epsmch) & (0.5 * ratio <= 1.0))
+            | (delta[active] <= epsmch * xnorm[active])
+            | ~np.isfinite(delta[active])
+        )
+        status = np.where((status == 0) & stagnated, 6, status)
+        info[active] = status
+        active = active[status == 0]
+
+    return P, r, (info >= 1) & (info <= 4)
+
+
+@lru_cache(maxsize=8)
+def _dictionary(f, t, x2_grid, x3_grid):
+    x2, x3 = (x.ravel() for x in np.meshgrid(x2_grid, x3_grid, indexing="ij"))
+    with np.errstate(all="ignore"):
+        D = f(np.array(t)[None, :], np.ones_like(x2)[:, None], x2[:, None], x3[:, None])
+    norms = np.linalg.norm(D, axis=1)
+    # Drop degenerate curves (all zero for x2 = x3 = 0), which would match as NaN.
+    keep = np.isfinite(norms) & (norms > 0)
+    return D[keep] / norms[keep, None], norms[keep], x2[keep], x3[keep]
+
+
+def _grid_dictionary(f, t, n_T1, n_x2):
+    T1_grid = np.geomspace(0.05, 20.0, n_T1)
+    x3_grid = np.sqrt(1.0 / T1_grid)
+    return _dictionary(f, t, tuple(np.linspace(0.0, 3.0, n_x2)), tuple(x3_grid))
+
+
+def _box_dictionary(f, t, n_x2, n_x3):
+    (x2_low, x2_high), (x3_low, x3_high) = X_BOUNDS[1], X_BOUNDS[2]
+    return _dictionary(
+        f, t, tuple(np.linspace(x2_low, x2_high, n_x2)), tuple(np.linspace(x3_low, x3_high, n_x3))
+    )
+
+
+def _match(dictionary, Y, chunk_size, n_best=1):
+    """Parameters (n_best, N, 3) of the n_best dictionary curves that correlate best
+    with each row of Y, best first, with the amplitude solved in closed form."""
+    D, norms, x2, x3 = dictionary
+    p0 = np.empty((n_best, len(Y), 3))
+    for start in range(0, len(Y), chunk_size):
+        Y_chunk = Y[start : start + chunk_size]
+        correlation = Y_chunk @ D.T
+        if n_best == 1:
+            best = np.argmax(correlation, axis=1)[:, None]
+        else:
+            best = np.argpartition(-correlation, n_best - 1, axis=1)[:, :n_best]
+            order = np.argsort(-np.take_along_axis(correlation, best, axis=1), axis=1)
+            best = np.take_along_axis(best, order, axis=1)
+        # Least-squares amplitude for the matched unit-amplitude model curve.
+        x1 = np.take_along_axis(correlation, best, axis=1) / norms[best]
+        p0[:, start : start + chunk_size] = np.stack([x1, x2[best], x3[best]], axis=-1).transpose(1, 0, 2)
+    return p0
+
+
+def grid_initial_guess(f, t, Y, n_T1=400, n_x2=61, chunk_size=256):
+    """Initial guesses (N, 3) for fitting f to the rows of Y, found by matching each
+    normalized curve against a dictionary of model curves over a (T1, x2) grid,
+    where T1 = 1 / x3**2 as in X3_CANDIDATES. The dictionary is cached per model
+    and time vector, so repeated calls with the same trigger times reuse it."""
+    t = tuple(np.asarray(t, dtype=float))
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    return _match(_grid_dictionary(f, t, n_T1, n_x2), Y, chunk_size)[0]
+
+
+def global_fit(f, t, Y, n_best=4, n_x2=101, n_x3=151, chunk_size=256):
+    """Batched replacement of the `direct` fallback over X_BOUNDS: every row of Y is
+    matched against a dictionary of model curves over the (x2, x3) box, with the
+    amplitude x1 solved in closed form and clipped to its bounds. The n_best matches
+    are refined with Levenberg-Marquardt, since neighbouring matches may lie in
+    different local minima of the absolute-value model. Returns the parameters and
+    residual norms of the best refined fit, or of the best match where no
+    refinement converges to a smaller residual."""
+    t = np.asarray(t, dtype=float)
+    P0 = _match(_box_dictionary(f, tuple(t), n_x2, n_x3), Y, chunk_size, n_best)
+    P0[..., 0] = np.clip(P0[..., 0], *X_BOUNDS[0])
+    with np.errstate(all="ignore"):
+        norms0 = np.linalg.norm(_residuals(f, t, Y, P0[0]), axis=1)
+    P, norms, converged = _fit_from_starting_points(f, t, Y, P0)
+    norms = np.where(converged, norms, np.inf)
+    best = np.argmin(norms, axis=0)
+    P, norms = P[best, np.arange(len(Y))], norms[best, np.arange(len(Y))]
+    better = norms <= norms0
+    return np.where(better[:, None], P, P0[0]), np.where(better, norms, norms0)
+
+
+def _fit_from_starting_points(f, t, Y, P0):
+    """Fits every row of Y from each of the (K, N, 3) starting points in P0. Returns
+    the fitted parameters, the residual norms and the convergence flags, all of
+    shape (K, N, ...)."""
+    n_starts, n_curves, n_params = P0.shape
+    with np.errstate(all="ignore"):
+        P, residuals, converged = levenberg_marquardt_batch(
+            f, t, np.tile(Y, (n_starts, 1)), P0.reshape(-1, n_params)
+        )
+    norms = np.linalg.norm(residuals, axis=1)
+    return (
+        P.reshape(n_starts, n_curves, n_params),
+        norms.reshape(n_starts, n_curves),
+        converged.reshape(n_starts, n_curves),
+    )
+
+
+def curve_fit_batch(f, t, Y, initial_guess="candidates", fallback="direct"):
+    """Vectorized counterpart of `curve_fit_wrapper` for an (N, len(t)) array of
+    signal curves. f must broadcast over arrays of parameters.
+
+    All starting points in X3_CANDIDATES are fitted for all curves at once, and the
+    first candidate (in the same order as `curve_fit_wrapper`) with a residual norm
+    below 0.1 is kept. Curves without an acceptable candidate go to the fallback:
+
+    - "direct" (default): the same `direct` search as `curve_fit_wrapper`, one curve
+      at a time. This is by far the slowest step; at SNR 25 about 60% of the curves
+      fail the residual check because of the noise alone.
+    - "global": `global_fit` on all of them at once, keeping whichever of its result
+      and the converged candidate fits has the smallest residual.
+    - None: the curves are left as NaN.
+
+    Tolerance: with the defaults, the T1 estimates (x2**2 / x3**2 up to model
+    constants) agree with `curve_fit_wrapper` to a relative tolerance of 1e-4 for
+    more than 99% of the curves at SNR 25. The remaining curves sit in the flat
+    valley x2 ~ 0, where `curve_fit` sometimes rejects the minimum because the
+    covariance is singular and falls through to a different candidate. Only |x2|
+    and |x3| are comparable, since the model depends on their squares. Curves with
+    non-finite or all-zero samples return NaN.
+
+    fallback="global" is several times faster, but does not reproduce
+    `curve_fit_wrapper`: `direct` stops after a few thousand function evaluations
+    short of the minimum, and the global fit continues to it. At SNR 25 about a
+    third of the curves get a different fit, with T1 differing by up to about 60%.
+    On synthetic curves at SNR 10, 25 and 50 no curve had a larger residual than
+    with `direct`.
+
+    With initial_guess="grid", every curve is first refined once from the
+    `grid_initial_guess` seed. Only curves where that fit does not converge go
+    through X3_CANDIDATES; converged fits rejected by the residual check go
+    straight to the fallback. This may land in a different (equally acceptable)
+    local minimum than `curve_fit_wrapper`, so the tolerance above does not apply."""
+    if initial_guess not in ("candidates", "grid"):
+        raise ValueError(f"Unknown initial_guess '{initial_guess}'")
+    if fallback not in ("global", "direct", None):
+        raise ValueError(f"Unknown fallback '{fallback}'")
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    with np.errstate(all="ignore"):
+        ymax = np.max(Y, axis=1)
+        Y = Y / ymax[:, None]
+    valid = np.all(np.isfinite(Y), axis=1)
+    popt = np.full((len(Y), 3), np.nan)
+    unfitted = valid.copy()
+    # Best converged fit rejected by the residual check, for the global fallback.
+    rejected = np.full((len(Y), 3), np.nan)
+    rejected_norm = np.full(len(Y), np.inf)
+
+    def record(idx, P, norms, converged):
+        success = converged & (norms < 0.1)
+        found = np.any(success, axis=0)
+        popt[idx[found]] = P[np.argmax(success, axis=0), np.arange(len(idx))][found]
+        unfitted[idx[found]] = False
+        norms = np.where(converged, norms, np.inf)
+        best = np.argmin(norms, axis=0)
+        best_norm = norms[best, np.arange(len(idx))]
+        better = best_norm < rejected_norm[idx]
+        rejected[idx[better]] = P[best, np.arange(len(idx))][better]
+        rejected_norm[idx[better]] = best_norm[better]
+
+    candidates = unfitted.copy()
+    if initial_guess == "grid":
+        idx = np.flatnonzero(unfitted)
+        P, norms, converged = _fit_from_starting_points(
+            f, t, Y[idx], grid_initial_guess(f, t, Y[idx])[None]
+        )
+        record(idx, P, norms, converged)
+        candidates[idx[converged[0]]] = False
+
+    idx = np.flatnonzero(unfitted & candidates)
+    P0 = np.array([[[1.0, 2.0, x3]] for x3 in X3_CANDIDATES])
+    record(idx, *_fit_from_starting_points(f, t, Y[idx], np.broadcast_to(P0, (len(P0), len(idx), 3))))
+
+    if fallback == "global":
+        idx = np.flatnonzero(unfitted)
+        P, norms = global_fit(f, t, Y[idx])
+        use_rejected = rejected_norm[idx] < norms
+        popt[idx] = np.where(use_rejected[:, None], rejected[idx], P)
+    elif fallback == "direct":
+        for idx in np.flatnonzero(unfitted):
+            popt[idx], _ = curve_fit_kernel(f, t=t, data=Y[idx], minimizer=direct, bounds=X_BOUNDS)
+    popt[:, 0] *= ymax
+    return popt
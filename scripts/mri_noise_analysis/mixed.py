@@ -1,25 +1,28 @@
+from functools import lru_cache
+
 import numpy as np
-import scipy.interpolate
 
 # Metadata for the Mixed sequence
 metadata = {"TR_ir": 8350.0, "TR_se": 11000.0, "TI": 2650.0, "TE": 700.0}
 
 
-def compute_se_signal(T1, SNR=20):
+def compute_se_signal(T1, SNR=20, rng=None):
+    rng = np.random if rng is None else rng
     M0 = 1  # will cancel out
     TR = metadata["TR_se"] - 2 * metadata["TE"]
     se = M0 * (1.0 - np.exp(-TR / T1))
     max_se = np.max(se)
-    return se + np.random.rayleigh(max_se / SNR, se.shape)
+    return se + rng.rayleigh(max_se / SNR, se.shape)
 
 
-def compute_ir_signal(T1, SNR=20):
-    se = compute_se_signal(T1)
+def compute_ir_signal(T1, SNR=20, rng=None):
+    rng = np.random if rng is None else rng
+    se = compute_se_signal(T1, rng=rng)
     M0 = 1  # will cancel out
     TI = metadata["TI"]
     ir = M0 - (M0 + se) * np.exp(-TI / T1)
     max_ir = np.max(ir)
-    return ir + np.random.normal(0, max_ir / SNR, ir.shape)
+    return ir + rng.normal(0, max_ir / SNR, ir.shape)
 
 
 def T1_lookup_table(TRse, TI, TE, T1_low, T1_hi):
@@ -32,16 +35,72 @@ def T1_lookup_table(TRse, TI, TE, T1_low, T1_hi):
     return fractionCurve, T1_grid
 
 
-def extract_mixed_t1(IR: np.ndarray, SE: np.ndarray, lookup_table) -> np.ndarray:
-    F, T1_grid = lookup_table
-    F_data = IR / SE
-    interpolator = scipy.interpolate.interp1d(
-        F, T1_grid, kind="nearest", bounds_error=False, fill_value=np.nan
-    )
-    T1_volume = interpolator(F_data)
-    return T1_volume
+class T1LookupInverter:
+    """Maps IR/SE ratios back to T1 through a precomputed lookup table.
+
+    The ratio curve must be monotone in T1. Ratios are located in the sorted table
+    with `np.searchsorted`, either picking the nearest table entry (as the former
+    `interp1d(kind="nearest")` lookup) or interpolating linearly between the
+    neighbouring entries. Ratios outside the table, and NaN ratios, map to NaN.
+    Where several T1 values share the same ratio (F == 1 for very short T1), the
+    largest of them is used."""
+
+    def __init__(self, fraction_curve, T1_grid):
+        F = np.asarray(fraction_curve, dtype=float)
+        T1 = np.asarray(T1_grid, dtype=float)
+        dF = np.diff(F[np.argsort(T1)])
+        if not (np.all(dF <= 0) or np.all(dF >= 0)):
+            raise ValueError("The IR/SE ratio is not monotone in T1 over the table range.")
+
+        order = np.lexsort((T1, F))
+        F, T1 = F[order], T1[order]
+        last_of_ties = np.append(np.diff(F) > 0, True)
+        self.F = F[last_of_ties]
+        self.T1 = T1[last_of_ties]
+        self.bounds = 0.5 * (self.F[1:] + self.F[:-1])
+
+    def lookup(self, F_data, interpolate=False):
+        F_data = np.asarray(F_data, dtype=float)
+        if interpolate:
+            idx = np.searchsorted(self.F, F_data, side="right") - 1
+            idx = np.clip(idx, 0, len(self.F) - 2)
+            weight = (F_data - self.F[idx]) / (self.F[idx + 1] - self.F[idx])
+            T1 = self.T1[idx] + weight * (self.T1[idx + 1] - self.T1[idx])
+        else:
+            T1 = self.T1[np.searchsorted(self.bounds, F_data, side="left")]
+        outside = ~((F_data >= self.F[0]) & (F_data <= self.F[-1]))
+        T1[outside] = np.nan
+        return T1
+
+    def __call__(self, IR, SE, interpolate=False, chunk_size=2**20):
+        """T1 for the IR and SE signals, processed in flat chunks of at most
+        chunk_size voxels to bound the size of the temporaries."""
+        IR, SE = np.broadcast_arrays(np.asarray(IR), np.asarray(SE))
+        T1_volume = np.empty(IR.shape, dtype=float)
+        IR_flat, SE_flat, out = IR.reshape(-1), SE.reshape(-1), T1_volume.reshape(-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for start in range(0, out.size, chunk_size):
+                chunk = slice(start, start + chunk_size)
+                out[chunk] = self.lookup(IR_flat[chunk] / SE_flat[chunk], interpolate)
+        return T1_volume
+
+
+@lru_cache(maxsize=16)
+def mixed_t1_inverter(TRse, TI, TE, T1_low, T1_hi):
+    return T1LookupInverter(*T1_lookup_table(TRse, TI, TE, T1_low, T1_hi))
+
+
+def extract_mixed_t1(
+    IR: np.ndarray, SE: np.ndarray, lookup_table, interpolate=False
+) -> np.ndarray:
+    if not isinstance(lookup_table, T1LookupInverter):
+        lookup_table = T1LookupInverter(*lookup_table)
+    return lookup_table(IR, SE, interpolate=interpolate)
 
 
 LOOKUP_TABLE = T1_lookup_table(
     metadata["TR_se"], metadata["TI"], metadata["TE"], 1, 10000
 )
+LOOKUP_INVERTER = mixed_t1_inverter(
+    metadata["TR_se"], metadata["TI"], metadata["TE"], 1, 10000
+)
@@ -5,6 +5,7 @@ for the Look Locker and Mixed sequences with a given SNR
 
 import matplotlib.pyplot as plt
 import click
+from cache import configure_cache
 from plot_noise_look_locker import plot_estimated_versus_actual as plot_look_locker
 from plot_noise_mixed import plot_estimated_versus_actual as plot_mixed
 
@@ -12,7 +13,10 @@ from plot_noise_mixed import plot_estimated_versus_actual as plot_mixed
 @click.option("--snr", default=25, help="Signal to noise ratio")
 @click.option("--samples", default=200, help="Number of samples")
 @click.option("--sequence_duration", default=2.6, help="Sequence duration in seconds")
-def main(snr, samples, sequence_duration=2.6):
+@click.option("--cache_dir", default=None, help="Directory for cached simulation results")
+@click.option("--no_cache", is_flag=True, help="Recompute without reading or writing the cache")
+def main(snr, samples, sequence_duration=2.6, cache_dir=None, no_cache=False):
+    configure_cache(directory=cache_dir, enabled=not no_cache)
     superfig = plt.figure(constrained_layout=True, figsize=(8, 5))
     figs = superfig.subfigures(nrows=2, ncols=1)
 
@@ -6,43 +6,40 @@ for the Look Locker sequence with a given SNR
 import matplotlib.pyplot as plt
 import numpy as np
 import click
-from pathlib import Path
-import hashlib
 
-from look_locker import curve_fit_wrapper, OptimizeWarning
+import common
+import look_locker
+from cache import cached, configure_cache
+from look_locker import curve_fit_batch
 from common import compute_T1, compute_c
-import multiprocessing as mp
+from scheduler import chunk_generators, chunk_slices, run_chunks
 
 
 def f(t, x1, x2, x3):
     return np.abs(x1 * (1.0 - (1.1 + x2**2) * np.exp(-(x3**2) * t)))
 
 
-def curve_fit_(x3, sequence_duration, snr, f, x1, x2, seed, repeats):
-    np.random.seed(seed=seed)
+def compute_T1_from_x23(x2, x3):
+    return (0.1 + x2**2) / (x3**2)
 
+
+def curve_fit_chunk(x3, sequence_duration, snr, f, x1, x2, rng, initial_guess="candidates"):
+    """Fit one noisy curve for each of the given x3 values, with noise drawn
+    from rng, which is the chunk's own generator."""
     number_images_per_sequence = 14
     t = np.linspace(0, sequence_duration, number_images_per_sequence)
 
-    popt = np.zeros((repeats, 3))
-    for j in range(repeats):
-
-        y = f(t, x1, x2, x3)
-        max_val = np.max(y)
-        re, im = (
-            np.random.normal(0, max_val / snr, len(y)),
-            np.random.normal(0, max_val / snr, len(y)),
-        )
-        y = y + np.sqrt(re**2 + im**2)
-        try:
-            popt[j] = curve_fit_wrapper(f, t, y, (1.0, np.sqrt(0.9), 1.0))
-        except (OptimizeWarning, RuntimeError):
-            popt[j] = np.nan * np.zeros(3)
+    y = f(t[None, :], x1, x2, x3[:, None])
+    max_val = np.max(y, axis=1, keepdims=True)
+    re, im = (
+        rng.normal(0, max_val / snr, y.shape),
+        rng.normal(0, max_val / snr, y.shape),
+    )
+    Y = y + np.sqrt(re**2 + im**2)
+    return curve_fit_batch(f, t, Y, initial_guess=initial_guess)
 
-    return popt
 
-
-def generate_look_locker_data(snr, samples, sequence_duration):
+def generate_look_locker_data(snr, samples, sequence_duration, workers=None, initial_guess="candidates"):
 
     repeats = 50
     c_min, c_max = 0.005, 0.3
@@ -55,29 +52,27 @@ def generate_look_locker_data(snr, samples, sequence_duration):
     x2 = np.sqrt(0.5)  # todo: what to choose here? not uniquely defined by T1
     x3 = np.sqrt((0.1 + x2**2) / T1_values)
 
-    # repeat repeats times for each T1 value (noise randomly sampled)
-    # check if the values are cached in a file, if yes load from cache, if not compute and store in cache
-    m = hashlib.sha256()
-    m.update(f"{snr}_{samples}_{sequence_duration}_{c_min}_{c_max}_{repeats}".encode())
-    sha = m.hexdigest()
-    cache_file = Path(f'looklockercache_{sha}.npy')
-    try:
-        popt = np.load(cache_file)
-        print("Loaded cached popt values.")
-    except FileNotFoundError:
-        print("Cache file not found. Computing popt values...")
-        popt = np.zeros((len(T1_values), repeats, 3))
-        with mp.Pool(mp.cpu_count()) as pool:
-            results = pool.starmap(curve_fit_, [(x3_, sequence_duration, snr, f, x1, x2, i, repeats) for i, x3_ in enumerate(x3)])
-        for i, result in enumerate(results):
-            popt[i] = result
-        np.save(cache_file, popt)
-        print("Computed and cached popt values.")
+    # repeat repeats times for each T1 value (noise randomly sampled), split into
+    # fixed-size chunks of (concentration, repeat) pairs with their own generators.
+    seed, chunk_size = 0, 256
+    def compute_popt():
+        x3_pairs = np.repeat(x3, repeats)
+        chunks = chunk_slices(len(x3_pairs), chunk_size)
+        tasks = [
+            (x3_pairs[chunk], sequence_duration, snr, f, x1, x2, rng, initial_guess)
+            for chunk, rng in zip(chunks, chunk_generators(seed, len(chunks)))
+        ]
+        popt = np.concatenate(list(run_chunks(curve_fit_chunk, tasks, workers=workers)))
+        return popt.reshape(len(T1_values), repeats, 3)
+
+    params = {
+        "sequence": "looklocker", "snr": snr, "samples": samples, "sequence_duration": sequence_duration,
+        "c_min": c_min, "c_max": c_max, "repeats": repeats, "x1": x1, "x2": x2,
+        "seed": seed, "chunk_size": chunk_size, "initial_guess": initial_guess,
+    }
+    popt = cached(compute_popt, params, dependencies=(f, curve_fit_chunk, look_locker, common))
 
     # calculate the mean and standard deviation of the estimated T1 values
-    def compute_T1_from_x23(x2, x3):
-        return (0.1 + x2**2) / (x3**2)
-
     T1_est = compute_T1_from_x23(x2=popt[:, :, 1], x3=popt[:, :, 2])
     c_est = compute_c(T1_est * 1000)
 
@@ -88,9 +83,9 @@ def generate_look_locker_data(snr, samples, sequence_duration):
 
 
 
-def plot_estimated_versus_actual(snr, samples, sequence_duration, ax_c=None, ax_t1=None):
+def plot_estimated_versus_actual(snr, samples, sequence_duration, ax_c=None, ax_t1=None, workers=None, initial_guess="candidates"):
 
-    c, c_est, T1, T1_est, c_values, T1_values, T1_threshold, c_threshold = generate_look_locker_data(snr, samples, sequence_duration)
+    c, c_est, T1, T1_est, c_values, T1_values, T1_threshold, c_threshold = generate_look_locker_data(snr, samples, sequence_duration, workers=workers, initial_guess=initial_guess)
 
     fontsize = 12
     if ax_c is not None:
@@ -135,9 +130,14 @@ def plot_estimated_versus_actual(snr, samples, sequence_duration, ax_c=None, ax_
 @click.option("--snr", default=25, help="Signal to noise ratio")
 @click.option("--samples", default=200, help="Number of samples")
 @click.option("--sequence_duration", default=2.6, help="Sequence duration in seconds")
-def main(snr, samples, sequence_duration=2.6):
+@click.option("--workers", default=None, type=int, help="Number of worker processes (default: all CPUs)")
+@click.option("--initial_guess", type=click.Choice(["candidates", "grid"]), default="candidates", help="Starting points of the curve fits; grid may change the published results")
+@click.option("--cache_dir", default=None, help="Directory for cached simulation results")
+@click.option("--no_cache", is_flag=True, help="Recompute without reading or writing the cache")
+def main(snr, samples, sequence_duration=2.6, workers=None, initial_guess="candidates", cache_dir=None, no_cache=False):
+    configure_cache(directory=cache_dir, enabled=not no_cache)
     fig, ax = plt.subplots(1, 2, figsize=(8, 3))
-    plot_estimated_versus_actual(ax_c=ax[0], ax_t1=ax[1], snr=snr, samples=samples, sequence_duration=sequence_duration)
+    plot_estimated_versus_actual(ax_c=ax[0], ax_t1=ax[1], snr=snr, samples=samples, sequence_duration=sequence_duration, workers=workers, initial_guess=initial_guess)
     fig.suptitle("concentration and T1 from Look-Locker sequence")
     fig.tight_layout()
     plt.show()
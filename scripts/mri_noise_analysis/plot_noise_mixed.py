@@ -7,27 +7,38 @@ import matplotlib.pyplot as plt
 import numpy as np
 import click
 
+import common
+import mixed
+from cache import cached, configure_cache
 from common import compute_T1, compute_c
-from mixed import compute_ir_signal, compute_se_signal, LOOKUP_TABLE, extract_mixed_t1
+from mixed import compute_ir_signal, compute_se_signal, LOOKUP_INVERTER, extract_mixed_t1
 
 
-def generate_mixed_data(snr, samples):
+def simulate_mixed_t1(snr, T1):
     # reproducibility
     np.random.seed(0)
 
+    # generate noisy IR and SE signals
+    IR = compute_ir_signal(T1, SNR=snr)
+    SE = compute_se_signal(T1, SNR=snr)
+
+    # estimate the T1 values from the noisy signals
+    return extract_mixed_t1(IR=IR, SE=SE, lookup_table=LOOKUP_INVERTER)
+
+
+def generate_mixed_data(snr, samples):
     # test different concentrations for a given noise level
     repeats = 50
-    c_values = np.linspace(0.005, 0.3, samples)
+    c_min, c_max = 0.005, 0.3
+    c_values = np.linspace(c_min, c_max, samples)
     T1_values = compute_T1(c_values)
     c = np.vstack([c_values for _ in range(repeats)]).T
     T1 = compute_T1(c)
 
-    # generate noisy IR and SE signals
-    IR = compute_ir_signal(T1, SNR=snr)
-    SE = compute_se_signal(T1, SNR=snr)
-
-    # estimate the concentration and T1 values from the noisy signals
-    T1_est = extract_mixed_t1(IR=IR, SE=SE, lookup_table=LOOKUP_TABLE)
+    params = {"sequence": "mixed", "snr": snr, "samples": samples, "c_min": c_min, "c_max": c_max, "repeats": repeats}
+    T1_est = cached(
+        lambda: simulate_mixed_t1(snr, T1), params, dependencies=(simulate_mixed_t1, mixed, common)
+    )
     c_est = compute_c(T1_est)
 
     T1 = T1 / 1000
@@ -86,7 +97,10 @@ def plot_estimated_versus_actual(snr, samples, ax_c=None, ax_t1=None):
 @click.command()
 @click.option("--snr", default=25, help="Signal to noise ratio")
 @click.option("--samples", default=100, help="Number of samples")
-def main(snr, samples):
+@click.option("--cache_dir", default=None, help="Directory for cached simulation results")
+@click.option("--no_cache", is_flag=True, help="Recompute without reading or writing the cache")
+def main(snr, samples, cache_dir=None, no_cache=False):
+    configure_cache(directory=cache_dir, enabled=not no_cache)
     fig, ax = plt.subplots(1, 2, figsize=(8, 3))
     plot_estimated_versus_actual(ax_c=ax[0], ax_t1=ax[1], snr=snr, samples=samples)
     fig.suptitle("concentration and T1 from Mixed sequence")
@@ -0,0 +1,60 @@
+"""
+Deterministic parallel execution of the noise simulations.
+
+Work is split into fixed-size chunks, and every chunk gets its own random
+generator spawned from a single np.random.SeedSequence. Chunks are handed to
+the workers of a process pool one at a time as they become idle, and the results
+are returned in chunk order, so the output is bit-identical for any number of
+workers.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+
+
+def chunk_slices(n_items: int, chunk_size: int) -> list[slice]:
+    return [
+        slice(start, min(start + chunk_size, n_items))
+        for start in range(0, n_items, chunk_size)
+    ]
+
+
+def chunk_generators(seed, n_chunks: int) -> list[np.random.Generator]:
+    return [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n_chunks)]
+
+
+def resolve_workers(workers: Optional[int]) -> int:
+    if workers is None:
+        return os.cpu_count() or 1
+    return max(1, workers)
+
+
+def run_chunks(
+    func: Callable, tasks: Iterable[tuple], workers: Optional[int] = None
+) -> Iterator:
+    """Yield func(*task) for every task, in order. With more than one worker the
+    tasks run on a process pool where each idle worker picks up the next pending
+    task, which balances chunks of very different cost. At most a few tasks per
+    worker are in flight, so lazily generated tasks and their results never
+    need to be held in memory all at once."""
+    workers = resolve_workers(workers)
+    if workers == 1:
+        for task in tasks:
+            yield func(*task)
+        return
+
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque(
+            executor.submit(func, *task) for task in islice(tasks, 2 * workers)
+        )
+        while pending:
+            result = pending.popleft().result()
+            for task in islice(tasks, 1):
+                pending.append(executor.submit(func, *task))
+            yield result
@@ -0,0 +1,275 @@
+"""
+Streaming Monte Carlo sweeps of the concentration and T1 estimation errors
+over SNR, concentration, number of repeats and sequence duration.
+
+The repeats for each sweep point are simulated in chunks, and the error
+statistics printed by tabulate_noise_combined.py are accumulated online, so
+sweeps with 10^5-10^6 repeats per point run in bounded memory and a single pass.
+"""
+
+import dataclasses
+import itertools
+from typing import Iterator, Optional
+
+import click
+import numpy as np
+
+from common import compute_T1, compute_c
+from look_locker import curve_fit_batch
+from mixed import LOOKUP_INVERTER, compute_ir_signal, compute_se_signal, extract_mixed_t1
+from plot_noise_look_locker import compute_T1_from_x23, f
+from scheduler import chunk_slices, run_chunks
+from tabulate_noise_combined import (
+    C_BINS,
+    C_REFERENCE,
+    T1_BINS,
+    T1_REFERENCE,
+    print_statistics_table,
+)
+
+
+class RunningStats:
+    """Online statistics for n independent series of non-negative values.
+
+    Mean and standard deviation are merged chunk by chunk (Chan et al.), min and
+    max are exact, and percentiles come from a log-binned histogram sketch with
+    the given relative accuracy (as in DDSketch). Values below min_value count as
+    zero, and the histogram grows as needed for values above max_value. NaN and
+    infinite values are counted in nan_count and excluded from all statistics."""
+
+    def __init__(self, n, relative_accuracy=0.005, min_value=1e-9, max_value=1e3):
+        self.n = n
+        self.count = np.zeros(n, dtype=np.int64)
+        self.nan_count = np.zeros(n, dtype=np.int64)
+        self._mean = np.zeros(n)
+        self._m2 = np.zeros(n)
+        self._min = np.full(n, np.inf)
+        self._max = np.full(n, -np.inf)
+
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.min_value = min_value
+        self._offset = int(np.ceil(np.log(min_value) / np.log(self.gamma)))
+        # Bin 0 collects the values below min_value.
+        self._histogram = np.zeros((n, self._key(max_value) + 1), dtype=np.int64)
+
+    def _key(self, values):
+        """Histogram bin of values at or above min_value."""
+        return np.ceil(np.log(values) / np.log(self.gamma)).astype(np.int64) - self._offset + 1
+
+    def _grow(self, n_bins: int):
+        if n_bins > self._histogram.shape[1]:
+            self._histogram = np.pad(self._histogram, ((0, 0), (0, n_bins - self._histogram.shape[1])))
+
+    def update(self, values: np.ndarray):
+        """Add an (n, k) array of new values."""
+        values = np.asarray(values, dtype=float).reshape(self.n, -1)
+        finite = np.isfinite(values)
+        if np.any(values[finite] < 0):
+            raise ValueError("RunningStats only supports non-negative values.")
+        self.nan_count += np.sum(~finite, axis=1)
+
+        count_b = np.sum(finite, axis=1)
+        masked = np.where(finite, values, 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_b = np.where(count_b > 0, np.sum(masked, axis=1) / count_b, 0.0)
+        m2_b = np.sum(np.where(finite, (values - mean_b[:, None]) ** 2, 0.0), axis=1)
+
+        count = self.count + count_b
+        delta = mean_b - self._mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(count > 0, count_b / count, 0.0)
+        self._m2 += m2_b + delta**2 * self.count * weight
+        self._mean += delta * weight
+        self.count = count
+
+        self._min = np.minimum(self._min, np.min(np.where(finite, values, np.inf), axis=1))
+        self._max = np.maximum(self._max, np.max(np.where(finite, values, -np.inf), axis=1))
+
+        rows = np.broadcast_to(np.arange(self.n)[:, None], values.shape)[finite]
+        bins = self._bin_index(values[finite])
+        if bins.size > 0:
+            self._grow(int(bins.max()) + 1)
+        self._histogram += np.bincount(
+            rows * self._histogram.shape[1] + bins, minlength=self._histogram.size
+        ).reshape(self._histogram.shape)
+
+    def _bin_index(self, values):
+        idx = np.maximum(self._key(np.maximum(values, self.min_value)), 1)
+        return np.where(values < self.min_value, 0, idx)
+
+    def merge(self, other: "RunningStats"):
+        count = self.count + other.count
+        delta = other._mean - self._mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(count > 0, other.count / count, 0.0)
+        self._m2 += other._m2 + delta**2 * self.count * weight
+        self._mean += delta * weight
+        self.count = count
+        self.nan_count += other.nan_count
+        self._min = np.minimum(self._min, other._min)
+        self._max = np.maximum(self._max, other._max)
+        self._grow(other._histogram.shape[1])
+        self._histogram[:, : other._histogram.shape[1]] += other._histogram
+
+    def mean(self):
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    def std(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(self._m2 / self.count)
+
+    def min(self):
+        return np.where(self.count > 0, self._min, np.nan)
+
+    def max(self):
+        return np.where(self.count > 0, self._max, np.nan)
+
+    def percentile(self, q):
+        """Approximate q-th percentile, clipped to the exact min and max."""
+        cumulative = np.cumsum(self._histogram, axis=1)
+        rank = q / 100 * (self.count - 1)
+        idx = np.argmax(cumulative > rank[:, None], axis=1)
+        k = idx - 1 + self._offset
+        value = np.where(idx == 0, 0.0, 2 * self.gamma**k / (self.gamma + 1))
+        value = np.clip(value, self._min, self._max)
+        return np.where(self.count > 0, value, np.nan)
+
+    def statistics(self):
+        """Statistics in the order of tabulate_noise_combined.STAT_NAMES."""
+        return (
+            self.mean(),
+            self.std(),
+            self.percentile(5),
+            self.percentile(50),
+            self.percentile(95),
+            self.min(),
+            self.max(),
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class SweepPoint:
+    sequence: str
+    snr: float
+    repeats: int
+    sequence_duration: Optional[float] = None
+
+
+@dataclasses.dataclass
+class SweepChunk:
+    point: SweepPoint
+    c_values: np.ndarray
+    T1_values: np.ndarray  # seconds
+    c_est: np.ndarray  # (samples, repeats in chunk)
+    T1_est: np.ndarray  # (samples, repeats in chunk), seconds
+
+
+def simulate_look_locker(c_values, snr, sequence_duration, repeats, rng):
+    x1 = 1.0
+    x2 = np.sqrt(0.5)
+    T1_values = compute_T1(c_values) * 0.001
+    x3 = np.sqrt((0.1 + x2**2) / T1_values)
+
+    number_images_per_sequence = 14
+    t = np.linspace(0, sequence_duration, number_images_per_sequence)
+    y = f(t[None, None, :], x1, x2, x3[:, None, None])
+    scale = np.max(y, axis=-1, keepdims=True) / snr
+    shape = (len(c_values), repeats, number_images_per_sequence)
+    re, im = rng.normal(0, scale, shape), rng.normal(0, scale, shape)
+    Y = y + np.sqrt(re**2 + im**2)
+
+    popt = curve_fit_batch(f, t, Y.reshape(-1, number_images_per_sequence))
+    popt = popt.reshape(len(c_values), repeats, 3)
+    T1_est = compute_T1_from_x23(x2=popt[..., 1], x3=popt[..., 2])
+    return compute_c(T1_est * 1000), T1_est
+
+
+def simulate_mixed(c_values, snr, repeats, rng):
+    T1 = np.repeat(compute_T1(c_values)[:, None], repeats, axis=1)
+    IR = compute_ir_signal(T1, SNR=snr, rng=rng)
+    SE = compute_se_signal(T1, SNR=snr, rng=rng)
+    T1_est = extract_mixed_t1(IR=IR, SE=SE, lookup_table=LOOKUP_INVERTER)
+    return compute_c(T1_est), T1_est / 1000
+
+
+def sweep_points(sequences, snr_values, repeats, sequence_durations):
+    points = []
+    for sequence, snr, n in itertools.product(sequences, snr_values, repeats):
+        if sequence == "looklocker":
+            points += [SweepPoint(sequence, snr, n, duration) for duration in sequence_durations]
+        elif sequence == "mixed":
+            points.append(SweepPoint(sequence, snr, n))
+        else:
+            raise ValueError(f"Unknown sequence '{sequence}'")
+    return points
+
+
+def simulate_chunk(point, c_values, repeats, rng) -> SweepChunk:
+    if point.sequence == "looklocker":
+        c_est, T1_est = simulate_look_locker(
+            c_values, point.snr, point.sequence_duration, repeats, rng
+        )
+    else:
+        c_est, T1_est = simulate_mixed(c_values, point.snr, repeats, rng)
+    return SweepChunk(point, c_values, compute_T1(c_values) * 0.001, c_est, T1_est)
+
+
+def sweep(points, c_values, chunk_size=2**14, seed=0, workers=1) -> Iterator[SweepChunk]:
+    """Simulate every sweep point in chunks of at most chunk_size curves, i.e.
+    chunk_size // len(c_values) repeats of every concentration per chunk. Each
+    chunk has its own generator spawned from the seed, so the chunks are the same
+    for any number of workers."""
+    repeats_per_chunk = max(1, chunk_size // len(c_values))
+
+    def tasks():
+        point_seeds = np.random.SeedSequence(seed).spawn(len(points))
+        for point, point_seed in zip(points, point_seeds):
+            chunks = chunk_slices(point.repeats, repeats_per_chunk)
+            for chunk, chunk_seed in zip(chunks, point_seed.spawn(len(chunks))):
+                rng = np.random.default_rng(chunk_seed)
+                yield point, c_values, chunk.stop - chunk.start, rng
+
+    yield from run_chunks(simulate_chunk, tasks(), workers=workers)
+
+
+def summarize(chunks) -> dict:
+    """Accumulate the absolute concentration and T1 errors of a stream of chunks
+    into one RunningStats per sweep point and quantity."""
+    summary = {}
+    for chunk in chunks:
+        if chunk.point not in summary:
+            n = len(chunk.c_values)
+            summary[chunk.point] = {"c": RunningStats(n), "T1": RunningStats(n)}
+        summary[chunk.point]["c"].update(np.abs(chunk.c_values[:, None] - chunk.c_est))
+        summary[chunk.point]["T1"].update(np.abs(chunk.T1_values[:, None] - chunk.T1_est))
+    return summary
+
+
+@click.command()
+@click.option("--sequence", "sequences", multiple=True, default=["looklocker", "mixed"], help="Sequences to simulate")
+@click.option("--snr", "snr_values", multiple=True, default=[25], type=float, help="Signal to noise ratios")
+@click.option("--samples", default=500, help="Number of concentration samples")
+@click.option("--repeats", multiple=True, default=[50], type=int, help="Number of noise realizations per sample")
+@click.option("--sequence_duration", "sequence_durations", multiple=True, default=[2.6], type=float, help="Look-Locker sequence duration in seconds")
+@click.option("--chunk_size", default=2**14, help="Maximum number of simulated curves per chunk")
+@click.option("--seed", default=0, help="Seed for the random number generators")
+@click.option("--workers", default=None, type=int, help="Number of worker processes (default: all CPUs)")
+def main(sequences, snr_values, samples, repeats, sequence_durations, chunk_size, seed, workers):
+    c_values = np.linspace(0.005, 0.3, samples)
+    T1_values = compute_T1(c_values) * 0.001
+    points = sweep_points(sequences, snr_values, repeats, sequence_durations)
+    summary = summarize(sweep(points, c_values, chunk_size=chunk_size, seed=seed, workers=workers))
+    for point, stats in summary.items():
+        print(point)
+        print_statistics_table(
+            r"$c$ in mmol/l ", c_values, C_BINS, stats["c"].statistics(), ".2f", C_REFERENCE,
+            nan_counts=stats["c"].nan_count,
+        )
+        print_statistics_table(
+            r"$T_1$ in s ", T1_values, T1_BINS, stats["T1"].statistics(), ".1f", T1_REFERENCE,
+            nan_counts=stats["T1"].nan_count,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,31 +2,41 @@
 Predicted concentration vs estimated concentrations
 for the Look Locker and Mixed sequences with a given SNR
 """
+from functools import partial
+
 import click
 import numpy as np
 
+from cache import configure_cache
 from plot_noise_look_locker import generate_look_locker_data
 from plot_noise_mixed import generate_mixed_data
 
 
-def tabulate_estimated_versus_actual(snr, samples, sequence_duration, generate_data_func=generate_mixed_data):
-    if sequence_duration is None:
-        c, c_est, T1, T1_est, c_values, T1_values, _, _ = generate_data_func(snr, samples)
-    else:
-        c, c_est, T1, T1_est, c_values, T1_values, _, _ = generate_data_func(snr, samples, sequence_duration)
-    c_error = np.abs(c - c_est)
+STAT_NAMES = ["mean(e)", "stddev(e)", "5th(e)", "median(e)", "95th(e)", "min(e)", "max(e)"]
+C_BINS = np.array([0.0, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3])
+T1_BINS = np.array([0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5])
+C_REFERENCE = 0.3  # or c_values
+T1_REFERENCE = 4.0
+
+
+def error_statistics(error):
+    """Per-sample error statistics in the order of STAT_NAMES, over the repeats in axis 1."""
+    return (
+        np.mean(error, axis=1),
+        np.std(error, axis=1),
+        np.percentile(error, 5, axis=1),
+        np.median(error, axis=1),
+        np.percentile(error, 95, axis=1),
+        np.min(error, axis=1),
+        np.max(error, axis=1),
+    )
 
-    reference = 0.3 # or c_values
-    c_error_5_percentile = np.percentile(c_error, 5, axis=1)/reference*100
-    c_error_95_percentile = np.percentile(c_error, 95, axis=1)/reference*100
-    c_error_median = np.median(c_error, axis=1)/reference*100
-    c_error_mean = np.mean(c_error, axis=1)/reference*100
-    c_error_stddev = np.std(c_error, axis=1)/reference*100
-    c_error_min = np.min(c_error, axis=1)/reference*100
-    c_error_max = np.max(c_error, axis=1)/reference*100
 
-    c_bins = np.array([0.0, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3])
-    inds = np.digitize(x=c_values, bins=c_bins)
+def print_statistics_table(header, values, bins, stats, bin_format, reference, nan_counts=None):
+    """Print the statistics averaged over the bins of values as LaTeX table rows.
+    With nan_counts (per sample), the number of failed estimates in each bin is
+    added as a last row, since the statistics exclude them."""
+    inds = np.digitize(x=values, bins=bins)
 
     def digitize_and_print_statistic(name, data, num_bins, format_str=".3e"):
         line = f"{name} "
@@ -35,52 +45,49 @@ def tabulate_estimated_versus_actual(snr, samples, sequence_duration, generate_d
         line += "\\\\"
         print(line)
 
-    line = r"$c$ in mmol/l "
-    for i in range(len(c_bins)-1):
-        line += f"& ${c_bins[i]:.2f}-{c_bins[i+1]:.2f}$"
+    line = header
+    for i in range(len(bins)-1):
+        line += f"& ${bins[i]:{bin_format}}-{bins[i+1]:{bin_format}}$"
     line += "\\\\\\midrule"
     print(line)
 
-    stat_names = ["mean(e)", "stddev(e)", "5th(e)", "median(e)", "95th(e)", "min(e)", "max(e)"]
-    stats = (c_error_mean, c_error_stddev, c_error_5_percentile, c_error_median, c_error_95_percentile, c_error_min, c_error_max)
     formats = [".2f", ".2f", ".2f", ".2f", ".2f", ".2f", ".2f"]
-
-    for name, stat, fmt in zip(stat_names, stats, formats):
-        digitize_and_print_statistic(name, stat, format_str=fmt, num_bins=len(c_bins))
+    for name, stat, fmt in zip(STAT_NAMES, stats, formats):
+        digitize_and_print_statistic(name, stat/reference*100, format_str=fmt, num_bins=len(bins))
+    if nan_counts is not None:
+        line = "NaN "
+        for i in range(len(bins)-1):
+            line += f"& ${np.sum(nan_counts[inds==i+1])}$ "
+        print(line + "\\\\")
     print(r"\bottomrule")
 
-    reference = 4.0
-    t1_error = np.abs(T1 - T1_est)
-    t1_error_5_percentile = np.percentile(t1_error, 5, axis=1)/reference*100
-    t1_error_95_percentile = np.percentile(t1_error, 95, axis=1)/reference*100
-    t1_error_median = np.median(t1_error, axis=1)/reference*100
-    t1_error_mean = np.mean(t1_error, axis=1)/reference*100
-    t1_error_stddev = np.std(t1_error, axis=1)/reference*100
-    t1_error_min = np.min(t1_error, axis=1)/reference*100
-    t1_error_max = np.max(t1_error, axis=1)/reference*100
-
-    t1_bins = np.array([0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5])
-    inds = np.digitize(x=T1_values, bins=t1_bins)
-
-    line = r"$T_1$ in s "
-    for i in range(len(t1_bins)-1):
-        line += f"& ${t1_bins[i]:.1f}-{t1_bins[i+1]:.1f}$"
-    line += "\\\\\\midrule"
-    print(line)
 
-    stats = (t1_error_mean, t1_error_stddev, t1_error_5_percentile, t1_error_median, t1_error_95_percentile, t1_error_min, t1_error_max)
-    for name, stat, fmt in zip(stat_names, stats, formats):
-        digitize_and_print_statistic(name, stat, format_str=fmt, num_bins=len(t1_bins))
-    print(r"\bottomrule")
+def tabulate_estimated_versus_actual(snr, samples, sequence_duration, generate_data_func=generate_mixed_data):
+    if sequence_duration is None:
+        c, c_est, T1, T1_est, c_values, T1_values, _, _ = generate_data_func(snr, samples)
+    else:
+        c, c_est, T1, T1_est, c_values, T1_values, _, _ = generate_data_func(snr, samples, sequence_duration)
+
+    c_error = np.abs(c - c_est)
+    print_statistics_table(r"$c$ in mmol/l ", c_values, C_BINS, error_statistics(c_error), ".2f", C_REFERENCE)
+
+    t1_error = np.abs(T1 - T1_est)
+    print_statistics_table(r"$T_1$ in s ", T1_values, T1_BINS, error_statistics(t1_error), ".1f", T1_REFERENCE)
 
 
 @click.command()
 @click.option("--snr", default=25, help="Signal to noise ratio")
 @click.option("--samples", default=500, help="Number of samples")
 @click.option("--sequence_duration", default=2.6, help="Sequence duration in seconds")
-def main(snr, samples, sequence_duration=2.6):
+@click.option("--cache_dir", default=None, help="Directory for cached simulation results")
+@click.option("--no_cache", is_flag=True, help="Recompute without reading or writing the cache")
+@click.option("--workers", default=None, type=int, help="Number of worker processes (default: all CPUs)")
+@click.option("--initial_guess", type=click.Choice(["candidates", "grid"]), default="candidates", help="Starting points of the Look-Locker fits; grid may change the published results")
+def main(snr, samples, sequence_duration=2.6, cache_dir=None, no_cache=False, workers=None, initial_guess="candidates"):
+    configure_cache(directory=cache_dir, enabled=not no_cache)
     print("Look-Locker Sequence Results:")
-    tabulate_estimated_versus_actual(snr=snr, samples=samples, sequence_duration=sequence_duration, generate_data_func=generate_look_locker_data)
+    generate_look_locker = partial(generate_look_locker_data, workers=workers, initial_guess=initial_guess)
+    tabulate_estimated_versus_actual(snr=snr, samples=samples, sequence_duration=sequence_duration, generate_data_func=generate_look_locker)
     print("Mixed Sequence Results:")
     tabulate_estimated_versus_actual(snr=snr, samples=samples, sequence_duration=None, generate_data_func=generate_mixed_data)
 
@@ -0,0 +1,109 @@
+"""
+Loading and saving of NIfTI images for the pipeline scripts.
+
+Uncompressed .nii files (written when `uncompressed-intermediates` is set in
+snakeconfig.yaml) are memory-mapped read-only, and returned without a copy when
+the image has no intensity scaling, so that only the pages that are actually used
+are read from disk. Compressed .nii.gz files have to be inflated, and are read
+into memory.
+
+The module also holds the helpers shared by several scripts: the reorientation
+applied by simple_mri.load_mri, the subject and session of an image from its
+file name, and the erosion with a ball as in skimage.
+"""
+
+import re
+from pathlib import Path
+from typing import Optional
+
+import nibabel
+import numpy as np
+import scipy.ndimage
+
+
+def is_uncompressed(path: Path) -> bool:
+    return Path(path).suffix == ".nii"
+
+
+def load_nifti(path: Path, dtype: Optional[type] = None) -> tuple[np.ndarray, np.ndarray]:
+    """Return the voxel data and the affine of a NIfTI image. The data is a
+    read-only np.memmap for unscaled uncompressed images, unless a conversion to
+    another dtype is requested."""
+    image = nibabel.load(path, mmap="r")
+    proxy = image.dataobj
+    if is_uncompressed(path) and proxy.slope == 1.0 and proxy.inter == 0.0:
+        data = proxy.get_unscaled()
+    else:
+        data = np.asanyarray(proxy)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return data, image.affine
+
+
+def save_nifti(path: Path, data: np.ndarray, affine: np.ndarray, dtype: Optional[type] = None):
+    """Save the data without intensity scaling, so that an uncompressed output can
+    be memory-mapped by `load_nifti`."""
+    image = nibabel.Nifti1Image(np.asarray(data, dtype=dtype), affine)
+    image.header.set_slope_inter(1.0, 0.0)
+    Path(path).parent.mkdir(exist_ok=True, parents=True)
+    nibabel.save(image, path)
+
+
+def reorientation(shape, affine: np.ndarray):
+    """Flips, axis permutation and affine of the reorientation applied by
+    simple_mri.load_mri, which makes the affine closest to the identity."""
+    A = affine[:3, :3]
+    flips = np.sign(A[np.argmax(np.abs(A), axis=0), np.arange(3)]).astype(int)
+    permutes = np.argmax(np.abs(A), axis=0)
+    offsets = ((1 - flips) // 2) * (np.array(shape[:3]) - 1)
+    F = np.eye(4, dtype=int)
+    F[:3, :3] = np.diag(flips)
+    F[:3, 3] = offsets
+    P = np.eye(4, dtype=int)[[*permutes, 3]]
+    inverse_permutes = np.argmax(P[:3, :3].T, axis=1)
+    return flips, inverse_permutes, affine @ F @ P
+
+
+def load_reoriented(path: Path, dtype) -> tuple[np.ndarray, np.ndarray]:
+    image = nibabel.load(path)
+    data = np.asarray(image.get_fdata("unchanged"), dtype=dtype)
+    flips, inverse_permutes, affine = reorientation(data.shape, image.affine)
+    data = data[:: flips[0], :: flips[1], :: flips[2], ...].transpose(
+        [*inverse_permutes, *range(3, data.ndim)]
+    )
+    return np.ascontiguousarray(data), affine
+
+
+def reoriented_grid(path: Path) -> tuple[tuple[int, ...], np.ndarray]:
+    """Shape and affine of the reoriented image, without reading the data."""
+    image = nibabel.load(path)
+    _, inverse_permutes, affine = reorientation(image.shape, image.affine)
+    return tuple(int(image.shape[i]) for i in inverse_permutes), affine
+
+
+def apply_affine(T: np.ndarray, X: np.ndarray) -> np.ndarray:
+    return T[:-1, :-1].dot(X.T).T + T[:-1, -1]
+
+
+def session_info(path: Path) -> tuple[str, str]:
+    match = re.search(r"(sub-[^_]+)_(ses-[^_]+)", Path(path).name)
+    if match is None:
+        raise ValueError(f"Could not find subject and session in '{path}'")
+    return match.group(1), match.group(2)
+
+
+def subject_info(path: Path) -> str:
+    match = re.search(r"sub-[^_.]+", Path(path).name)
+    if match is None:
+        raise ValueError(f"Could not find subject in '{path}'")
+    return match.group(0)
+
+
+def erode_ball(mask: np.ndarray, radius: int) -> np.ndarray:
+    """Binary erosion with a ball of the given radius, as skimage.morphology.ball.
+    Voxels outside of the image count as inside the mask, as in skimage."""
+    if radius <= 0:
+        return mask
+    grid = np.mgrid[(slice(-radius, radius + 1),) * 3]
+    ball = (grid**2).sum(axis=0) <= radius**2
+    return scipy.ndimage.binary_erosion(mask, ball, border_value=1)
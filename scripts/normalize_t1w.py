@@ -0,0 +1,38 @@
+"""
+Normalize a T1-weighted image by its median intensity in the orbital reference ROI.
+
+Produces the same image as `gmri2fem mri t1w-normalize`, but reads the median of
+the session from the statistics written by `orbital_refroi.py --stats`, so that
+the reference ROI is not read and the median is not recomputed.
+"""
+
+import json
+from pathlib import Path
+
+import click
+import numpy as np
+from loguru import logger
+
+from nifti_io import load_nifti, reorientation, save_nifti, session_info
+
+
+@click.command()
+@click.option("--input", "image_path", type=Path, required=True)
+@click.option("--refroi_stats", type=Path, required=True)
+@click.option("--side", type=click.Choice(["left", "right"]), default="left")
+@click.option("--output", type=Path, required=True)
+def main(image_path: Path, refroi_stats: Path, side: str, output: Path):
+    session = session_info(image_path)[1]
+    medians = json.loads(refroi_stats.read_text())[side]
+    if session not in medians:
+        raise ValueError(f"No reference intensity for {session} in {refroi_stats}")
+
+    data, affine = load_nifti(image_path, dtype=np.float32)
+    flips, inverse_permutes, affine = reorientation(data.shape, affine)
+    data = data[:: flips[0], :: flips[1], :: flips[2]].transpose(inverse_permutes)
+    save_nifti(output, data / np.float32(medians[session]), affine, dtype=np.float32)
+    logger.info(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Extract the left and right orbital reference ROIs of a subject in one pass.
+
+Produces the same masks as `gmri2fem seg orbital-refroi --side left/right`:
+for each side, a Gaussian centred between the lateral orbitofrontal cortex,
+the medial orbitofrontal cortex and the amygdala weights every T1-weighted
+session, the weighted image is thresholded (Yen, or Otsu when Yen keeps fewer
+than 1000 voxels), and the masks of all sessions are intersected, eroded and
+reduced to their largest connected component.
+
+The sessions are read once into a memory-mapped (session, x, y, z) stack shared
+by both sides, the label centres of both sides are found in one pass over the
+segmentation, and each side only weights and thresholds the box where its
+Gaussian is evaluated. The median intensity of every session within each ROI
+is written to a JSON file, which `normalize_t1w.py` uses instead of reading the
+ROI again.
+"""
+
+import itertools
+import json
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import click
+import numpy as np
+import scipy.ndimage
+import scipy.stats
+import skimage.filters
+from loguru import logger
+
+from nifti_io import (
+    apply_affine,
+    erode_ball,
+    load_nifti,
+    load_reoriented,
+    reoriented_grid,
+    reorientation,
+    save_nifti,
+    session_info,
+)
+
+AXES_SEG_LABELS = {"left": [1012, 1027, 18], "right": [2012, 2027, 54]}
+ORBIT_DIMS_IN_MM = [10, 15, 10]
+
+
+def load_stack(paths: list[Path], stack_path: Path) -> tuple[np.ndarray, np.ndarray]:
+    """Reoriented images as one memory-mapped (session, x, y, z) float32 array."""
+    shape, affine = reoriented_grid(paths[0])
+    stack = np.lib.format.open_memmap(stack_path, mode="w+", dtype=np.float32, shape=(len(paths), *shape))
+    for idx, path in enumerate(paths):
+        data, image_affine = load_nifti(path, dtype=np.float32)
+        flips, inverse_permutes, image_affine = reorientation(data.shape, image_affine)
+        if not np.allclose(image_affine, affine):
+            raise ValueError(f"{path} is not on the grid of {paths[0]}")
+        stack[idx] = data[:: flips[0], :: flips[1], :: flips[2]].transpose(inverse_permutes)
+    stack.flush()
+    return stack, affine
+
+
+def label_centers(seg: np.ndarray, affine: np.ndarray) -> dict[str, np.ndarray]:
+    """Centre of each side's orbital Gaussian in scanner coordinates: the mean
+    index along axis i of the i-th label of the side."""
+    labels = sorted({label for side_labels in AXES_SEG_LABELS.values() for label in side_labels})
+    boxes = scipy.ndimage.find_objects(np.where(np.isin(seg, labels), seg, 0), max_label=max(labels))
+    centers = {}
+    for side, side_labels in AXES_SEG_LABELS.items():
+        center = []
+        for axis, label in enumerate(side_labels):
+            box = boxes[label - 1]
+            if box is None:
+                raise ValueError(f"Label {label} not found in segmentation")
+            indices = np.nonzero(seg[box] == label)[axis] + box[axis].start
+            center.append(indices.mean())
+        centers[side] = apply_affine(affine, np.array(center))
+    return centers
+
+
+def orbital_weights(
+    center_ras: np.ndarray, shape, affine: np.ndarray
+) -> tuple[tuple[slice, ...], np.ndarray]:
+    """Gaussian weights on the evaluation window around the centre, and the box of
+    the image holding the window. The box is the whole image when the window
+    reaches outside of it, in which case the weights are placed like the
+    original's (wrapping) fancy indexing does."""
+    std = np.array(ORBIT_DIMS_IN_MM) / 2
+    inverse = np.linalg.inv(affine)
+    lower = np.rint(apply_affine(inverse, center_ras - 5 * std))
+    upper = np.rint(apply_affine(inverse, center_ras + 5 * std))
+    ranges = [np.arange(int(a), int(b)) for a, b in zip(lower, upper)]
+    G = scipy.stats.multivariate_normal(mean=center_ras, cov=std**2)
+
+    if all(r.size and r[0] >= 0 and r[-1] < n for r, n in zip(ranges, shape)):
+        window = np.stack(np.meshgrid(*ranges, indexing="ij"), axis=-1).reshape(-1, 3)
+        box = tuple(slice(int(r[0]), int(r[-1]) + 1) for r in ranges)
+        weights = G.pdf(apply_affine(affine, window)).astype(np.float32)
+        return box, weights.reshape([r.size for r in ranges])
+
+    window = np.fromiter(itertools.product(*ranges), dtype=np.dtype((int, 3)))
+    weights = np.zeros(shape, dtype=np.float32)
+    weights[tuple(window.T)] = G.pdf(apply_affine(affine, window))
+    return (slice(None),) * 3, weights
+
+
+def threshold_weighted_image(
+    volume: np.ndarray, box: tuple[slice, ...], weights: np.ndarray, min_voxels: int = 1000
+) -> np.ndarray:
+    """Thresholded weighted image on the box. Outside of the box the weighted
+    image is zero, which only matters for the Otsu fallback."""
+    image = volume[box] * weights
+    hist, bin_edges = np.histogram(image[image > 1e-8], bins=256)
+    bins = (bin_edges[:-1] + bin_edges[1:]) / 2
+    mask = image > skimage.filters.threshold_yen(hist=(hist, bins))
+    if mask.sum() < min_voxels:
+        full = np.zeros(volume.shape, dtype=image.dtype)
+        full[box] = image
+        return image > skimage.filters.threshold_otsu(full)
+    return mask
+
+
+def largest_island(mask: np.ndarray) -> np.ndarray:
+    labels, num_labels = scipy.ndimage.label(mask)
+    if num_labels == 0:
+        raise ValueError("Empty reference ROI")
+    sizes = np.bincount(labels.ravel())[1:]
+    return labels == np.argmax(sizes) + 1
+
+
+def orbital_roi(stack: np.ndarray, center_ras: np.ndarray, affine: np.ndarray) -> np.ndarray:
+    box, weights = orbital_weights(center_ras, stack.shape[1:], affine)
+    roi_box = np.ones(weights.shape, dtype=bool)
+    for volume in stack:
+        roi_box &= threshold_weighted_image(volume, box, weights)
+    roi = np.zeros(stack.shape[1:], dtype=bool)
+    roi[box] = roi_box
+    return largest_island(erode_ball(roi, 1))
+
+
+@click.command()
+@click.option("--T1w", "t1w_paths", type=Path, multiple=True, required=True, help="Registered T1w images, first is the reference")
+@click.option("--segmentation", type=Path, required=True)
+@click.option("--left", type=Path, required=True, help="Output left orbital ROI")
+@click.option("--right", type=Path, required=True, help="Output right orbital ROI")
+@click.option("--stats", type=Path, help="Output JSON with the median intensity of every session in each ROI")
+@click.option("--tmpdir", type=Path, help="Directory of the memory-mapped stack, defaults to the system temporary directory")
+def main(t1w_paths, segmentation: Path, left: Path, right: Path, stats: Optional[Path], tmpdir: Optional[Path]):
+    seg, seg_affine = load_reoriented(segmentation, np.int16)
+    centers = label_centers(seg, seg_affine)
+    del seg
+
+    outputs = {"left": left, "right": right}
+    medians = {}
+    with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+        stack, affine = load_stack(list(t1w_paths), Path(tmp) / "T1w.npy")
+        for side, output in outputs.items():
+            roi = orbital_roi(stack, centers[side], affine)
+            save_nifti(output, roi, affine, dtype=np.uint8)
+            logger.info(f"Wrote {output} ({roi.sum()} voxels)")
+            medians[side] = {
+                session_info(path)[1]: float(np.median(volume[roi])) for path, volume in zip(t1w_paths, stack)
+            }
+        del stack
+
+    if stats is not None:
+        stats.parent.mkdir(exist_ok=True, parents=True)
+        stats.write_text(json.dumps(medians, indent=2))
+
+
+if __name__ == "__main__":
+    main()
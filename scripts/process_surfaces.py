@@ -0,0 +1,94 @@
+"""
+Surface processing for the brain mesh with a single read of aseg.mgz.
+
+Runs the steps of `gmri2fem brainmeshing process-surfaces` and
+`gmri2fem brainmeshing extract-ventricles` with the same brainmeshing functions
+and parameters, but loads the segmentation once and shares it between the
+subcortical gray matter, the white matter connective tissue and the ventricles.
+The ventricle surface is extracted in a worker process while the cortical
+surfaces are processed, so that the two steps still run concurrently as they did
+as separate rules.
+"""
+
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import click
+import numpy as np
+import pyvista as pv
+import simple_mri as sm
+from loguru import logger
+
+from brainmeshing.mesh_generation import extract_subcortical_gm, preprocess_pial_surfaces
+from brainmeshing.utils import (
+    grow_white_connective_tissue,
+    pyvista2svmtk,
+    repair_triangulation,
+    surface_union,
+    svmtk2pyvista,
+)
+from brainmeshing.ventricles import extract_ventricle_surface
+
+SURFACES = ["lh_pial.stl", "rh_pial.stl", "lh_white.stl", "rh_white.stl"]
+
+
+def extract_ventricles(seg_mri: sm.SimpleMRI, surface_dir: Path):
+    ventricles = extract_ventricle_surface(
+        seg_mri,
+        initial_smoothing=0,
+        min_radius=3,
+        surface_smoothing=2,
+        taubin_iter=100,
+        dilate=0,
+    )
+    pv.save_meshio(f"{surface_dir}/ventricles.stl", ventricles)
+
+
+def preprocess_white_matter_surfaces(
+    seg_mri: sm.SimpleMRI,
+    surface_dir: Path,
+    max_edge_length=0.5,
+    remesh_iter=1,
+    taubin_iter=100,
+    taubin_pass_band=0.1,
+):
+    """brainmeshing.mesh_generation.preprocess_white_matter_surfaces, on a loaded
+    segmentation."""
+    logger.info("Preparing white matter surfaces.")
+    connective = repair_triangulation(
+        grow_white_connective_tissue(seg_mri, cc_radius=3, lv_radius=2, smoothing=4)
+    )
+    svm_surfaces = [
+        pyvista2svmtk(repair_triangulation(pv.read(f"{surface_dir}/lh_white.stl"))),
+        pyvista2svmtk(connective),
+        pyvista2svmtk(repair_triangulation(pv.read(f"{surface_dir}/rh_white.stl"))),
+    ]
+    white_svm = functools.reduce(surface_union, svm_surfaces)
+    white_svm = pyvista2svmtk(repair_triangulation(svmtk2pyvista(white_svm)))
+    white_svm.isotropic_remeshing(max_edge_length, remesh_iter, True)
+    white = svmtk2pyvista(white_svm)
+    white.smooth_taubin(taubin_iter, taubin_pass_band, normalize_coordinates=True, inplace=True)
+    pv.save_meshio(f"{surface_dir}/white.stl", repair_triangulation(white))
+
+
+@click.command()
+@click.option("--fs_dir", type=Path, required=True)
+@click.option("--surface_dir", type=Path, required=True)
+def main(fs_dir: Path, surface_dir: Path):
+    missing = [surf for surf in SURFACES if not (surface_dir / surf).exists()]
+    if missing:
+        raise FileNotFoundError(f"Missing {missing} in {surface_dir}, see convert_surfaces.py")
+    logger.info(f"Processing surfaces from {fs_dir} -> {surface_dir}")
+    seg_mri = sm.load_mri(fs_dir / "mri/aseg.mgz", dtype=np.int16)
+
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        ventricles = executor.submit(extract_ventricles, seg_mri, surface_dir)
+        pv.save_meshio(f"{surface_dir}/subcortical_gm.stl", extract_subcortical_gm(seg_mri))
+        preprocess_white_matter_surfaces(seg_mri, surface_dir)
+        preprocess_pial_surfaces(surface_dir)
+        ventricles.result()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Refine several FreeSurfer segmentations of a subject in one pass.
+
+Produces, for every segmentation, the same refined segmentation and CSF
+segmentation as `gmri2fem seg refine`:
+
+1. the segmentation is resampled (nearest neighbour) to the reference image,
+2. the labels are smoothed: every label's indicator is Gaussian filtered, and
+   every voxel gets the label with the highest score, while unlabelled voxels
+   with a score below 0.5 stay unlabelled,
+3. every voxel of the CSF mask gets the label of the nearest labelled voxel.
+
+The resampling map from reference voxels to segmentation voxels, and the CSF
+voxels, are computed once and shared by all segmentations on the same grid (the
+FreeSurfer volumes of a subject are all on the conformed grid). The filtered
+indicator of a label is zero further than the filter radius from the label, so
+each label is filtered on its bounding box padded by that radius only, on a
+shared pool of threads. The nearest labelled voxel of every CSF voxel is looked
+up once for all segmentations with the same labelled voxels.
+"""
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import click
+import numpy as np
+import scipy.ndimage
+import scipy.spatial
+from loguru import logger
+
+from nifti_io import apply_affine, load_reoriented, reoriented_grid, save_nifti
+
+SEG_DTYPE = np.int16
+
+
+def resampling_map(
+    shape_in, affine_in: np.ndarray, shape_out, affine_out: np.ndarray, chunk_size: int = 2**22
+) -> np.ndarray:
+    """Flat index into the input grid for every voxel of the output grid, -1 for
+    voxels outside the input field of view (or on its first slab along any axis)."""
+    size = int(np.prod(shape_out))
+    index = np.full(size, -1, dtype=np.int64)
+    inverse = np.linalg.inv(affine_in)
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        out_inds = np.stack(np.unravel_index(np.arange(start, stop), shape_out), axis=1)
+        in_inds = np.rint(apply_affine(inverse, apply_affine(affine_out, out_inds))).astype(int)
+        # Index 0 is treated as outside, deliberately reproducing the check of
+        # gmri2fem's resample_segmentation, so the outputs match `gmri2fem seg refine`.
+        valid = (in_inds > 0).all(axis=1) * (in_inds < shape_in).all(axis=1)
+        index[start:stop][valid] = np.ravel_multi_index(tuple(in_inds[valid].T), shape_in)
+    return index
+
+
+def resample(segmentation: np.ndarray, index: np.ndarray, shape_out) -> np.ndarray:
+    resampled = np.zeros(index.shape, dtype=segmentation.dtype)
+    valid = index >= 0
+    resampled[valid] = segmentation.reshape(-1)[index[valid]]
+    return resampled.reshape(shape_out)
+
+
+def label_boxes(segmentation: np.ndarray, margin: int) -> dict[int, tuple[slice, ...]]:
+    """Bounding box of every nonzero label, padded by margin and clipped to the image."""
+    boxes = {}
+    for label, box in enumerate(scipy.ndimage.find_objects(np.maximum(segmentation, 0)), start=1):
+        if box is None:
+            continue
+        boxes[label] = tuple(
+            slice(max(s.start - margin, 0), min(s.stop + margin, n)) for s, n in zip(box, segmentation.shape)
+        )
+    for label in np.unique(segmentation[segmentation < 0]):
+        # find_objects only handles positive labels.
+        where = np.argwhere(segmentation == label)
+        boxes[int(label)] = tuple(
+            slice(max(lo - margin, 0), min(hi + 1 + margin, n))
+            for lo, hi, n in zip(where.min(axis=0), where.max(axis=0), segmentation.shape)
+        )
+    return boxes
+
+
+def segmentation_smoothing(
+    segmentation: np.ndarray,
+    sigma: float,
+    executor: ThreadPoolExecutor,
+    cutoff_score: float = 0.5,
+    truncate: float = 4.0,
+) -> np.ndarray:
+    radius = int(truncate * float(sigma) + 0.5)
+    boxes = label_boxes(segmentation, radius)
+    labels = sorted(boxes)
+
+    def label_scores(label: int) -> np.ndarray:
+        box = boxes[label]
+        return scipy.ndimage.gaussian_filter(
+            (segmentation[box] == label).astype(float), sigma=sigma, truncate=truncate
+        )
+
+    new_labels = np.zeros_like(segmentation)
+    high_scores = np.zeros(segmentation.shape)
+    # Results are combined in label order, so ties resolve as in the sequential version.
+    for label, scores in zip(labels, executor.map(label_scores, labels)):
+        box = boxes[label]
+        is_new_high_score = scores > high_scores[box]
+        new_labels[box][is_new_high_score] = label
+        high_scores[box][is_new_high_score] = scores[is_new_high_score]
+
+    delete_scores = (high_scores < cutoff_score) * (segmentation == 0)
+    new_labels[delete_scores] = 0
+    return new_labels
+
+
+def nearest_labelled(labelled_voxels: np.ndarray, query_voxels: np.ndarray) -> np.ndarray:
+    tree = scipy.spatial.cKDTree(labelled_voxels.astype(float))
+    _, indices = tree.query(query_voxels.astype(float))
+    return indices
+
+
+@click.command()
+@click.option(
+    "--seg",
+    "segmentations",
+    type=(Path, Path, Path),
+    multiple=True,
+    required=True,
+    help="FreeSurfer segmentation, output refined segmentation and output CSF segmentation",
+)
+@click.option("--reference", type=Path, required=True)
+@click.option("--csfmask", type=Path, required=True)
+@click.option("--label_smoothing", type=float, default=0)
+@click.option("--threads", type=int, default=6)
+def main(segmentations, reference: Path, csfmask: Path, label_smoothing: float, threads: int):
+    shape_out, affine_out = reoriented_grid(reference)
+    csf_mask, csf_affine = load_reoriented(csfmask, bool)
+    if csf_mask.shape != shape_out or not np.allclose(csf_affine, affine_out):
+        raise ValueError(f"{csfmask} is not on the grid of {reference}")
+    csf_voxels = np.argwhere(csf_mask)
+
+    maps = {}
+    neighbours = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for fs_seg, output_seg, output_csfseg in segmentations:
+            seg, affine_in = load_reoriented(fs_seg, SEG_DTYPE)
+            grid = (seg.shape, affine_in.tobytes())
+            if grid not in maps:
+                maps[grid] = resampling_map(seg.shape, affine_in, shape_out, affine_out)
+            refined = resample(seg, maps[grid], shape_out)
+            if label_smoothing > 0:
+                refined = segmentation_smoothing(refined, label_smoothing, executor)
+            save_nifti(output_seg, refined, affine_out, dtype=SEG_DTYPE)
+
+            labelled = refined != 0
+            support = hashlib.sha256(np.packbits(labelled)).digest()
+            labelled_voxels = np.argwhere(labelled)
+            if support not in neighbours:
+                neighbours[support] = nearest_labelled(labelled_voxels, csf_voxels)
+            csf_seg = np.zeros(shape_out, dtype=SEG_DTYPE)
+            nearest = labelled_voxels[neighbours[support]]
+            csf_seg[tuple(csf_voxels.T)] = refined[tuple(nearest.T)]
+            save_nifti(output_csfseg, csf_seg, affine_out, dtype=SEG_DTYPE)
+            logger.info(f"Refined {fs_seg}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Region-wise statistics of a set of session images over a segmentation.
+
+All sessions are stacked into one (sessions, voxels) array over the labelled
+voxels only, grouped by label with the index of the segmentation (see
+label_index.py), which is cached in --cache_dir when given. Counts, sums, means
+and standard deviations then follow from np.bincount, and the median and
+percentiles are read directly from the sorted groups, so the cost is
+O(sessions * voxels * log(voxels)) independently of the number of labels.
+
+The output has one row per session and label, with the columns of
+`gmri2fem mri stats`, and the acquisition time of each session taken from the
+timetable. The total content of a region is `sum` times the voxel volume.
+
+With --timeline, the sessions are read from the concentration timeline store of
+the subject (see concentration_timeline.py) instead of the images, with the
+acquisition times recorded in the store. Voxels outside of its mask are NaN, as
+in the concentration images.
+"""
+
+import os
+from pathlib import Path
+from typing import Optional
+
+import click
+import nibabel
+import numpy as np
+import pandas as pd
+
+from concentration_timeline import Timeline
+from label_index import LabelIndex, load_label_index
+from nifti_io import load_nifti, session_info, subject_info
+from timetable import load_timetable
+
+PERCENTILES = [1, 5, 25, 75, 90, 95, 99]
+
+
+def read_lut(path: Optional[Path]) -> dict[int, str]:
+    """Label descriptions from a FreeSurferColorLUT.txt-style lookup table."""
+    if path is None or not Path(path).exists():
+        return {}
+    lut = {}
+    for line in Path(path).read_text().splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].isdigit():
+            lut[int(fields[0])] = fields[1]
+    return lut
+
+
+def grouped_statistics(values: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> dict:
+    """Statistics of the groups values[start:start + count] of a 1D array ordered
+    by group. NaN values are excluded; groups with no finite values give NaN."""
+    group = np.repeat(np.arange(len(starts)), counts)
+    # Sort the values within each group, with NaN last (as np.sort does).
+    order = np.lexsort((values, group))
+    values = values[order]
+    finite = np.isfinite(values)
+    n = np.bincount(group, weights=finite, minlength=len(starts)).astype(int)
+
+    masked = np.where(finite, values, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = np.bincount(group, weights=masked, minlength=len(starts))
+        mean = total / n
+        squares = np.where(finite, (values - mean[group]) ** 2, 0.0)
+        std = np.sqrt(np.bincount(group, weights=squares, minlength=len(starts)) / n)
+
+    def quantile(q):
+        # Linear interpolation between closest ranks, as np.quantile.
+        position = q * np.maximum(n - 1, 0)
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, np.maximum(n - 1, 0))
+        lo, hi = values[starts + lower], values[starts + upper]
+        result = lo + (hi - lo) * (position - lower)
+        return np.where(n > 0, result, np.nan)
+
+    return {
+        "num_nan_values": counts - n,
+        "sum": np.where(n > 0, total, np.nan),
+        "mean": mean,
+        "median": quantile(0.5),
+        "std": std,
+        "min": quantile(0.0),
+        **{f"PC{pc}": quantile(pc / 100) for pc in PERCENTILES},
+        "max": quantile(1.0),
+    }
+
+
+def region_statistics(
+    index: LabelIndex,
+    images: list[np.ndarray],
+    voxel_volume_ml: float,
+    lut: Optional[dict[int, str]] = None,
+) -> list[pd.DataFrame]:
+    """One dataframe of region statistics per image."""
+    lut = lut or {}
+    starts, counts = index.offsets[:-1], index.counts
+    stacked = np.stack([np.asarray(image).reshape(-1)[index.voxels] for image in images])
+    regions = {
+        "label": index.labels,
+        "description": [lut.get(int(label), "") for label in index.labels],
+        "voxelcount": counts,
+        "volume_ml": counts * voxel_volume_ml,
+    }
+    return [
+        pd.DataFrame({**regions, **grouped_statistics(values.astype(float), starts, counts)})
+        for values in stacked
+    ]
+
+
+@click.command()
+@click.option("-s", "--segmentation", type=Path, required=True)
+@click.option("-m", "--mri", "mris", type=Path, multiple=True)
+@click.option("--timeline", type=Path, help="Concentration timeline store, instead of --mri")
+@click.option("-o", "--output", type=Path, required=True)
+@click.option("--timetable", type=Path)
+@click.option("--timelabel", type=str, default="looklocker")
+@click.option("--lut", type=Path, help="FreeSurfer color lookup table for the label descriptions")
+@click.option("--cache_dir", type=Path, help="Directory for the cached label index of the segmentation")
+def main(
+    segmentation: Path,
+    mris: list[Path],
+    timeline: Optional[Path],
+    output: Path,
+    timetable: Optional[Path],
+    timelabel: str,
+    lut: Optional[Path],
+    cache_dir: Optional[Path],
+):
+    if bool(mris) == (timeline is not None):
+        raise click.UsageError("Give either --mri or --timeline")
+    index = load_label_index(segmentation, cache_dir)
+    affine = nibabel.load(segmentation).affine
+    if timeline is not None:
+        subject = subject_info(timeline)
+        with Timeline(timeline) as store:
+            if store.shape != index.shape or not np.allclose(store.affine, affine):
+                raise ValueError(f"{timeline} is not on the grid of the segmentation")
+            images = [store.time_slice(idx) for idx in range(len(store.sessions))]
+            sessions = [(subject, session) for session in store.sessions]
+            timestamps = list(store.times)
+    else:
+        images = []
+        for path in mris:
+            data, image_affine = load_nifti(path)
+            if data.shape != index.shape or not np.allclose(image_affine, affine):
+                raise ValueError(f"{path} is not on the grid of the segmentation")
+            images.append(data)
+        sessions = [session_info(path) for path in mris]
+        times = load_timetable(timetable) if timetable is not None else None
+        timestamps = [times.time(*info, timelabel) for info in sessions] if times is not None else None
+    voxel_volume_ml = abs(np.linalg.det(affine[:3, :3])) / 1000
+    if lut is None and "FREESURFER_HOME" in os.environ:
+        lut = Path(os.environ["FREESURFER_HOME"]) / "FreeSurferColorLUT.txt"
+
+    frames = region_statistics(index, images, voxel_volume_ml, read_lut(lut))
+    for idx, (frame, (subject, session)) in enumerate(zip(frames, sessions)):
+        frame["subject"] = subject
+        frame["session"] = session
+        if timestamps is not None:
+            frame["timestamp"] = timestamps[idx]
+    output.parent.mkdir(exist_ok=True, parents=True)
+    pd.concat(frames, ignore_index=True).to_csv(output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Rigid registration of several moving images to one fixed image in a single job.
+
+Every (moving, transform, metric) pair is registered with the same greedy command
+as the `register` rule, so the .mat transforms are the same. The fixed image is
+read and decompressed once into an uncompressed copy shared by all registrations,
+and the greedy processes run on a shared pool of threads, instead of each job
+reserving its own threads and memory and inflating the fixed image again.
+"""
+
+import shlex
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import click
+import nibabel
+from loguru import logger
+
+
+def uncompressed_copy(image: Path, directory: Path) -> Path:
+    if image.suffix == ".nii":
+        return image
+    output = directory / image.name.removesuffix(".gz")
+    nibabel.save(nibabel.load(image), output)
+    return output
+
+
+def greedy_command(fixed: Path, moving: Path, transform: Path, metric: str, threads: int) -> str:
+    return (
+        "greedy -d 3 -a"
+        f" -i {shlex.quote(str(fixed))} {shlex.quote(str(moving))}"
+        f" -o {shlex.quote(str(transform))}"
+        " -ia-image-centers"
+        " -dof 6"
+        f" -m {metric}"
+        f" -threads {threads}"
+    )
+
+
+def register_all(fixed: Path, pairs, threads: int, jobs: int, verbose: bool = False):
+    jobs = max(1, min(jobs, len(pairs)))
+    threads_per_job = max(1, threads // jobs)
+
+    def register(pair):
+        moving, transform, metric = pair
+        transform.parent.mkdir(exist_ok=True, parents=True)
+        cmd = greedy_command(fixed, moving, transform, metric, threads_per_job)
+        logger.info(cmd)
+        subprocess.run(
+            cmd, shell=True, capture_output=not verbose, text=True
+        ).check_returncode()
+        return transform
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for transform in executor.map(register, pairs):
+            logger.info(f"Wrote {transform}")
+
+
+@click.command()
+@click.option("--fixed", type=Path, required=True)
+@click.option(
+    "--pair",
+    "pairs",
+    type=(Path, Path, str),
+    multiple=True,
+    required=True,
+    help="Moving image, output transform and greedy metric, e.g. 'NCC 5x5x5'",
+)
+@click.option("--threads", type=int, default=6, help="Total number of threads")
+@click.option("--jobs", type=int, default=2, help="Number of concurrent registrations")
+@click.option("--verbose", type=bool, is_flag=True)
+def main(fixed: Path, pairs, threads: int, jobs: int, verbose: bool):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shared_fixed = uncompressed_copy(fixed, Path(tmpdir))
+        register_all(shared_fixed, pairs, threads, jobs, verbose)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Reslice several images with the same rigid transform in one pass.
+
+The greedy transforms (.mat, 4x4 matrices mapping fixed to moving physical RAS
+coordinates) given with --transform are composed into a single matrix, applied in
+the same order as `greedy -r`, i.e. the last one first. For nearest-neighbour
+interpolation, the voxel of the moving grid sampled by every voxel of the fixed
+grid is computed once per (transform, fixed grid, moving grid) and cached as a
+flat index array, and every image is then resliced by a single gather. Points
+outside the moving image are set to 0, as in greedy. The least recently used
+index arrays are evicted when the cache directory grows beyond --cache_max_mb
+(default RESLICE_CACHE_MAX_MB, or 2048).
+"""
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import click
+import nibabel
+import numpy as np
+import scipy.ndimage
+from loguru import logger
+
+from nifti_io import load_nifti, save_nifti
+
+CACHE_MAX_BYTES = int(float(os.environ.get("RESLICE_CACHE_MAX_MB", 2048)) * 2**20)
+
+
+def compose_transforms(transforms: list[Path]) -> np.ndarray:
+    matrix = np.eye(4)
+    for transform in transforms:
+        matrix = matrix @ np.loadtxt(transform)
+    return matrix
+
+
+def voxel_map(matrix: np.ndarray, fixed_affine: np.ndarray, moving_affine: np.ndarray) -> np.ndarray:
+    """Affine map from fixed voxel indices to moving voxel coordinates."""
+    return np.linalg.inv(moving_affine) @ matrix @ fixed_affine
+
+
+def moving_coordinates(vox2vox: np.ndarray, fixed_shape, start: int, stop: int) -> np.ndarray:
+    """Moving voxel coordinates (3, n) of the fixed voxels with flat (C-order)
+    indices start:stop."""
+    fixed_voxels = np.unravel_index(np.arange(start, stop), fixed_shape)
+    return vox2vox[:3, :3] @ np.stack(fixed_voxels) + vox2vox[:3, 3:]
+
+
+def nearest_index(vox2vox: np.ndarray, fixed_shape, moving_shape, chunk_size: int = 2**22) -> np.ndarray:
+    """Flat index into the moving image for every fixed voxel, -1 outside."""
+    size = int(np.prod(fixed_shape))
+    dtype = np.int32 if np.prod(moving_shape) < 2**31 else np.int64
+    index = np.empty(size, dtype=dtype)
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        coordinates = np.floor(moving_coordinates(vox2vox, fixed_shape, start, stop) + 0.5)
+        coordinates = coordinates.astype(np.int64)
+        inside = np.all(
+            (coordinates >= 0) & (coordinates < np.array(moving_shape)[:, None]), axis=0
+        )
+        flat = np.ravel_multi_index(np.where(inside, coordinates, 0), moving_shape)
+        index[start:stop] = np.where(inside, flat, -1)
+    return index
+
+
+def grid_key(matrix: np.ndarray, fixed: nibabel.Nifti1Image, moving: nibabel.Nifti1Image) -> str:
+    m = hashlib.sha256()
+    for array in (matrix, fixed.affine, moving.affine):
+        m.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    m.update(repr((fixed.shape[:3], moving.shape[:3])).encode())
+    return m.hexdigest()
+
+
+def cached_nearest_index(
+    matrix: np.ndarray,
+    fixed: nibabel.Nifti1Image,
+    moving: nibabel.Nifti1Image,
+    cache_dir: Optional[Path],
+    max_bytes: int = CACHE_MAX_BYTES,
+) -> np.ndarray:
+    vox2vox = voxel_map(matrix, fixed.affine, moving.affine)
+    if cache_dir is None:
+        return nearest_index(vox2vox, fixed.shape[:3], moving.shape[:3])
+    path = cache_dir / f"{grid_key(matrix, fixed, moving)}.npy"
+    try:
+        index = np.load(path, mmap_mode="r")
+        os.utime(path)  # Mark as recently used.
+        return index
+    except (FileNotFoundError, ValueError, EOFError):
+        pass
+    index = nearest_index(vox2vox, fixed.shape[:3], moving.shape[:3])
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    # Written to a unique file and renamed, as concurrent jobs may share the pair.
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f".{path.stem}.", suffix=".tmp", delete=False) as f:
+        np.save(f, index)
+    Path(f.name).replace(path)
+    evict(cache_dir, max_bytes, keep=path)
+    return index
+
+
+def evict(cache_dir: Path, max_bytes: int, keep: Optional[Path] = None):
+    entries = sorted(cache_dir.glob("*.npy"), key=lambda p: p.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        size = entry.stat().st_size
+        try:
+            entry.unlink()
+        except FileNotFoundError:
+            continue
+        total -= size
+
+
+def reslice_nearest(data: np.ndarray, index: np.ndarray, fixed_shape) -> np.ndarray:
+    """Gather the (moving) data at index, over the first three axes."""
+    flat = np.asarray(data).reshape(int(np.prod(data.shape[:3])), *data.shape[3:])
+    resliced = flat[np.maximum(index, 0)]
+    resliced[index < 0] = 0
+    return resliced.reshape(*fixed_shape, *data.shape[3:])
+
+
+def reslice_linear(data: np.ndarray, vox2vox: np.ndarray, fixed_shape) -> np.ndarray:
+    if data.ndim != 3:
+        raise ValueError("Linear interpolation is only supported for 3D images")
+    return scipy.ndimage.affine_transform(
+        np.asarray(data, dtype=np.float32),
+        vox2vox,
+        output_shape=fixed_shape,
+        order=1,
+        mode="constant",
+        cval=0.0,
+    )
+
+
+@click.command()
+@click.option("--fixed", type=Path, required=True, help="Image defining the output grid")
+@click.option("--transform", "transforms", type=Path, multiple=True, required=True)
+@click.option("--image", "images", type=(Path, Path), multiple=True, required=True, help="Moving image and output")
+@click.option("--interp_mode", type=click.Choice(["NN", "LINEAR"]), default="NN")
+@click.option("--cache_dir", type=Path, help="Directory for the cached sampling indices")
+@click.option("--cache_max_mb", type=float, help="Size limit of the cache directory")
+def main(fixed: Path, transforms, images, interp_mode: str, cache_dir: Optional[Path], cache_max_mb: Optional[float]):
+    max_bytes = CACHE_MAX_BYTES if cache_max_mb is None else int(cache_max_mb * 2**20)
+    fixed_image = nibabel.load(fixed)
+    fixed_shape = fixed_image.shape[:3]
+    matrix = compose_transforms(transforms)
+    indices = {}
+    for moving, output in images:
+        moving_image = nibabel.load(moving)
+        data, _ = load_nifti(moving)
+        if interp_mode == "NN":
+            key = grid_key(matrix, fixed_image, moving_image)
+            if key not in indices:
+                indices[key] = cached_nearest_index(matrix, fixed_image, moving_image, cache_dir, max_bytes)
+            resliced = reslice_nearest(data, indices[key], fixed_shape)
+        else:
+            vox2vox = voxel_map(matrix, fixed_image.affine, moving_image.affine)
+            resliced = reslice_linear(data, vox2vox, fixed_shape)
+        save_nifti(output, resliced, fixed_image.affine)
+        logger.info(f"Resliced {moving} -> {output}")
+
+
+if __name__ == "__main__":
+    main()
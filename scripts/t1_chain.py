@@ -0,0 +1,140 @@
+"""
+Fused voxelwise T1 post-processing of the registered T1 maps of a subject.
+
+Computes, for every session, the images of the rules `hybrid_T1maps`,
+`T1_to_R1` (applied to the hybrid map) and `concentration_estimate`:
+
+- hybrid T1: the Look-Locker T1, replaced by the mixed T1 in the (eroded) CSF
+  mask where both exceed the threshold,
+- R1 (1/s): 1000 / T1 for T1 within [t1_low, t1_high], NaN elsewhere,
+- concentration (mmol/L): (1/T1 - 1/T1_0) / r1 within the intracranial mask,
+  where T1_0 is the hybrid T1 of the reference session.
+
+The masks and the reference session are read once, and every session is
+processed in slabs along the first axis, so that no full-size temporaries are
+created besides the outputs. The hybrid and R1 maps are only written if
+requested.
+"""
+
+from pathlib import Path
+from typing import Optional
+
+import click
+import numpy as np
+from loguru import logger
+
+from nifti_io import erode_ball, load_nifti, save_nifti
+
+
+def hybrid_t1(ll: np.ndarray, mixed: np.ndarray, csf_mask: np.ndarray, threshold: float) -> np.ndarray:
+    use_mixed = csf_mask & (ll > threshold) & (mixed > threshold)
+    return np.where(use_mixed, mixed, ll)
+
+
+def t1_to_r1(T1: np.ndarray, t1_low: float, t1_high: float, scale: float = 1000.0) -> np.ndarray:
+    valid = (t1_low <= T1) & (T1 <= t1_high)
+    R1 = np.full(T1.shape, np.nan, dtype=np.float32)
+    R1[valid] = scale / T1[valid]
+    return R1
+
+
+def concentration(T1: np.ndarray, T1_0: np.ndarray, mask: np.ndarray, r1: float) -> np.ndarray:
+    valid = mask & (T1_0 > 1e-10) & (T1 > 1e-10)
+    C = np.full(T1.shape, np.nan, dtype=np.float32)
+    C[valid] = 1 / r1 * (1 / T1[valid] - 1 / T1_0[valid])
+    return C
+
+
+def slabs(size: int, chunk_size: int) -> list[slice]:
+    return [slice(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def process_session(
+    ll: np.ndarray,
+    mixed: np.ndarray,
+    reference: np.ndarray,
+    csf_mask: np.ndarray,
+    mask: np.ndarray,
+    threshold: float,
+    r1: float,
+    t1_low: float,
+    t1_high: float,
+    chunk_size: int,
+    with_R1: bool = False,
+) -> tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    hybrid = np.empty(ll.shape, dtype=np.float32)
+    C = np.empty(ll.shape, dtype=np.float32)
+    R1 = np.empty(ll.shape, dtype=np.float32) if with_R1 else None
+    for s in slabs(ll.shape[0], chunk_size):
+        hybrid[s] = hybrid_t1(
+            np.asarray(ll[s], dtype=np.float32), np.asarray(mixed[s], dtype=np.float32), csf_mask[s], threshold
+        )
+        C[s] = concentration(hybrid[s], reference[s], mask[s], r1)
+        if R1 is not None:
+            R1[s] = t1_to_r1(hybrid[s], t1_low, t1_high)
+    return hybrid, C, R1
+
+
+@click.command()
+@click.option("--reference", type=(Path, Path), required=True, help="Registered LL and mixed T1 maps of the reference session")
+@click.option("--session", "sessions", type=(Path, Path), multiple=True, required=True, help="Registered LL and mixed T1 maps")
+@click.option("--concentration", "concentrations", type=Path, multiple=True, required=True)
+@click.option("--hybrid", "hybrids", type=Path, multiple=True, help="Output hybrid T1 maps, optional")
+@click.option("--R1", "R1maps", type=Path, multiple=True, help="Output hybrid R1 maps, optional")
+@click.option("--csfmask", type=Path, required=True)
+@click.option("--mask", type=Path, required=True, help="Intracranial mask")
+@click.option("--threshold", type=float, default=1500)
+@click.option("--erode", type=int, default=1)
+@click.option("--r1", type=float, default=0.0032)
+@click.option("--T1_low", "t1_low", type=float, default=200)
+@click.option("--T1_high", "t1_high", type=float, default=10000)
+@click.option("--chunk_size", type=int, default=16, help="Slices per slab")
+def main(
+    reference,
+    sessions,
+    concentrations,
+    hybrids,
+    R1maps,
+    csfmask: Path,
+    mask: Path,
+    threshold: float,
+    erode: int,
+    r1: float,
+    t1_low: float,
+    t1_high: float,
+    chunk_size: int,
+):
+    for name, outputs in (("--concentration", concentrations), ("--hybrid", hybrids), ("--R1", R1maps)):
+        if outputs and len(outputs) != len(sessions):
+            raise click.UsageError(f"Expected one {name} per --session")
+
+    csf_mask_data, affine = load_nifti(csfmask)
+    csf_mask = erode_ball(np.asarray(csf_mask_data).astype(bool), erode)
+    mask_data = np.asarray(load_nifti(mask)[0]).astype(bool)
+    ll_0, mixed_0 = (load_nifti(path)[0] for path in reference)
+    T1_0 = np.empty(csf_mask.shape, dtype=np.float32)
+    for s in slabs(T1_0.shape[0], chunk_size):
+        T1_0[s] = hybrid_t1(
+            np.asarray(ll_0[s], dtype=np.float32), np.asarray(mixed_0[s], dtype=np.float32), csf_mask[s], threshold
+        )
+
+    for idx, (ll_path, mixed_path) in enumerate(sessions):
+        ll, ll_affine = load_nifti(ll_path)
+        mixed, mixed_affine = load_nifti(mixed_path)
+        if not (ll.shape == mixed.shape == csf_mask.shape) or not (
+            np.allclose(ll_affine, affine) and np.allclose(mixed_affine, affine)
+        ):
+            raise ValueError(f"{ll_path} and {mixed_path} are not on the grid of {csfmask}")
+        hybrid, C, R1 = process_session(
+            ll, mixed, T1_0, csf_mask, mask_data, threshold, r1, t1_low, t1_high, chunk_size, with_R1=bool(R1maps)
+        )
+        save_nifti(concentrations[idx], C, affine)
+        if hybrids:
+            save_nifti(hybrids[idx], hybrid, affine)
+        if R1maps:
+            save_nifti(R1maps[idx], R1, affine)
+        logger.info(f"Wrote {concentrations[idx]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Convert many T1 maps (ms) to R1 maps (1/s) in one process.
+
+Each pair is converted as by `gmri2fem mri t1-to-r1`: R1 = scale / T1 for T1
+within [T1_low, T1_high], and NaN elsewhere. The images are read, converted and
+written on a pool of threads, which overlaps the (de)compression of the files.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import click
+import numpy as np
+from loguru import logger
+
+from nifti_io import load_nifti, save_nifti
+from t1_chain import t1_to_r1
+
+
+def convert(T1map: Path, R1map: Path, t1_low: float, t1_high: float, scale: float) -> Path:
+    T1, affine = load_nifti(T1map, dtype=np.float32)
+    save_nifti(R1map, t1_to_r1(T1, t1_low, t1_high, scale), affine)
+    return R1map
+
+
+@click.command()
+@click.option("--pair", "pairs", type=(Path, Path), multiple=True, required=True, help="Input T1 map and output R1 map")
+@click.option("--scale", type=float, default=1000)
+@click.option("--T1_low", "t1_low", type=float, default=1)
+@click.option("--T1_high", "t1_high", type=float, default=float("Inf"))
+@click.option("--workers", type=int, default=4)
+def main(pairs, scale: float, t1_low: float, t1_high: float, workers: int):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(convert, T1map, R1map, t1_low, t1_high, scale) for T1map, R1map in pairs
+        ]
+        for future in futures:
+            logger.info(f"Wrote {future.result()}")
+
+
+if __name__ == "__main__":
+    main()
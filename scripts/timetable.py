@@ -0,0 +1,88 @@
+"""
+Indexed access to the acquisition times in mri_dataset/timetable.tsv.
+
+The timetable is parsed once into a dictionary keyed by (subject, session,
+sequence_label), with the acquisition time in seconds relative to the injection.
+Parsed timetables are cached per file and modification time, so the module can
+be imported from the Snakefile and resolve timestamps while the DAG is built,
+without starting a new interpreter per rule.
+"""
+
+import csv
+import dataclasses
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import click
+
+
+@dataclasses.dataclass(frozen=True)
+class Timetable:
+    entries: dict[tuple[str, str, str], float]
+
+    def time(self, subject: str, session: str, sequence_label: str) -> float:
+        try:
+            return self.entries[(subject, session, sequence_label)]
+        except KeyError:
+            raise KeyError(
+                f"No '{sequence_label}' entry for {subject} {session} in the timetable"
+            ) from None
+
+    def sessions(self, subject: str, sequence_label: str) -> list[str]:
+        return sorted(
+            session
+            for (entry_subject, session, label) in self.entries
+            if entry_subject == subject and label == sequence_label
+        )
+
+    def times(self, subject: str, sequence_label: str) -> list[float]:
+        """Acquisition times of the sequence for all sessions of the subject, in
+        session order."""
+        return [
+            self.entries[(subject, session, sequence_label)]
+            for session in self.sessions(subject, sequence_label)
+        ]
+
+
+def parse_timetable(path: Path) -> Timetable:
+    entries = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            key = (row["subject"], row["session"], row["sequence_label"])
+            if key in entries:
+                raise ValueError(f"Duplicate timetable entry for {key} in {path}")
+            entries[key] = float(row["acquisition_relative_injection"])
+    return Timetable(entries)
+
+
+@lru_cache(maxsize=8)
+def _cached_timetable(path: str, mtime_ns: int) -> Timetable:
+    return parse_timetable(Path(path))
+
+
+def load_timetable(path: Path) -> Timetable:
+    """Parsed timetable, reused as long as the file is unchanged."""
+    path = Path(path).resolve()
+    return _cached_timetable(str(path), os.stat(path).st_mtime_ns)
+
+
+def write_timestamps(timetable: Path, subject: str, sequence_label: str, output: Path):
+    times = load_timetable(timetable).times(subject, sequence_label)
+    if len(times) == 0:
+        raise ValueError(f"No '{sequence_label}' entries for {subject} in {timetable}")
+    Path(output).parent.mkdir(exist_ok=True, parents=True)
+    Path(output).write_text("".join(f"{time}\n" for time in times))
+
+
+@click.command()
+@click.option("--timetable", type=Path, required=True)
+@click.option("--subject", type=str, required=True)
+@click.option("--sequence_label", type=str, required=True)
+@click.option("--output", type=Path, required=True)
+def main(timetable: Path, subject: str, sequence_label: str, output: Path):
+    write_timestamps(timetable, subject, sequence_label, output)
+
+
+if __name__ == "__main__":
+    main()
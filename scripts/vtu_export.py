@@ -0,0 +1,285 @@
+"""
+Export data.hdf (written by `gmri2fem i2m collect`) to binary, compressed VTU.
+
+The output has the same arrays as `gmri2fem i2m hdf2vtk`: the subdomains,
+parcellations, DTI, FA and MD as cell data, and the (boundary) concentrations at
+every time point as point data named by their time. The arrays are stored in the
+appended section in raw binary, compressed with zlib (default) or lz4 in blocks
+as vtkZLibDataCompressor / vtkLZ4DataCompressor, which ParaView reads directly.
+
+Every array is compressed as soon as it has been read, so only the compressed
+data is kept in memory, and --timestep writes a single time point without reading
+the others. With --pieces N, the cells are split into N contiguous pieces written
+as separate .vtu files, referenced by a .pvtu file with the requested name.
+"""
+
+import dataclasses
+import zlib
+from pathlib import Path
+from typing import Callable, Optional
+from xml.sax.saxutils import quoteattr
+
+import click
+import numpy as np
+from loguru import logger
+
+VTK_TETRA = 10
+BLOCK_SIZE = 2**16
+
+VTK_TYPES = {
+    np.dtype(np.int8): "Int8",
+    np.dtype(np.uint8): "UInt8",
+    np.dtype(np.int32): "Int32",
+    np.dtype(np.uint32): "UInt32",
+    np.dtype(np.int64): "Int64",
+    np.dtype(np.uint64): "UInt64",
+    np.dtype(np.float32): "Float32",
+    np.dtype(np.float64): "Float64",
+}
+
+
+def lz4_compress(data: bytes, level: int) -> bytes:
+    try:
+        import lz4.block
+    except ImportError:
+        raise RuntimeError("lz4 compression requires the 'lz4' package") from None
+    return lz4.block.compress(data, mode="high_compression", compression=level, store_size=False)
+
+
+COMPRESSORS: dict[str, tuple[str, Callable[[bytes, int], bytes]]] = {
+    "zlib": ("vtkZLibDataCompressor", zlib.compress),
+    "lz4": ("vtkLZ4DataCompressor", lz4_compress),
+}
+
+
+def encode_block(array: np.ndarray, compression: Optional[str], level: int) -> bytes:
+    """Appended raw data of one array, with a UInt64 header."""
+    data = np.ascontiguousarray(array).tobytes()
+    if compression is None:
+        return np.array([len(data)], dtype="<u8").tobytes() + data
+    compress = COMPRESSORS[compression][1]
+    blocks = [compress(data[i : i + BLOCK_SIZE], level) for i in range(0, len(data), BLOCK_SIZE)]
+    last = len(data) % BLOCK_SIZE
+    header = [len(blocks), BLOCK_SIZE, last if last else BLOCK_SIZE if data else 0]
+    header += [len(block) for block in blocks]
+    return np.array(header, dtype="<u8").tobytes() + b"".join(blocks)
+
+
+@dataclasses.dataclass
+class EncodedArray:
+    name: str
+    vtk_type: str
+    components: int
+    data: bytes
+
+
+class VTUWriter:
+    """Collects compressed arrays of an unstructured tetrahedral grid."""
+
+    def __init__(self, points: np.ndarray, cells: np.ndarray, compression: Optional[str] = "zlib", level: int = 6):
+        self.compression = compression
+        self.level = level
+        self.num_points = len(points)
+        self.num_cells = len(cells)
+        self.points = self.encode("Points", np.asarray(points, dtype=np.float64))
+        self.cells = [
+            self.encode("connectivity", np.asarray(cells, dtype=np.int64).reshape(-1)),
+            self.encode("offsets", np.arange(1, len(cells) + 1, dtype=np.int64) * cells.shape[1]),
+            self.encode("types", np.full(len(cells), VTK_TETRA, dtype=np.uint8)),
+        ]
+        self.point_data: list[EncodedArray] = []
+        self.cell_data: list[EncodedArray] = []
+
+    def encode(self, name: str, array: np.ndarray) -> EncodedArray:
+        array = np.asarray(array)
+        if array.dtype not in VTK_TYPES:
+            array = array.astype(np.float64)
+        components = 1 if array.ndim == 1 else int(np.prod(array.shape[1:]))
+        return EncodedArray(name, VTK_TYPES[array.dtype], components, encode_block(array, self.compression, self.level))
+
+    def add_point_data(self, name: str, values: np.ndarray):
+        if len(values) != self.num_points:
+            raise ValueError(f"Point data '{name}' has {len(values)} values, expected {self.num_points}")
+        self.point_data.append(self.encode(name, values))
+
+    def add_cell_data(self, name: str, values: np.ndarray):
+        if len(values) != self.num_cells:
+            raise ValueError(f"Cell data '{name}' has {len(values)} values, expected {self.num_cells}")
+        self.cell_data.append(self.encode(name, values))
+
+    def write(self, path: Path):
+        offset = 0
+        blocks = []
+
+        def data_array(array: EncodedArray) -> str:
+            nonlocal offset
+            xml = (
+                f'<DataArray type="{array.vtk_type}" Name={quoteattr(array.name)}'
+                f' NumberOfComponents="{array.components}" format="appended" offset="{offset}"/>'
+            )
+            offset += len(array.data)
+            blocks.append(array.data)
+            return xml
+
+        compressor = f' compressor="{COMPRESSORS[self.compression][0]}"' if self.compression else ""
+        lines = [
+            '<?xml version="1.0"?>',
+            f'<VTKFile type="UnstructuredGrid" version="1.0" byte_order="LittleEndian" header_type="UInt64"{compressor}>',
+            "<UnstructuredGrid>",
+            f'<Piece NumberOfPoints="{self.num_points}" NumberOfCells="{self.num_cells}">',
+            "<PointData>",
+            *[data_array(array) for array in self.point_data],
+            "</PointData>",
+            "<CellData>",
+            *[data_array(array) for array in self.cell_data],
+            "</CellData>",
+            "<Points>",
+            data_array(self.points),
+            "</Points>",
+            "<Cells>",
+            *[data_array(array) for array in self.cells],
+            "</Cells>",
+            "</Piece>",
+            "</UnstructuredGrid>",
+            '<AppendedData encoding="raw">',
+        ]
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, "wb") as f:
+            f.write(("\n".join(lines) + "\n_").encode())
+            for block in blocks:
+                f.write(block)
+            f.write(b"\n</AppendedData>\n</VTKFile>\n")
+
+
+def write_pvtu(path: Path, pieces: list[Path], writer: VTUWriter):
+    def declarations(arrays: list[EncodedArray]) -> list[str]:
+        return [
+            f'<PDataArray type="{a.vtk_type}" Name={quoteattr(a.name)} NumberOfComponents="{a.components}"/>'
+            for a in arrays
+        ]
+
+    lines = [
+        '<?xml version="1.0"?>',
+        '<VTKFile type="PUnstructuredGrid" version="1.0" byte_order="LittleEndian" header_type="UInt64">',
+        '<PUnstructuredGrid GhostLevel="0">',
+        "<PPointData>",
+        *declarations(writer.point_data),
+        "</PPointData>",
+        "<PCellData>",
+        *declarations(writer.cell_data),
+        "</PCellData>",
+        "<PPoints>",
+        '<PDataArray type="Float64" NumberOfComponents="3"/>',
+        "</PPoints>",
+        *[f"<Piece Source={quoteattr(piece.name)}/>" for piece in pieces],
+        "</PUnstructuredGrid>",
+        "</VTKFile>",
+    ]
+    path.write_text("\n".join(lines) + "\n")
+
+
+def partition(cells: np.ndarray, num_pieces: int) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Split the cells into contiguous pieces, returning for each piece the cell
+    indices, the (global) point indices and the renumbered connectivity."""
+    pieces = []
+    for cell_ids in np.array_split(np.arange(len(cells)), num_pieces):
+        point_ids, local = np.unique(cells[cell_ids], return_inverse=True)
+        pieces.append((cell_ids, point_ids, local.reshape(-1, cells.shape[1])))
+    return pieces
+
+
+@dataclasses.dataclass
+class MeshData:
+    points: np.ndarray
+    cells: np.ndarray
+    point_data: Callable[[], list[tuple[str, np.ndarray]]]
+    cell_data: Callable[[], list[tuple[str, np.ndarray]]]
+
+
+def cell_values(values: np.ndarray, cell_dofs: np.ndarray) -> np.ndarray:
+    """Values of a DG0 function in cell order, from its dof values and the dofs of
+    every cell (cells x components), as the dofs need not be numbered like the cells."""
+    if cell_dofs.shape[1] == 1:
+        return values[cell_dofs[:, 0]]
+    return values[cell_dofs]
+
+
+def read_data_hdf(path: Path, timestep: Optional[int] = None) -> MeshData:
+    """Mesh and (lazily read) data of data.hdf, reading either all time points or
+    only the given one."""
+    import dolfin as df
+    import panta_rhei as pr
+
+    hdf = df.HDF5File(df.MPI.comm_world, str(path), "r")
+    domain = pr.read_domain(hdf)
+    cells = domain.cells()
+
+    def point_data():
+        for funcname, label in (("concentration", "concentration"), ("boundary_concentration", "boundary-concentration")):
+            times = pr.read_timevector(hdf, funcname)
+            indices = range(len(times)) if timestep is None else [timestep]
+            for idx in indices:
+                u = pr.read_function(hdf, funcname, domain, idx)
+                yield f"{label}-{int(times[idx])}", u.compute_vertex_values()
+
+    def cell_data():
+        yield "subdomains", domain.subdomains.array()
+        parcellations = df.MeshFunction("size_t", domain, 3)
+        hdf.read(parcellations, "parcellations")
+        yield "parcellations", parcellations.array()
+        for name, funcname in [("dt", "DTI"), ("fa", "FA"), ("md", "MD")]:
+            u = pr.read_function(hdf, funcname, domain)
+            dofs = u.function_space().dofmap().entity_dofs(domain, domain.topology().dim())
+            yield name, cell_values(u.vector()[:], np.reshape(dofs, (len(cells), -1)))
+
+    return MeshData(domain.coordinates(), cells, point_data, cell_data)
+
+
+def export(
+    data: MeshData,
+    output: Path,
+    compression: Optional[str] = "zlib",
+    level: int = 6,
+    pieces: int = 1,
+):
+    if pieces <= 1:
+        writer = VTUWriter(data.points, data.cells, compression, level)
+        for name, values in data.point_data():
+            writer.add_point_data(name, values)
+        for name, values in data.cell_data():
+            writer.add_cell_data(name, values)
+        writer.write(output)
+        logger.info(f"Wrote {output}")
+        return
+
+    parts = partition(data.cells, pieces)
+    writers = [VTUWriter(data.points[point_ids], local, compression, level) for _, point_ids, local in parts]
+    for name, values in data.point_data():
+        for writer, (_, point_ids, _) in zip(writers, parts):
+            writer.add_point_data(name, values[point_ids])
+    for name, values in data.cell_data():
+        for writer, (cell_ids, _, _) in zip(writers, parts):
+            writer.add_cell_data(name, values[cell_ids])
+    piece_paths = [output.with_name(f"{output.stem}_{idx}.vtu") for idx in range(pieces)]
+    for writer, path in zip(writers, piece_paths):
+        writer.write(path)
+    write_pvtu(output, piece_paths, writers[0])
+    logger.info(f"Wrote {output} with {pieces} pieces")
+
+
+@click.command()
+@click.option("--input", "hdf_data", type=Path, required=True)
+@click.option("--output", type=Path, required=True, help="Output .vtu, or .pvtu with --pieces")
+@click.option("--compression", type=click.Choice(["zlib", "lz4", "none"]), default="zlib")
+@click.option("--level", type=int, default=6, help="Compression level")
+@click.option("--pieces", type=int, default=1, help="Number of pieces of a parallel .pvtu")
+@click.option("--timestep", type=int, help="Only write this time point")
+def main(hdf_data: Path, output: Path, compression: str, level: int, pieces: int, timestep: Optional[int]):
+    if pieces > 1 and output.suffix != ".pvtu":
+        raise click.UsageError("Use a .pvtu output with --pieces")
+    data = read_data_hdf(hdf_data, timestep)
+    export(data, output, None if compression == "none" else compression, level, pieces)
+
+
+if __name__ == "__main__":
+    main()
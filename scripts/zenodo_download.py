@@ -1,18 +1,30 @@
 import argparse
 import dataclasses
+import hashlib
+import http.client
 import json
-from urllib import request
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+from urllib import error, request
 
 
 @dataclasses.dataclass
 class Settings:
     api_url: str = "https://zenodo.org/api/deposit/depositions/14266867"
+    workers: int = 4
+    chunk_size: int = 2**20
+    retries: int = 5
+    # Seconds without data before a connection attempt or read is abandoned.
+    timeout: float = 60.0
 
 
 def get_file_list(settings: Settings) -> list[dict[str, str]]:
     url = f"{settings.api_url}/files"
     
-    with request.urlopen(url) as response:
+    with request.urlopen(url, timeout=settings.timeout) as response:
         return json.loads(response.read().decode())
 
 
@@ -29,10 +41,95 @@ def find_file_id(filename: str, files: list[dict[str, str]], settings: Settings)
     return file_ids[0]
 
 
-def download_single_file(file_download_url: str, output: str, settings: Settings):
-    with request.urlopen(file_download_url) as response:
-        with open(output, "wb") as f:
-            f.write(response.read())
+def md5sum(path: Path, settings: Settings) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(settings.chunk_size):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def normalize_checksum(checksum: Optional[str]) -> Optional[str]:
+    # The records API prefixes the checksum with the algorithm, e.g. "md5:...".
+    if checksum is None:
+        return None
+    return checksum.removeprefix("md5:")
+
+
+def fetch_to_part(file_download_url: str, part: Path, settings: Settings):
+    """Stream the file into the .part file, continuing from its current size with
+    an HTTP Range request. Servers that ignore the range restart the file."""
+    offset = part.stat().st_size if part.exists() else 0
+    req = request.Request(file_download_url)
+    if offset > 0:
+        req.add_header("Range", f"bytes={offset}-")
+    try:
+        response = request.urlopen(req, timeout=settings.timeout)
+    except error.HTTPError as e:
+        if e.code == 416:  # The .part file is already complete.
+            return
+        raise
+    with response:
+        resumed = response.status == 206
+        length = int(response.headers.get("Content-Length", -1))
+        total = offset + length if resumed and length >= 0 else length
+        mode = "ab" if resumed else "wb"
+        with open(part, mode) as f:
+            while chunk := response.read(settings.chunk_size):
+                f.write(chunk)
+    if 0 <= total != part.stat().st_size:
+        raise ConnectionError(f"Connection closed after {part.stat().st_size} of {total} bytes")
+
+
+def download_single_file(
+    file_download_url: str, output: str, settings: Settings, checksum: Optional[str] = None
+):
+    """Download to `output`.part, resuming after dropped connections, and move it
+    into place once the MD5 checksum (if given) matches. An existing output with
+    a matching checksum is not downloaded again."""
+    output = Path(output)
+    checksum = normalize_checksum(checksum)
+    if output.exists() and checksum is not None and md5sum(output, settings) == checksum:
+        print(f"{output.name} already downloaded.")
+        return
+    part = output.with_name(output.name + ".part")
+    resumed = part.exists()
+    for attempt in range(settings.retries + 1):
+        try:
+            fetch_to_part(file_download_url, part, settings)
+            break
+        # socket.timeout is only an alias of TimeoutError from Python 3.10 on.
+        except (error.URLError, http.client.HTTPException, ConnectionError, TimeoutError, socket.timeout) as e:
+            if isinstance(e, error.HTTPError) and e.code < 500:
+                raise
+            if attempt == settings.retries:
+                raise
+            print(f"Download of {output.name} interrupted ({e}), resuming.")
+
+    if checksum is not None and (actual := md5sum(part, settings)) != checksum:
+        part.unlink()
+        if resumed:
+            # The .part file left by an earlier run may have been corrupt.
+            print(f"Checksum mismatch for resumed {output.name}, downloading it again.")
+            return download_single_file(file_download_url, output, settings, checksum)
+        raise ValueError(f"Checksum mismatch for {output.name}: expected {checksum}, got {actual}")
+    os.replace(part, output)
+
+
+def download_files(files: list[dict], output_dir: str, settings: Settings):
+    def download(file):
+        print(f"Downloading file {file['filename']}")
+        download_single_file(
+            file["links"]["download"],
+            f"{output_dir}/{file['filename']}",
+            settings,
+            file.get("checksum"),
+        )
+
+    Path(output_dir).mkdir(exist_ok=True, parents=True)
+    with ThreadPoolExecutor(max_workers=settings.workers) as executor:
+        # Consume the results to re-raise any failed download.
+        list(executor.map(download, files))
 
 
 def list_all_files(files: list[dict[str, str]]):
@@ -74,9 +171,27 @@ def main():
         action="store_true",
         help="List files in record, without downloading.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=Settings.workers,
+        help="Number of files downloaded concurrently.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=Settings.timeout,
+        help="Seconds to wait for data before retrying a download.",
+    )
+    parser.add_argument(
+        "--api_url",
+        type=str,
+        default=Settings.api_url,
+        help="Deposition API URL.",
+    )
     args = validate_input(parser)
 
-    settings = Settings()
+    settings = Settings(api_url=args.api_url, workers=args.workers, timeout=args.timeout)
     files = get_file_list(settings)
     if args.ls:
         list_all_files(files)
@@ -89,11 +204,7 @@ def main():
         if len(files) == 0:
             raise ValueError(f"Couldn't find {args.filename} in deposition")
 
-    for file in files:
-        print(f"Downloading file {file['filename']}")
-        download_single_file(
-            file["links"]["download"], f"{args.output}/{file['filename']}", settings
-        )
+    download_files(files, args.output, settings)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,37 @@
+import json
+
+import numpy as np
+from click.testing import CliRunner
+
+import benchmark
+
+
+def test_duplicate_sizes_are_measured_once(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_measure(name, size, repeats, seed):
+        calls.append((name, size))
+        voxels = benchmark.voxel_count(name, size)
+        return {"kernel": name, "voxels": voxels, "wall_time_s": 1.0, "peak_memory_mb": 1.0, "voxels_per_s": voxels}
+
+    monkeypatch.setattr(benchmark, "measure_in_subprocess", fake_measure)
+    history = tmp_path / "history.json"
+    result = CliRunner().invoke(
+        benchmark.main,
+        [
+            "--kernel", "compute_c", "--kernel", "T1_lookup_table",
+            "--size", "1e3", "--size", "1000", "--size", "1000.4", "--size", "2e3",
+            "--history", str(history), "--baseline", str(tmp_path / "baseline.json"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    # The lookup table has the same number of voxels for every size.
+    assert calls == [("compute_c", 1000), ("compute_c", 2000), ("T1_lookup_table", 1000)]
+    records = json.loads(history.read_text())[0]["results"]
+    assert [(r["kernel"], r["voxels"]) for r in records] == [("compute_c", 1000), ("compute_c", 2000), ("T1_lookup_table", 10000)]
+
+
+def test_voxel_count_matches_setup():
+    for name, (setup, _, _) in benchmark.KERNELS.items():
+        _, voxels = setup(10, np.random.default_rng(0))
+        assert voxels == benchmark.voxel_count(name, 10), name
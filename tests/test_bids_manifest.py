@@ -0,0 +1,129 @@
+import json
+import os
+
+import pytest
+
+import bids_manifest
+from bids_manifest import DirectoryListing, leaf_templates, load_manifest, subject_leaves
+
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("")
+
+
+def bump_mtime(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    root = tmp_path / "mri_dataset"
+    for subject in ["sub-01", "sub-02"]:
+        for session in ["ses-01", "ses-02"]:
+            touch(root / subject / session / "anat" / f"{subject}_{session}_T1w.nii.gz")
+    touch(root / "sub-01" / "ses-01" / "dwi" / "sub-01_ses-01_dwi.nii.gz")
+    touch(root / "timetable.tsv")
+    return root, tmp_path / ".snakemake" / "bids-manifest.json"
+
+
+@pytest.fixture
+def scans(monkeypatch):
+    scanned = []
+    scan_subject = bids_manifest.scan_subject
+    monkeypatch.setattr(bids_manifest, "scan_subject", lambda root, subject: scanned.append(subject) or scan_subject(root, subject))
+    return scanned
+
+
+def test_manifest_contents(dataset):
+    root, cache = dataset
+    manifest = load_manifest(root, cache)
+    assert manifest.subjects == ["sub-01", "sub-02"]
+    assert manifest.sessions("sub-01") == ["ses-01", "ses-02"]
+    assert manifest.files("sub-01", "ses-01") == ["anat/sub-01_ses-01_T1w.nii.gz", "dwi/sub-01_ses-01_dwi.nii.gz"]
+    assert manifest.has("sub-02", "ses-02", "anat/sub-02_ses-02_T1w.nii.gz")
+    assert not manifest.has("sub-02", "ses-03", "anat/sub-02_ses-03_T1w.nii.gz")
+    assert json.loads(cache.read_text())["version"] == bids_manifest.MANIFEST_VERSION
+    assert list(cache.parent.iterdir()) == [cache]
+
+
+def test_unknown_subject(dataset):
+    manifest = load_manifest(*dataset)
+    with pytest.raises(ValueError, match="No subject sub-03 in .*; found sub-01, sub-02"):
+        manifest.sessions("sub-03")
+
+
+def test_only_changed_subjects_are_rescanned(dataset, scans):
+    root, cache = dataset
+    load_manifest(root, cache)
+    assert scans == ["sub-01", "sub-02"]
+
+    scans.clear()
+    written = os.stat(cache).st_mtime_ns
+    load_manifest(root, cache)
+    assert scans == []
+    assert os.stat(cache).st_mtime_ns == written
+
+    touch(root / "sub-02" / "ses-01" / "anat" / "sub-02_ses-01_T2w.nii.gz")
+    bump_mtime(root / "sub-02" / "ses-01" / "anat")
+    manifest = load_manifest(root, cache)
+    assert scans == ["sub-02"]
+    assert manifest.has("sub-02", "ses-01", "anat/sub-02_ses-01_T2w.nii.gz")
+
+    scans.clear()
+    touch(root / "sub-03" / "ses-01" / "anat" / "sub-03_ses-01_T1w.nii.gz")
+    bump_mtime(root)
+    manifest = load_manifest(root, cache)
+    assert scans == ["sub-03"]
+    assert manifest.subjects == ["sub-01", "sub-02", "sub-03"]
+
+
+def test_corrupt_cache_is_rebuilt(dataset, scans):
+    root, cache = dataset
+    cache.parent.mkdir(parents=True)
+    cache.write_text("{")
+    assert load_manifest(root, cache).subjects == ["sub-01", "sub-02"]
+    assert scans == ["sub-01", "sub-02"]
+    assert json.loads(cache.read_text())["subjects"].keys() == {"sub-01", "sub-02"}
+
+
+def test_leaf_templates_round_trip():
+    sessions = ["ses-01", "ses-02", "ses-03"]
+    leaves = [
+        "mri_processed_data/sub-01/registered/sub-01_ses-01_T1w_registered.nii.gz",
+        *[f"mri_processed_data/sub-01/concentrations/sub-01_{s}_concentration.nii.gz" for s in sessions],
+        "mri_processed_data/sub-01/dti/sub-01_ses-02_dti.nii.gz",
+        "mri_processed_data/sub-01/modeling/resolution32/data.hdf",
+    ]
+    templates = leaf_templates(leaves, "sub-01", sessions)
+    assert templates == [
+        "mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+        "mri_processed_data/{subject}/concentrations/{subject}_{session}_concentration.nii.gz",
+        "mri_processed_data/{subject}/dti/{subject}_ses-02_dti.nii.gz",
+        "mri_processed_data/{subject}/modeling/resolution32/data.hdf",
+    ]
+    assert subject_leaves(templates, "sub-01", sessions) == leaves
+    assert subject_leaves(templates, "sub-02", ["ses-01", "ses-02"]) == [
+        "mri_processed_data/sub-02/registered/sub-02_ses-01_T1w_registered.nii.gz",
+        "mri_processed_data/sub-02/concentrations/sub-02_ses-01_concentration.nii.gz",
+        "mri_processed_data/sub-02/concentrations/sub-02_ses-02_concentration.nii.gz",
+        "mri_processed_data/sub-02/dti/sub-02_ses-02_dti.nii.gz",
+        "mri_processed_data/sub-02/modeling/resolution32/data.hdf",
+    ]
+
+
+def test_directory_listing(tmp_path, monkeypatch):
+    touch(tmp_path / "a" / "one.nii.gz")
+    touch(tmp_path / "a" / "two.nii.gz")
+    listed = []
+    listdir = os.listdir
+    monkeypatch.setattr(bids_manifest.os, "listdir", lambda path: listed.append(path) or listdir(path))
+
+    listing = DirectoryListing()
+    assert listing.exists(tmp_path / "a" / "one.nii.gz")
+    assert listing.exists(str(tmp_path / "a" / "two.nii.gz"))
+    assert not listing.exists(tmp_path / "a" / "three.nii.gz")
+    assert not listing.exists(tmp_path / "missing" / "one.nii.gz")
+    assert not listing.exists(tmp_path / "missing" / "two.nii.gz")
+    assert listed == [tmp_path / "a", tmp_path / "missing"]
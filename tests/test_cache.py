@@ -0,0 +1,85 @@
+import importlib.util
+import os
+
+import numpy as np
+
+import cache
+from cache import CacheSettings, cache_key, cached, configure_cache
+
+
+def load_module(path, source):
+    path.write_text(source)
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_key_changes_with_params_and_source(tmp_path):
+    a = load_module(tmp_path / "model_a.py", "def model(x):\n    return x + 1\n")
+    b = load_module(tmp_path / "model_b.py", "def model(x):\n    return x + 2\n")
+    same = load_module(tmp_path / "model_c.py", "def model(x):\n    return x + 1\n")
+    params = {"snr": 25, "samples": 200}
+
+    key = cache_key(params, (a.model,))
+    assert cache_key(dict(reversed(params.items())), (a.model,)) == key
+    assert cache_key(params, (same.model,)) == key
+    assert cache_key(params, (b.model,)) != key
+    assert cache_key({**params, "snr": 50}, (a.model,)) != key
+    assert cache_key(params, (a.model, b.model)) != key
+
+
+def test_hit_and_miss(tmp_path):
+    settings = CacheSettings(directory=tmp_path / "cache")
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return np.arange(6.0).reshape(2, 3)
+
+    first = cached(compute, {"snr": 25}, settings=settings)
+    second = cached(compute, {"snr": 25}, settings=settings)
+    assert len(calls) == 1
+    assert np.array_equal(first, second)
+    assert isinstance(second, np.memmap)
+    cached(compute, {"snr": 50}, settings=settings)
+    assert len(calls) == 2
+    assert len(list(settings.directory.glob("*.npy"))) == 2
+    assert not list(settings.directory.glob("*.tmp"))
+
+
+def test_no_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "SETTINGS", CacheSettings(directory=tmp_path / "cache"))
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return np.zeros(3)
+
+    # As the scripts do for --no_cache.
+    configure_cache(enabled=False)
+    cached(compute, {"snr": 25}, settings=cache.SETTINGS)
+    cached(compute, {"snr": 25}, settings=cache.SETTINGS)
+    assert len(calls) == 2
+    assert not (tmp_path / "cache").exists()
+
+
+def test_evicts_least_recently_used(tmp_path):
+    settings = CacheSettings(directory=tmp_path / "cache", max_bytes=10**9)
+    for idx, name in enumerate(["a", "b", "c"]):
+        cached(lambda: np.full(1000, float(idx)), {"name": name}, settings=settings)
+        path = settings.directory / f"{cache_key({'name': name})}.npy"
+        os.utime(path, (1000 + idx, 1000 + idx))
+    size = (settings.directory / f"{cache_key({'name': 'a'})}.npy").stat().st_size
+
+    # Reading "a" makes it the most recently used, so "b" is evicted first.
+    cached(lambda: None, {"name": "a"}, settings=settings)
+    settings.max_bytes = 3 * size
+    cached(lambda: np.zeros(1000), {"name": "d"}, settings=settings)
+    remaining = {path.stem for path in settings.directory.glob("*.npy")}
+    assert remaining == {cache_key({"name": name}) for name in ["a", "c", "d"]}
+
+    settings.max_bytes = size
+    cached(lambda: np.ones(1000), {"name": "e"}, settings=settings)
+    remaining = {path.stem for path in settings.directory.glob("*.npy")}
+    assert remaining == {cache_key({"name": "e"})}
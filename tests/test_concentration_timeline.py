@@ -0,0 +1,59 @@
+import numpy as np
+from click.testing import CliRunner
+
+import concentration_timeline
+from concentration_timeline import Timeline
+from nifti_io import save_nifti
+
+
+def test_create_and_append(tmp_path):
+    rng = np.random.default_rng(0)
+    mask = np.zeros((4, 5, 6), dtype=np.uint8)
+    mask[1:3, 1:4, 2:5] = 1
+    affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    save_nifti(tmp_path / "mask.nii.gz", mask, affine)
+    images = {}
+    for session in ["ses-01", "ses-02", "ses-03"]:
+        images[session] = rng.normal(size=mask.shape).astype(np.float32)
+        save_nifti(tmp_path / f"sub-01_{session}_concentration.nii.gz", images[session], affine)
+    (tmp_path / "timetable.tsv").write_text(
+        "subject\tsession\tsequence_label\tacquisition_relative_injection\n"
+        "sub-01\tses-01\tlooklocker\t-100.0\n"
+        "sub-01\tses-02\tlooklocker\t3600.0\n"
+        "sub-01\tses-03\tlooklocker\t600.0\n"
+    )
+    store = tmp_path / "timeline" / "sub-01_concentration-timeline.h5"
+    runner = CliRunner()
+
+    def run(*args):
+        result = runner.invoke(concentration_timeline.main, ["--store", str(store), "--mask", str(tmp_path / "mask.nii.gz"), *args])
+        assert result.exit_code == 0, result.output
+
+    run()
+    with Timeline(store) as timeline:
+        assert timeline.sessions == []
+        assert timeline.trajectories().shape == (0, mask.sum())
+
+    for session in ["ses-01", "ses-02", "ses-03", "ses-02"]:
+        run("--image", str(tmp_path / f"sub-01_{session}_concentration.nii.gz"), "--timetable", str(tmp_path / "timetable.tsv"))
+
+    with Timeline(store) as timeline:
+        assert timeline.sessions == ["ses-01", "ses-03", "ses-02"]
+        assert list(timeline.times) == [-100.0, 600.0, 3600.0]
+        for idx, session in enumerate(timeline.sessions):
+            volume = timeline.time_slice(idx)
+            assert np.array_equal(volume[mask > 0], images[session][mask > 0])
+            assert np.isnan(volume[mask == 0]).all()
+        voxels = np.flatnonzero(mask)[[4, 0, 4]]
+        expected = np.stack([images[s].reshape(-1)[voxels] for s in timeline.sessions])
+        assert np.array_equal(timeline.trajectories(voxels), expected)
+
+
+def test_append_requires_timetable(tmp_path):
+    save_nifti(tmp_path / "mask.nii.gz", np.ones((2, 2, 2), dtype=np.uint8), np.eye(4))
+    result = CliRunner().invoke(
+        concentration_timeline.main,
+        ["--store", str(tmp_path / "store.h5"), "--mask", str(tmp_path / "mask.nii.gz"), "--image", str(tmp_path / "mask.nii.gz")],
+    )
+    assert result.exit_code != 0
+    assert "--timetable" in result.output
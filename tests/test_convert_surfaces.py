@@ -0,0 +1,88 @@
+import nibabel
+import nibabel.freesurfer
+import numpy as np
+import pytest
+import scipy.spatial.transform
+
+from convert_surfaces import STL_TRIANGLE, convert_surface, tkr_to_scanner, write_stl
+
+
+def oblique_mgh() -> nibabel.MGHImage:
+    rotation = scipy.spatial.transform.Rotation.from_euler("xyz", [12, -20, 35], degrees=True).as_matrix()
+    affine = np.eye(4)
+    affine[:3, :3] = rotation * [1.0, 1.2, 0.9]
+    affine[:3, 3] = [-80.0, 95.0, -40.0]
+    return nibabel.MGHImage(np.zeros((64, 70, 60), dtype=np.float32), affine)
+
+
+def volume_info(image: nibabel.MGHImage) -> dict:
+    header = image.header
+    zooms = np.array(header.get_zooms()[:3])
+    directions = header.get_vox2ras()[:3, :3] / zooms
+    return {
+        "head": np.array([2, 0, 20], dtype=np.int32),
+        "valid": "1  # volume info valid",
+        "filename": "orig.mgz",
+        "volume": np.array(image.shape, dtype=np.int64),
+        "voxelsize": zooms,
+        "xras": directions[:, 0],
+        "yras": directions[:, 1],
+        "zras": directions[:, 2],
+        "cras": np.asarray(header["Pxyz_c"], dtype=float),
+    }
+
+
+def test_tkr_to_scanner_matches_mgh_header():
+    image = oblique_mgh()
+    header = image.header
+    expected = header.get_vox2ras() @ np.linalg.inv(header.get_vox2ras_tkr())
+    assert np.allclose(tkr_to_scanner(volume_info(image)), expected, atol=1e-5)
+
+
+def test_tkr_to_scanner_requires_valid_geometry():
+    with pytest.raises(ValueError, match="no valid volume geometry"):
+        tkr_to_scanner({"valid": "0  # volume info invalid"})
+
+
+def read_stl(path):
+    with open(path, "rb") as f:
+        header = f.read(80)
+        count = int(np.frombuffer(f.read(4), dtype="<u4")[0])
+        triangles = np.fromfile(f, dtype=STL_TRIANGLE)
+    assert len(triangles) == count
+    return header, triangles
+
+
+def test_write_stl_round_trip(tmp_path):
+    vertices = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 2.0, 0.0], [0.0, 0.0, 3.0], [2.0, 0.0, 0.0]])
+    # The last face is degenerate, and gets a zero normal.
+    faces = np.array([[0, 1, 2], [0, 3, 1], [0, 2, 3], [0, 1, 4]])
+    write_stl(tmp_path / "surface.stl", vertices, faces, header="lh.pial")
+
+    header, triangles = read_stl(tmp_path / "surface.stl")
+    assert header == b"lh.pial".ljust(80)
+    assert np.array_equal(triangles["vertices"], vertices[faces].astype(np.float32))
+    assert np.allclose(triangles["normal"], [[0, 0, 1], [0, 1, 0], [1, 0, 0], [0, 0, 0]])
+    assert not triangles["attribute"].any()
+
+    vtk = pytest.importorskip("vtk")
+    reader = vtk.vtkSTLReader()
+    reader.SetFileName(str(tmp_path / "surface.stl"))
+    reader.Update()
+    assert reader.GetOutput().GetNumberOfCells() == len(faces)
+
+
+def test_convert_surface(tmp_path):
+    image = oblique_mgh()
+    rng = np.random.default_rng(0)
+    vertices = rng.uniform(-50, 50, size=(20, 3))
+    faces = np.array([[i, (i + 1) % 20, (i + 7) % 20] for i in range(20)], dtype=np.int32)
+    nibabel.freesurfer.write_geometry(tmp_path / "lh.pial", vertices, faces, volume_info=volume_info(image))
+
+    convert_surface(tmp_path / "lh.pial", tmp_path / "lh_pial.stl")
+
+    header = image.header
+    transform = header.get_vox2ras() @ np.linalg.inv(header.get_vox2ras_tkr())
+    scanner = vertices @ transform[:3, :3].T + transform[:3, 3]
+    _, triangles = read_stl(tmp_path / "lh_pial.stl")
+    assert np.allclose(triangles["vertices"], scanner[faces], atol=1e-3)
@@ -0,0 +1,35 @@
+import numpy as np
+
+import label_index
+from nifti_io import save_nifti
+
+
+def test_label_index_is_cached_in_cache_dir(tmp_path, monkeypatch):
+    seg = np.zeros((4, 5, 6), dtype=np.int16)
+    seg[1:3, 1:4, 2:5] = 7
+    seg[0, 0, 0] = 3
+    segdir = tmp_path / "segmentations"
+    save_nifti(segdir / "seg.nii.gz", seg, np.eye(4))
+    cache_dir = tmp_path / "cache"
+
+    index = label_index.load_label_index(segdir / "seg.nii.gz", cache_dir)
+    assert [p.name for p in segdir.iterdir()] == ["seg.nii.gz"]
+    assert [p.name for p in cache_dir.iterdir()] == ["seg.labelindex.npz"]
+    assert list(index.labels) == [3, 7]
+    assert np.array_equal(index.mask(7), seg == 7)
+    assert index.bbox(7) == (slice(1, 3), slice(1, 4), slice(2, 5))
+
+    # A second load reads the cache instead of the segmentation.
+    monkeypatch.setattr(label_index, "load_nifti", None)
+    cached = label_index.load_label_index(segdir / "seg.nii.gz", cache_dir)
+    assert np.array_equal(cached.voxels, index.voxels)
+    assert np.array_equal(cached.offsets, index.offsets)
+
+
+def test_label_index_without_cache_dir(tmp_path):
+    seg = np.zeros((3, 3, 3), dtype=np.int16)
+    seg[1, 1, 1] = 5
+    save_nifti(tmp_path / "seg.nii", seg, np.eye(4))
+    index = label_index.load_label_index(tmp_path / "seg.nii")
+    assert list(index.voxels) == [13]
+    assert [p.name for p in tmp_path.iterdir()] == ["seg.nii"]
@@ -0,0 +1,91 @@
+import warnings
+
+import numpy as np
+import pytest
+from scipy.optimize import curve_fit
+
+from look_locker import curve_fit_batch, curve_fit_wrapper, grid_initial_guess, levenberg_marquardt_batch
+from plot_noise_look_locker import compute_T1_from_x23, f
+
+
+def noisy_curves(n, snr=25, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 2.6, 14)
+    x2 = np.sqrt(0.5)
+    x3 = np.sqrt((0.1 + x2**2) / rng.uniform(0.5, 4.5, n))
+    y = f(t[None, :], 1.0, x2, x3[:, None])
+    scale = np.max(y, axis=1, keepdims=True) / snr
+    return t, y + np.sqrt(rng.normal(0, scale, y.shape) ** 2 + rng.normal(0, scale, y.shape) ** 2)
+
+
+def wrapper_fits(t, Y):
+    return np.array([curve_fit_wrapper(f, t, y, None) for y in Y])
+
+
+def test_levenberg_marquardt_batch_matches_curve_fit():
+    t, Y = noisy_curves(20, seed=1)
+    Y = Y / Y.max(axis=1, keepdims=True)
+    P0 = np.tile([1.0, 2.0, 1.0], (len(Y), 1))
+    P, residuals, converged = levenberg_marquardt_batch(f, t, Y, P0)
+
+    assert converged.all()
+    for p, r, y in zip(P, residuals, Y):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            expected, _ = curve_fit(f, t, y, p0=[1.0, 2.0, 1.0])
+        # The parameters are only determined up to the flat valley at x2 ~ 0, the
+        # fitted curves are.
+        assert np.allclose(f(t, *p), f(t, *expected), atol=1e-5)
+        assert np.isclose(np.linalg.norm(r), np.linalg.norm(f(t, *expected) - y), rtol=1e-6)
+
+
+def test_curve_fit_batch_matches_wrapper():
+    t, Y = noisy_curves(60)
+    P = curve_fit_batch(f, t, Y)
+    expected = wrapper_fits(t, Y)
+
+    T1 = compute_T1_from_x23(P[:, 1], P[:, 2])
+    T1_expected = compute_T1_from_x23(expected[:, 1], expected[:, 2])
+    # The tolerance of the curve_fit_batch docstring.
+    assert np.mean(np.abs(T1 - T1_expected) <= 1e-4 * T1_expected) >= 0.99
+    assert np.allclose(P[:, 0], expected[:, 0], rtol=1e-3)
+
+
+def test_global_fallback_does_not_increase_residuals():
+    t, Y = noisy_curves(60)
+    P = curve_fit_batch(f, t, Y, fallback="global")
+    expected = wrapper_fits(t, Y)
+
+    def residual(P):
+        return np.linalg.norm(f(t[None, :], *(p[:, None] for p in P.T)) - Y, axis=1)
+
+    assert np.all(residual(P) <= residual(expected) * (1 + 1e-6))
+
+
+@pytest.mark.parametrize("fallback", ["direct", "global", None])
+@pytest.mark.parametrize("initial_guess", ["candidates", "grid"])
+def test_degenerate_curves_return_nan(fallback, initial_guess):
+    t, Y = noisy_curves(3)
+    Y = np.concatenate([np.full((1, len(t)), np.nan), np.zeros((1, len(t))), Y])
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        P = curve_fit_batch(f, t, Y, initial_guess=initial_guess, fallback=fallback)
+    assert np.isnan(P[:2]).all()
+    if fallback is not None:
+        assert np.isfinite(P[2:]).all()
+
+
+def test_grid_initial_guess_finds_noise_free_grid_entries():
+    t = np.linspace(0, 2.6, 14)
+    T1_grid = np.geomspace(0.05, 20.0, 400)
+    x2_grid = np.linspace(0.0, 3.0, 61)
+    entries = [(0, 0), (10, 37), (30, 200), (60, 399), (45, 123)]
+    x2 = np.array([x2_grid[i] for i, _ in entries])
+    x3 = np.array([np.sqrt(1.0 / T1_grid[j]) for _, j in entries])
+    x1 = np.array([0.5, 1.0, 2.5, 10.0, 3.0])
+    Y = f(t[None, :], x1[:, None], x2[:, None], x3[:, None])
+
+    P0 = grid_initial_guess(f, t, Y)
+    assert np.array_equal(P0[:, 1], x2)
+    assert np.array_equal(P0[:, 2], x3)
+    assert np.allclose(P0[:, 0], x1)
@@ -0,0 +1,79 @@
+import numpy as np
+from click.testing import CliRunner
+
+import looklocker_t1map
+from looklocker_t1map import estimate_t1map, f, head_mask, select_voxels
+from nifti_io import load_nifti, save_nifti
+
+
+def synthetic_series(shape=(6, 5, 4), seed=0):
+    """Noise-free Look-Locker series with known T1 (ms), zero in the first slab."""
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0.1, 2.7, 14)
+    x2 = np.sqrt(rng.uniform(0.2, 1.0, shape))
+    T1 = rng.uniform(500, 4000, shape)
+    x3 = x2 / np.sqrt(T1 / 1000.0)
+    x1 = rng.uniform(50, 200, shape)
+    data = f(t, x1[..., None], x2[..., None], x3[..., None]).astype(np.float32)
+    data[0] = 0.0
+    return t, data, T1
+
+
+def test_select_voxels():
+    series = np.array([[0.0, 0.0], [1.0, 5.0], [2.0, 1.0], [-1.0, -2.0], [10.0, 0.0]])
+    assert np.array_equal(select_voxels(series, None, None), [1, 2, 4])
+    assert np.array_equal(select_voxels(series, None, 2.0), [1, 4])
+    mask = np.array([1, 0, 1, 1, 1])
+    assert np.array_equal(select_voxels(series, mask, None), [2, 4])
+    assert np.array_equal(select_voxels(series, mask, 2.0), [4])
+
+
+def test_head_mask_of_a_sphere():
+    grid = np.mgrid[:40, :40, :40] - 19.5
+    radius = np.sqrt((grid**2).sum(axis=0))
+    volume = np.where(radius < 12, 100.0, 0.0) + np.random.default_rng(0).uniform(0, 1, radius.shape)
+    mask = head_mask(volume, smoothing_level=2)
+    assert mask[radius < 8].all()
+    assert not mask[radius > 16].any()
+
+
+def test_estimate_t1map():
+    t, data, T1 = synthetic_series()
+    # T1 is capped at 10000 ms, as in gmri2fem.
+    data[2, 2, 2] = f(t, 100.0, 1.0, 1.0 / np.sqrt(20.0))
+    T1[2, 2, 2] = 10000.0
+    mask = np.ones(data.shape[:3], dtype=bool)
+    mask[:, 0] = False
+    T1map, quality = estimate_t1map(data, t, mask=mask, chunk_size=7, workers=1)
+
+    fitted = mask.copy()
+    fitted[0] = False
+    assert T1map.dtype == np.float32 and quality.dtype == np.float32
+    assert np.isnan(T1map[~fitted]).all() and np.isnan(quality[~fitted]).all()
+    assert np.allclose(T1map[fitted], T1[fitted], rtol=1e-3)
+    assert (quality[fitted] < 1e-3).all()
+
+
+def test_cli_writes_t1map_and_quality(tmp_path):
+    t, data, T1 = synthetic_series(shape=(3, 3, 2), seed=1)
+    affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    save_nifti(tmp_path / "LL.nii.gz", data, affine)
+    np.savetxt(tmp_path / "timestamps.txt", t * 1000.0)
+
+    result = CliRunner().invoke(
+        looklocker_t1map.main,
+        [
+            "--input", str(tmp_path / "LL.nii.gz"),
+            "--timestamps", str(tmp_path / "timestamps.txt"),
+            "--output", str(tmp_path / "T1map.nii.gz"),
+            "--quality", str(tmp_path / "quality.nii.gz"),
+            "--threshold", "1",
+            "--workers", "1",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    T1map, _ = load_nifti(tmp_path / "T1map.nii.gz")
+    quality, _ = load_nifti(tmp_path / "quality.nii.gz")
+    assert np.isnan(T1map[0]).all()
+    assert np.allclose(T1map[1:], T1[1:], rtol=1e-3)
+    assert (quality[1:] < 1e-3).all()
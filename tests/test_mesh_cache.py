@@ -0,0 +1,78 @@
+import os
+import sys
+
+from mesh_cache import cache_key, cached_run
+
+
+def write_outputs(tmp_path, counter):
+    # Appends to the counter on every run, and writes a file and a directory.
+    return [
+        sys.executable, "-c",
+        "import pathlib, sys;"
+        f"open({str(counter)!r}, 'a').write('x');"
+        "data = pathlib.Path(sys.argv[1]).read_text();"
+        "pathlib.Path(sys.argv[2]).write_text(data.upper());"
+        "pathlib.Path(sys.argv[3]).mkdir(exist_ok=True);"
+        "(pathlib.Path(sys.argv[3]) / 'part.txt').write_text(data[::-1])",
+        str(tmp_path / "input.txt"), str(tmp_path / "out.txt"), str(tmp_path / "outdir"),
+    ]
+
+
+def test_cached_run(tmp_path):
+    counter = tmp_path / "runs"
+    (tmp_path / "input.txt").write_text("surface")
+    command = write_outputs(tmp_path, counter)
+    inputs = [tmp_path / "input.txt"]
+    outputs = [tmp_path / "out.txt", tmp_path / "outdir"]
+    cache_dir = tmp_path / "cache"
+
+    cached_run(command, inputs, outputs, cache_dir, {"resolution": "16"})
+    assert counter.read_text() == "x"
+
+    # Removed outputs are restored from the cache, with new modification times. The
+    # outputs are hard links into the cache, so this also ages the cache entry.
+    for output in [tmp_path / "out.txt", tmp_path / "outdir" / "part.txt"]:
+        os.utime(output, (0, 0))
+    (tmp_path / "out.txt").unlink()
+    cached_run(command, inputs, outputs, cache_dir, {"resolution": "16"})
+    assert counter.read_text() == "x"
+    assert (tmp_path / "out.txt").read_text() == "SURFACE"
+    assert (tmp_path / "outdir" / "part.txt").read_text() == "ecafrus"
+    for output in [tmp_path / "out.txt", tmp_path / "outdir", tmp_path / "outdir" / "part.txt"]:
+        assert output.stat().st_mtime > 1e9
+
+    # Another parameter, or the same input rewritten with the same content.
+    cached_run(command, inputs, outputs, cache_dir, {"resolution": "32"})
+    assert counter.read_text() == "xx"
+    (tmp_path / "input.txt").write_text("surface")
+    cached_run(command, inputs, outputs, cache_dir, {"resolution": "32"})
+    assert counter.read_text() == "xx"
+
+    (tmp_path / "input.txt").write_text("white")
+    cached_run(command, inputs, outputs, cache_dir, {"resolution": "32"})
+    assert counter.read_text() == "xxx"
+    assert (tmp_path / "out.txt").read_text() == "WHITE"
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    counter = tmp_path / "runs"
+    (tmp_path / "input.txt").write_text("surface")
+    command = write_outputs(tmp_path, counter)
+    inputs = [tmp_path / "input.txt"]
+    outputs = [tmp_path / "out.txt", tmp_path / "outdir"]
+    cache_dir = tmp_path / "cache"
+
+    for resolution in ["16", "32"]:
+        cached_run(command, inputs, outputs, cache_dir, {"resolution": resolution})
+    first, second = [cache_dir / cache_key(command, inputs, {"resolution": r}) for r in ["16", "32"]]
+    os.utime(first, (0, 0))
+    os.utime(second, (1, 1))
+    cached_run(command, inputs, outputs, cache_dir, {"resolution": "16"})  # A hit marks it as used.
+    assert counter.read_text() == "xx"
+
+    entry_size = 2 * len("surface")
+    cached_run(command, inputs, outputs, cache_dir, {"resolution": "64"}, max_bytes=2 * entry_size)
+    assert counter.read_text() == "xxx"
+    remaining = set(cache_dir.iterdir())
+    assert len(remaining) == 2
+    assert first in remaining and second not in remaining
@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+import scipy.sparse
+import scipy.sparse.linalg
+
+from dti_sampling import (
+    build_dti_operator,
+    extend_to_9_components,
+    load_dti_operator,
+    sample_dti,
+    save_dti_operator,
+    valid_masks,
+)
+from mesh_sampling import SamplingOperator, csf_boundary_mask, nearest_voxels, operator_key, session_timestamps
+from timetable import load_timetable
+
+
+def test_csf_boundary_mask_matches_skimage():
+    skimage = pytest.importorskip("skimage.morphology")
+    rng = np.random.default_rng(0)
+    mask = rng.uniform(size=(12, 10, 8)) > 0.3
+    # A block touching the image border is not eroded along the border.
+    mask[:4, :4, :4] = True
+    eroded = csf_boundary_mask(mask.astype(np.uint8))
+    assert np.array_equal(eroded, skimage.binary_erosion(mask, skimage.ball(1)))
+    assert eroded[0, 0, 0] and eroded[0, 1, 2]
+
+
+def test_session_timestamps_clipped_at_injection(tmp_path):
+    (tmp_path / "timetable.tsv").write_text(
+        "subject\tsession\tsequence_label\tacquisition_relative_injection\n"
+        "sub-01\tses-01\tlooklocker\t-100.0\n"
+        "sub-01\tses-02\tlooklocker\t3600.0\n"
+    )
+    paths = [tmp_path / f"sub-01_{session}_concentration.nii.gz" for session in ["ses-02", "ses-01"]]
+    timestamps = session_timestamps(load_timetable(tmp_path / "timetable.tsv"), paths)
+    assert np.array_equal(timestamps, [3600.0, 0.0])
+
+
+def random_operator(rng, num_dofs=30, shape=(5, 6, 7), N=4) -> SamplingOperator:
+    num_voxels = int(np.prod(shape))
+    A = scipy.sparse.random(num_dofs, num_dofs, density=0.2, random_state=1)
+    mass = (A @ A.T + num_dofs * scipy.sparse.eye(num_dofs)).tocsr()
+    return SamplingOperator(
+        projection=scipy.sparse.random(num_dofs, num_voxels, density=0.1, format="csr", random_state=2),
+        mass=mass,
+        boundary_dofs=np.arange(0, num_dofs, 3),
+        boundary_neighbours=rng.integers(0, num_voxels, size=(num_dofs // 3, N)),
+        shape=shape,
+    )
+
+
+def test_project_factorizes_once(monkeypatch):
+    rng = np.random.default_rng(0)
+    operator = random_operator(rng)
+    calls = []
+    splu = scipy.sparse.linalg.splu
+    monkeypatch.setattr(scipy.sparse.linalg, "splu", lambda A: calls.append(A) or splu(A))
+
+    for _ in range(2):
+        volumes = rng.normal(size=(operator.projection.shape[1], 3))
+        expected = scipy.sparse.linalg.spsolve(operator.mass.tocsc(), operator.projection @ volumes)
+        assert np.allclose(operator.project(volumes), expected)
+    assert len(calls) == 1
+
+
+def test_boundary_median_ignores_nan():
+    rng = np.random.default_rng(0)
+    operator = random_operator(rng)
+    volumes = rng.normal(size=(operator.projection.shape[1], 2))
+    volumes[rng.uniform(size=volumes.shape) < 0.2] = np.nan
+
+    expected = np.array(
+        [[np.median([v for v in volumes[row, k] if np.isfinite(v)]) for k in range(2)] for row in operator.boundary_neighbours]
+    )
+    assert np.allclose(operator.boundary(volumes), expected, equal_nan=True)
+
+
+def test_nearest_voxels():
+    mask = np.zeros((4, 4, 4), dtype=bool)
+    mask[0, 0, 0] = mask[3, 3, 3] = mask[0, 3, 0] = True
+    nearest = nearest_voxels(np.array([[0.2, 0.1, 0.0], [2.9, 2.6, 3.1]]), mask, N=2)
+    assert np.array_equal(nearest[:, 0], np.ravel_multi_index(([0, 3], [0, 3], [0, 3]), mask.shape))
+
+
+def test_extend_to_9_components():
+    xx, xy, xz, yy, yz, zz = range(1, 7)
+    tensor = extend_to_9_components(np.array([[xx, xy, xz, yy, yz, zz]]))
+    assert np.array_equal(tensor.reshape(3, 3), [[xx, xy, xz], [xy, yy, yz], [xz, yz, zz]])
+    with pytest.raises(ValueError):
+        extend_to_9_components(np.zeros((2, 4)))
+
+
+def test_sample_dti_matches_brute_force():
+    rng = np.random.default_rng(0)
+    shape = (6, 5, 4)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = [-5.0, 3.0, 1.0]
+    dti = rng.normal(size=(*shape, 6))
+    dti[rng.uniform(size=shape) < 0.2] = np.nan
+    md = rng.uniform(0, 1e-3, size=shape)
+    md[rng.uniform(size=shape) < 0.2] = 0.0
+    fa = rng.uniform(size=shape)
+    brain = np.ones(shape, dtype=bool)
+    brain[0] = False
+    midpoints = rng.uniform(0, 1, size=(15, 3)) * (np.array(shape) - 1) @ affine[:3, :3].T + affine[:3, 3]
+
+    tensors, md_values, fa_values = sample_dti(midpoints, affine, dti, md, fa, brain, N=10)
+
+    voxels = np.argwhere(np.ones(shape, dtype=bool))
+    flat = np.ravel_multi_index(tuple(voxels.T), shape)
+    points = (midpoints - affine[:3, 3]) @ np.linalg.inv(affine[:3, :3]).T
+    dti_valid = (np.isfinite(dti).all(axis=-1) & brain).reshape(-1)
+    md_valid = ((md > 1e-5) & brain).reshape(-1)
+    for point, tensor, md_value, fa_value in zip(points, tensors, md_values, fa_values):
+        distance = np.linalg.norm(voxels - point, axis=1)
+        order = flat[np.argsort(distance)]
+        nearest = order[dti_valid[order]][0]
+        assert np.allclose(tensor, extend_to_9_components(dti.reshape(-1, 6)[nearest]))
+        neighbours = order[md_valid[order]][:10]
+        assert np.isclose(md_value, np.median(md.reshape(-1)[neighbours]))
+        assert np.isclose(fa_value, np.median(fa.reshape(-1)[neighbours]))
+
+
+def test_dti_operator_round_trip(tmp_path):
+    rng = np.random.default_rng(1)
+    shape = (5, 4, 3)
+    affine = np.eye(4)
+    dti = rng.normal(size=(*shape, 6))
+    dti[0, 0, 0] = np.nan
+    md = rng.uniform(0, 1e-3, size=shape)
+    fa = rng.uniform(size=shape)
+    dti_mask, md_mask = valid_masks(dti, md, np.ones(shape, dtype=bool))
+    midpoints = rng.uniform(0, 3, size=(8, 3))
+    operator = build_dti_operator(midpoints, affine, dti_mask, md_mask, N=4)
+
+    path = tmp_path / "mesh_sampling" / "operator.npz"
+    save_dti_operator(path, operator)
+    loaded = load_dti_operator(path)
+    assert list(path.parent.iterdir()) == [path]
+    assert loaded.shape == shape
+    assert np.array_equal(loaded.nearest, operator.nearest)
+    assert np.array_equal(loaded.neighbours, operator.neighbours)
+    assert np.array_equal(loaded.tensors(dti), operator.tensors(dti))
+    assert np.array_equal(loaded.medians(md, fa), operator.medians(md, fa))
+
+    # Keyed like the sampling operator, and distinct from it for the same masks.
+    mesh = tmp_path / "mesh.hdf"
+    mesh.write_bytes(b"mesh")
+    key = operator_key(mesh, affine, dti_mask, md_mask, kind="dti", N=4)
+    assert key == operator_key(mesh, affine, dti_mask, md_mask, kind="dti", N=4)
+    assert key != operator_key(mesh, affine, dti_mask, md_mask, kind="dti", N=10)
+    assert key != operator_key(mesh, affine, dti_mask, ~md_mask, kind="dti", N=4)
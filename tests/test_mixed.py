@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import scipy.interpolate
+
+from mixed import (
+    LOOKUP_INVERTER,
+    LOOKUP_TABLE,
+    T1LookupInverter,
+    compute_ir_signal,
+    compute_se_signal,
+    extract_mixed_t1,
+)
+
+
+def interp1d_lookup(F_data, lookup_table):
+    # The lookup replaced by T1LookupInverter.
+    F, T1_grid = lookup_table
+    return scipy.interpolate.interp1d(F, T1_grid, kind="nearest", bounds_error=False, fill_value=np.nan)(F_data)
+
+
+def test_matches_interp1d_nearest():
+    rng = np.random.default_rng(0)
+    T1 = rng.uniform(200, 5000, size=(40, 50))
+    IR, SE = compute_ir_signal(T1, SNR=25, rng=rng), compute_se_signal(T1, SNR=25, rng=rng)
+    F = IR / SE
+    # Noisy ratios outside of the table, which map to NaN, and none exactly on the
+    # F == 1 plateau of very short T1, where interp1d picks an arbitrary T1.
+    assert (F > 1).any() and (F < 1).any() and not (F == 1).any()
+
+    T1_est = extract_mixed_t1(IR, SE, LOOKUP_INVERTER)
+    assert T1_est.shape == T1.shape
+    assert np.array_equal(T1_est, interp1d_lookup(F, LOOKUP_TABLE), equal_nan=True)
+    # The former call style with the raw table.
+    assert np.array_equal(extract_mixed_t1(IR, SE, LOOKUP_TABLE), T1_est, equal_nan=True)
+
+
+def test_out_of_range_and_nan_ratios():
+    F_table = LOOKUP_TABLE[0]
+    F_data = np.array([F_table.min() - 1.0, F_table.max() + 1.0, np.nan, F_table.min(), np.median(F_table)])
+    T1 = LOOKUP_INVERTER.lookup(F_data)
+    assert np.isnan(T1[:3]).all()
+    assert np.isfinite(T1[3:]).all()
+    assert np.array_equal(T1[3:], interp1d_lookup(F_data[3:], LOOKUP_TABLE))
+    assert np.isnan(LOOKUP_INVERTER(np.zeros(2), np.zeros(2))).all()
+
+
+def test_interpolation_recovers_table_T1():
+    F, T1_grid = LOOKUP_TABLE
+    valid = F < F.max()
+    T1 = np.random.default_rng(1).uniform(T1_grid[valid].min(), T1_grid.max(), 100)
+    F_data = np.interp(T1, T1_grid, F)
+    assert np.allclose(LOOKUP_INVERTER.lookup(F_data, interpolate=True), T1, rtol=1e-6)
+
+
+def test_rejects_non_monotone_table():
+    T1_grid = np.linspace(1, 10, 20)
+    with pytest.raises(ValueError, match="not monotone"):
+        T1LookupInverter(np.sin(T1_grid), T1_grid)
+    # Decreasing tables are monotone.
+    T1LookupInverter(-T1_grid, T1_grid)
@@ -0,0 +1,46 @@
+import json
+
+import nibabel
+import numpy as np
+import pytest
+from click.testing import CliRunner
+
+import normalize_t1w
+from nifti_io import load_nifti, save_nifti
+from orbital_refroi import load_stack
+
+
+def test_normalize_matches_reference(tmp_path):
+    sm = pytest.importorskip("simple_mri")
+    rng = np.random.default_rng(0)
+    shape = (9, 7, 8)
+    # Permuted and flipped axes, which are reoriented on load.
+    affine = np.array([[0.0, 0.0, -1.1, 10.0], [1.2, 0.0, 0.0, -5.0], [0.0, -0.9, 0.0, 3.0], [0.0, 0.0, 0.0, 1.0]])
+    paths = [tmp_path / f"sub-01_{session}_T1w_registered.nii.gz" for session in ["ses-01", "ses-02"]]
+    for path in paths:
+        data = rng.lognormal(5, 1, size=shape).astype(np.float32)
+        nibabel.save(nibabel.Nifti1Image(data, affine), path)
+
+    # The medians as written by orbital_refroi.py --stats, on its reoriented stack.
+    stack, reoriented = load_stack(paths, tmp_path / "stack.npy")
+    roi = rng.uniform(size=stack.shape[1:]) > 0.7
+    save_nifti(tmp_path / "refroi.nii.gz", roi, reoriented, dtype=np.uint8)
+    medians = {"left": {f"ses-0{idx + 1}": float(np.median(volume[roi])) for idx, volume in enumerate(stack)}}
+    (tmp_path / "refroi.json").write_text(json.dumps(medians))
+
+    for path in paths:
+        output = tmp_path / f"{path.name}_normalized.nii.gz"
+        result = CliRunner().invoke(
+            normalize_t1w.main,
+            ["--input", str(path), "--refroi_stats", str(tmp_path / "refroi.json"), "--output", str(output)],
+        )
+        assert result.exit_code == 0, result.output
+
+        # gmri2fem.t1_weighted.normalize_image
+        image = sm.load_mri(path, dtype=np.single)
+        refroi = sm.load_mri(tmp_path / "refroi.nii.gz", dtype=bool)
+        expected = image.data / np.median(image.data[refroi.data])
+        normalized, normalized_affine = load_nifti(output)
+        assert normalized.dtype == np.float32
+        assert np.allclose(normalized_affine, image.affine)
+        assert np.array_equal(normalized, expected)
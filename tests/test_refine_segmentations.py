@@ -0,0 +1,115 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel
+import numpy as np
+import pytest
+import scipy.interpolate
+import scipy.ndimage
+from click.testing import CliRunner
+
+import refine_segmentations
+from nifti_io import apply_affine, load_nifti
+from refine_segmentations import resample, resampling_map, segmentation_smoothing
+
+
+# Transcriptions of gmri2fem.segmentation_refinement, which `gmri2fem seg refine` runs.
+def reference_resample(seg, affine_in, shape_out, affine_out):
+    upsampled_inds = np.fromiter(itertools.product(*(np.arange(n) for n in shape_out)), dtype=np.dtype((int, 3)))
+    seg_inds = np.rint(apply_affine(np.linalg.inv(affine_in), apply_affine(affine_out, upsampled_inds))).astype(int)
+    valid_index_mask = (seg_inds > 0).all(axis=1) * (seg_inds < seg.shape).all(axis=1)
+    upsampled_inds = upsampled_inds[valid_index_mask]
+    seg_inds = seg_inds[valid_index_mask]
+    seg_upsampled = np.zeros(shape_out, dtype=seg.dtype)
+    seg_upsampled[tuple(upsampled_inds.T)] = seg[tuple(seg_inds.T)]
+    return seg_upsampled
+
+
+def reference_smoothing(segmentation, sigma, cutoff_score=0.5):
+    labels = np.unique(segmentation)
+    labels = labels[labels != 0]
+    new_labels = np.zeros_like(segmentation)
+    high_scores = np.zeros(segmentation.shape)
+    for label in labels:
+        label_scores = scipy.ndimage.gaussian_filter((segmentation == label).astype(float), sigma=sigma)
+        is_new_high_score = label_scores > high_scores
+        new_labels[is_new_high_score] = label
+        high_scores[is_new_high_score] = label_scores[is_new_high_score]
+    delete_scores = (high_scores < cutoff_score) * (segmentation == 0)
+    new_labels[delete_scores] = 0
+    return new_labels
+
+
+def reference_csf_segmentation(seg, csf_mask):
+    I, J, K = np.where(seg != 0)
+    interp = scipy.interpolate.NearestNDInterpolator(np.array([I, J, K]).T, seg[I, J, K])
+    i, j, k = np.where(csf_mask)
+    csf_seg = np.zeros_like(seg, dtype=np.int16)
+    csf_seg[i, j, k] = interp(i, j, k)
+    return csf_seg
+
+
+def blob_segmentation(rng, shape, labels):
+    seg = np.zeros(shape, dtype=np.int16)
+    for label in labels:
+        center = rng.integers(0, shape)
+        radius = rng.integers(1, 4, size=3)
+        grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+        seg[sum(((x - c) / r) ** 2 for x, c, r in zip(grid, center, radius)) <= 1] = label
+    return seg
+
+
+def test_resampling_map_excludes_first_slab():
+    rng = np.random.default_rng(0)
+    seg = rng.integers(1, 20, size=(6, 7, 5)).astype(np.int16)
+    affine_in = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine_out = np.eye(4)
+    affine_out[:3, 3] = [0.3, -1.2, 0.4]
+    shape_out = (12, 12, 10)
+
+    resampled = resample(seg, resampling_map(seg.shape, affine_in, shape_out, affine_out, chunk_size=100), shape_out)
+    assert np.array_equal(resampled, reference_resample(seg, affine_in, shape_out, affine_out))
+    # As in gmri2fem, the voxels mapping to index 0 of the segmentation are outside.
+    assert not resampled[0].any() and resampled[1].any()
+
+
+@pytest.mark.parametrize("sigma", [0.7, 1.5])
+def test_segmentation_smoothing_matches_reference(sigma):
+    rng = np.random.default_rng(1)
+    seg = blob_segmentation(rng, (20, 18, 16), [3, 7, 2, 41, -5])
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        smoothed = segmentation_smoothing(seg, sigma, executor)
+    assert np.array_equal(smoothed, reference_smoothing(seg, sigma))
+
+
+def test_refine_matches_reference(tmp_path):
+    rng = np.random.default_rng(2)
+    seg = blob_segmentation(rng, (10, 9, 8), [2, 4, 17, 30])
+    affine_in = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine_in[:3, 3] = [-10.0, -9.0, -8.0]
+    shape_out = (18, 16, 14)
+    affine_out = np.eye(4)
+    affine_out[:3, 3] = [-9.6, -8.5, -7.7]
+    csf_mask = (rng.uniform(size=shape_out) > 0.8).astype(np.uint8)
+    nibabel.save(nibabel.Nifti1Image(seg, affine_in), tmp_path / "aseg.nii.gz")
+    nibabel.save(nibabel.Nifti1Image(np.zeros(shape_out, dtype=np.float32), affine_out), tmp_path / "reference.nii.gz")
+    nibabel.save(nibabel.Nifti1Image(csf_mask, affine_out), tmp_path / "csfmask.nii.gz")
+
+    result = CliRunner().invoke(
+        refine_segmentations.main,
+        [
+            "--seg", str(tmp_path / "aseg.nii.gz"), str(tmp_path / "refined.nii.gz"), str(tmp_path / "csfseg.nii.gz"),
+            "--reference", str(tmp_path / "reference.nii.gz"),
+            "--csfmask", str(tmp_path / "csfmask.nii.gz"),
+            "--label_smoothing", "1",
+            "--threads", "2",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    expected = reference_smoothing(reference_resample(seg, affine_in, shape_out, affine_out), 1)
+    refined, affine = load_nifti(tmp_path / "refined.nii.gz")
+    assert np.allclose(affine, affine_out)
+    assert np.array_equal(refined, expected)
+    csf_seg, _ = load_nifti(tmp_path / "csfseg.nii.gz")
+    assert np.array_equal(csf_seg, reference_csf_segmentation(expected, csf_mask.astype(bool)))
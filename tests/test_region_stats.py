@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+
+import region_stats
+from concentration_timeline import append_session, create_store
+from nifti_io import save_nifti
+
+COLUMNS = [
+    "label", "description", "voxelcount", "volume_ml", "num_nan_values", "sum", "mean", "median",
+    "std", "min", "PC1", "PC5", "PC25", "PC75", "PC90", "PC95", "PC99", "max",
+    "subject", "session", "timestamp",
+]
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    rng = np.random.default_rng(0)
+    seg = np.zeros((6, 7, 8), dtype=np.int16)
+    seg[1:3, :, :] = 2
+    seg[3:5, 2:6, :] = 17
+    seg[5, 0, 0] = 1000
+    affine = np.diag([2.0, 1.0, 1.5, 1.0])
+    save_nifti(tmp_path / "seg.nii.gz", seg, affine)
+
+    sessions = {"ses-01": rng.normal(size=seg.shape), "ses-02": rng.normal(size=seg.shape)}
+    sessions["ses-02"][1, 0, :3] = np.nan
+    sessions["ses-02"][5, 0, 0] = np.nan
+    for session, data in sessions.items():
+        save_nifti(tmp_path / f"sub-01_{session}_concentration.nii.gz", data, affine, dtype=np.float32)
+
+    (tmp_path / "timetable.tsv").write_text(
+        "subject\tsession\tsequence_label\tacquisition_relative_injection\n"
+        "sub-01\tses-01\tlooklocker\t-3600.0\n"
+        "sub-01\tses-02\tlooklocker\t7200.5\n"
+    )
+    (tmp_path / "lut.txt").write_text("# No. Label\n2 Left-Cerebral-White-Matter 245 245 245 0\n17 Left-Hippocampus 220 216 20 0\n")
+    return tmp_path, seg, {s: d.astype(np.float32) for s, d in sessions.items()}
+
+
+def test_region_stats_csv(dataset):
+    path, seg, sessions = dataset
+    result = CliRunner().invoke(
+        region_stats.main,
+        [
+            "-s", str(path / "seg.nii.gz"),
+            "-m", str(path / "sub-01_ses-01_concentration.nii.gz"),
+            "-m", str(path / "sub-01_ses-02_concentration.nii.gz"),
+            "-o", str(path / "stats.csv"),
+            "--timetable", str(path / "timetable.tsv"),
+            "--lut", str(path / "lut.txt"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    frame = pd.read_csv(path / "stats.csv")
+
+    assert list(frame.columns) == COLUMNS
+    assert list(frame["label"]) == [2, 17, 1000] * 2
+    assert list(frame["session"]) == ["ses-01"] * 3 + ["ses-02"] * 3
+    assert list(frame["subject"]) == ["sub-01"] * 6
+    assert list(frame["timestamp"]) == [-3600.0] * 3 + [7200.5] * 3
+    assert list(frame["description"].fillna("")[:3]) == ["Left-Cerebral-White-Matter", "Left-Hippocampus", ""]
+
+    for row in frame.itertuples():
+        values = sessions[row.session][seg == row.label].astype(float)
+        finite = values[np.isfinite(values)]
+        assert row.voxelcount == values.size
+        assert row.volume_ml == pytest.approx(values.size * 3.0 / 1000)
+        assert row.num_nan_values == values.size - finite.size
+        if finite.size == 0:
+            assert np.isnan([row.sum, row.mean, row.median, row.std, row.min, row.max]).all()
+            continue
+        assert row.sum == pytest.approx(finite.sum())
+        assert row.mean == pytest.approx(finite.mean())
+        assert row.std == pytest.approx(finite.std())
+        assert row.median == pytest.approx(np.median(finite))
+        assert row.min == pytest.approx(finite.min())
+        assert row.max == pytest.approx(finite.max())
+        for pc in region_stats.PERCENTILES:
+            assert getattr(row, f"PC{pc}") == pytest.approx(np.percentile(finite, pc))
+
+
+def test_region_stats_from_timeline(dataset):
+    path, seg, sessions = dataset
+    store = path / "sub-01_concentration-timeline.h5"
+    # Voxels outside the mask of the store are NaN, as in the concentration images.
+    mask = np.ones(seg.shape, dtype=bool)
+    mask[0] = False
+    for data in sessions.values():
+        data[0] = np.nan
+    affine = np.diag([2.0, 1.0, 1.5, 1.0])
+    create_store(store, mask, affine)
+    for (session, data), time in zip(reversed(sessions.items()), [7200.5, -3600.0]):
+        save_nifti(path / f"sub-01_{session}_concentration.nii.gz", data, affine)
+        append_session(store, session, time, data, affine)
+
+    def run(*args):
+        result = CliRunner().invoke(
+            region_stats.main, ["-s", str(path / "seg.nii.gz"), "--lut", str(path / "lut.txt"), *args]
+        )
+        assert result.exit_code == 0, result.output
+
+    run("--timeline", str(store), "-o", str(path / "timeline.csv"))
+    run(
+        "-m", str(path / "sub-01_ses-01_concentration.nii.gz"),
+        "-m", str(path / "sub-01_ses-02_concentration.nii.gz"),
+        "--timetable", str(path / "timetable.tsv"),
+        "-o", str(path / "images.csv"),
+    )  # fmt: skip
+    pd.testing.assert_frame_equal(pd.read_csv(path / "timeline.csv"), pd.read_csv(path / "images.csv"))
+
+
+def test_region_stats_requires_one_source(dataset):
+    path, _, _ = dataset
+    result = CliRunner().invoke(region_stats.main, ["-s", str(path / "seg.nii.gz"), "-o", str(path / "stats.csv")])
+    assert result.exit_code != 0
+    assert "either --mri or --timeline" in result.output
@@ -0,0 +1,64 @@
+import shlex
+import subprocess
+import threading
+from pathlib import Path
+
+import nibabel
+import numpy as np
+from click.testing import CliRunner
+
+import register_batch
+from register_batch import greedy_command, main
+
+
+def test_greedy_command_matches_register_rule(tmp_path):
+    cmd = greedy_command(tmp_path / "fixed image.nii", tmp_path / "moving.nii.gz", tmp_path / "out.mat", "NCC 5x5x5", 3)
+    assert shlex.split(cmd) == [
+        "greedy", "-d", "3", "-a",
+        "-i", str(tmp_path / "fixed image.nii"), str(tmp_path / "moving.nii.gz"),
+        "-o", str(tmp_path / "out.mat"),
+        "-ia-image-centers",
+        "-dof", "6",
+        "-m", "NCC", "5x5x5",
+        "-threads", "3",
+    ]  # fmt: skip
+
+
+def test_fixed_image_is_decompressed_once(tmp_path, monkeypatch):
+    fixed = tmp_path / "fixed.nii.gz"
+    nibabel.save(nibabel.Nifti1Image(np.arange(24, dtype=np.float32).reshape(2, 3, 4), np.eye(4)), fixed)
+
+    loads = []
+    load = nibabel.load
+    monkeypatch.setattr(register_batch.nibabel, "load", lambda path: loads.append(path) or load(path))
+
+    commands = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(2, timeout=5)
+
+    def fake_greedy(cmd, shell, capture_output, text):
+        args = shlex.split(cmd)
+        shared = args[args.index("-i") + 1]
+        with lock:
+            commands.append(args)
+            # The uncompressed copy exists while greedy runs.
+            assert shared.endswith(".nii") and np.array_equal(load(shared).get_fdata(), load(fixed).get_fdata())
+        barrier.wait()  # Both registrations run at the same time.
+        Path(args[args.index("-o") + 1]).write_text("")
+        return subprocess.CompletedProcess(cmd, 0)
+
+    monkeypatch.setattr(register_batch.subprocess, "run", fake_greedy)
+    pairs = [(f"moving{idx}.nii.gz", str(tmp_path / "transforms" / f"{idx}.mat"), "NMI") for idx in range(2)]
+    args = ["--fixed", str(fixed), "--threads", "6", "--jobs", "2"]
+    for pair in pairs:
+        args += ["--pair", *pair]
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+
+    assert loads == [fixed]
+    assert len(commands) == 2
+    shared = {args[args.index("-i") + 1] for args in commands}
+    assert len(shared) == 1
+    assert {args[args.index("-i") + 2] for args in commands} == {"moving0.nii.gz", "moving1.nii.gz"}
+    assert all(args[args.index("-threads") + 1] == "3" for args in commands)
+    assert all((tmp_path / "transforms" / f"{idx}.mat").exists() for idx in range(2))
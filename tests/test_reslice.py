@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+
+import nibabel
+import numpy as np
+
+from reslice import cached_nearest_index, nearest_index, reslice_nearest, voxel_map
+
+
+def reslice(matrix, fixed, moving, data):
+    index = nearest_index(voxel_map(matrix, fixed.affine, moving.affine), fixed.shape, moving.shape)
+    return reslice_nearest(data, index, fixed.shape)
+
+
+def images():
+    fixed = nibabel.Nifti1Image(np.zeros((6, 7, 8), dtype=np.float32), np.diag([1.0, 1.0, 1.0, 1.0]))
+    moving = nibabel.Nifti1Image(np.zeros((5, 6, 7), dtype=np.float32), np.diag([1.2, 1.0, 0.9, 1.0]))
+    matrix = np.eye(4)
+    matrix[:3, 3] = [0.4, -1.0, 0.3]
+    return matrix, fixed, moving
+
+
+def test_cached_nearest_index_concurrent_writers(tmp_path):
+    matrix, fixed, moving = images()
+    expected = nearest_index(voxel_map(matrix, fixed.affine, moving.affine), fixed.shape, moving.shape)
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: cached_nearest_index(matrix, fixed, moving, tmp_path), range(16)))
+
+    for index in results:
+        assert np.array_equal(index, expected)
+    cached = list(tmp_path.iterdir())
+    assert len(cached) == 1 and cached[0].suffix == ".npy"
+    assert np.array_equal(cached_nearest_index(matrix, fixed, moving, tmp_path), expected)
+
+
+def test_reslice_nearest_outside_is_zero():
+    matrix, fixed, moving = images()
+    data = np.arange(np.prod(moving.shape), dtype=np.float32).reshape(moving.shape) + 1
+    index = nearest_index(voxel_map(matrix, fixed.affine, moving.affine), fixed.shape, moving.shape)
+    resliced = reslice_nearest(data, index, fixed.shape)
+    assert np.array_equal(resliced.reshape(-1) == 0, index < 0)
+    assert np.array_equal(resliced.reshape(-1)[index >= 0], data.reshape(-1)[index[index >= 0]])
+
+
+def test_flip_and_shift_matches_greedy_nearest():
+    # Moving grid with a flipped first axis, and a transform shifting 1 mm along y:
+    # fixed voxel (i, j, k) samples moving voxel (3 - i, j + 1, k), 0 beyond the edge.
+    fixed = nibabel.Nifti1Image(np.zeros((4, 5, 6), dtype=np.float32), np.eye(4))
+    moving_affine = np.eye(4)
+    moving_affine[0, 0], moving_affine[0, 3] = -1.0, 3.0
+    moving = nibabel.Nifti1Image(np.zeros((4, 5, 6), dtype=np.float32), moving_affine)
+    matrix = np.eye(4)
+    matrix[1, 3] = 1.0
+    data = np.arange(4 * 5 * 6, dtype=np.float32).reshape(4, 5, 6) + 1
+
+    expected = np.zeros_like(data)
+    expected[:, :4] = data[::-1, 1:]
+    assert np.array_equal(reslice(matrix, fixed, moving, data), expected)
+
+
+def test_half_voxel_ties_round_up_like_greedy():
+    # A moving grid of twice the voxel size puts every other fixed voxel halfway
+    # between two moving voxels; greedy (ITK) rounds these up.
+    fixed = nibabel.Nifti1Image(np.zeros((6, 6, 6), dtype=np.float32), np.eye(4))
+    moving = nibabel.Nifti1Image(np.zeros((4, 4, 4), dtype=np.float32), np.diag([2.0, 2.0, 2.0, 1.0]))
+    data = np.arange(64, dtype=np.float32).reshape(4, 4, 4) + 1
+
+    nearest = (np.arange(6) + 1) // 2
+    expected = data[np.ix_(nearest, nearest, nearest)]
+    assert np.array_equal(reslice(np.eye(4), fixed, moving, data), expected)
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    matrix, fixed, moving = images()
+    shifts = [np.eye(4) for _ in range(3)]
+    for idx, shift in enumerate(shifts):
+        shift[0, 3] = idx
+    cached_nearest_index(shifts[0] @ matrix, fixed, moving, tmp_path)
+    cached_nearest_index(shifts[1] @ matrix, fixed, moving, tmp_path)
+    first, second = sorted(tmp_path.glob("*.npy"), key=lambda p: p.stat().st_mtime)
+    os.utime(first, (0, 0))
+    os.utime(second, (1, 1))
+    cached_nearest_index(shifts[0] @ matrix, fixed, moving, tmp_path)  # A hit marks it as used.
+
+    size = first.stat().st_size
+    cached_nearest_index(shifts[2] @ matrix, fixed, moving, tmp_path, max_bytes=2 * size)
+    remaining = set(tmp_path.glob("*.npy"))
+    assert len(remaining) == 2
+    assert first in remaining and second not in remaining
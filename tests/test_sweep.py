@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from sweep import RunningStats
+
+
+def chunked_data(seed=0, n=4, k=900):
+    rng = np.random.default_rng(seed)
+    values = rng.lognormal(-2, 2, size=(n, k))
+    values[rng.uniform(size=values.shape) < 0.05] = 0.0
+    values[rng.uniform(size=values.shape) < 0.05] = np.nan
+    values[rng.uniform(size=values.shape) < 0.01] = np.inf
+    # Above max_value, which grows the histogram.
+    values[:, 7] = [2e3, 5e4, 1e6, 3e3]
+    return values
+
+
+def finite_rows(values):
+    return [row[np.isfinite(row)] for row in values]
+
+
+def check_statistics(stats, values):
+    rows = finite_rows(values)
+    assert np.array_equal(stats.count, [len(row) for row in rows])
+    assert np.array_equal(stats.nan_count, np.sum(~np.isfinite(values), axis=1))
+    assert np.allclose(stats.mean(), [row.mean() for row in rows], rtol=1e-10)
+    assert np.allclose(stats.std(), [row.std() for row in rows], rtol=1e-8)
+    assert np.array_equal(stats.min(), [row.min() for row in rows])
+    assert np.array_equal(stats.max(), [row.max() for row in rows])
+    for q in [0, 5, 50, 95, 99, 100]:
+        # The sketch returns an order statistic to within the relative accuracy.
+        expected = np.array([np.percentile(row, q, method="lower") for row in rows])
+        assert np.allclose(stats.percentile(q), expected, rtol=0.005, atol=1e-9), q
+
+
+def test_update_in_chunks():
+    values = chunked_data()
+    stats = RunningStats(len(values))
+    for start in range(0, values.shape[1], 128):
+        stats.update(values[:, start : start + 128])
+    assert stats._histogram.shape[1] > RunningStats(len(values))._histogram.shape[1]
+    check_statistics(stats, values)
+
+
+def test_merge():
+    values = chunked_data(seed=1)
+    parts = [RunningStats(len(values)) for _ in range(3)]
+    for part, chunk in zip(parts, np.array_split(values, [100, 101], axis=1)):
+        part.update(chunk)
+    # Only the first part has grown its histogram, so merging it grows the others.
+    assert parts[0]._histogram.shape[1] > parts[1]._histogram.shape[1] == parts[2]._histogram.shape[1]
+    merged = RunningStats(len(values))
+    for part in parts:
+        merged.merge(part)
+    check_statistics(merged, values)
+
+    parts[2].merge(parts[0])
+    parts[2].merge(parts[1])
+    check_statistics(parts[2], values)
+
+
+def test_empty_rows_and_negative_values():
+    stats = RunningStats(2)
+    stats.update(np.array([[np.nan, np.nan], [1.0, 3.0]]))
+    assert np.isnan(stats.mean()[0]) and np.isnan(stats.percentile(50)[0])
+    assert stats.mean()[1] == 2.0
+    with pytest.raises(ValueError):
+        stats.update(np.array([[-1.0, 0.0], [0.0, 0.0]]))
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+from click.testing import CliRunner
+
+import t1_chain
+from nifti_io import load_nifti, save_nifti
+from t1_chain import concentration, hybrid_t1, process_session, t1_to_r1
+
+
+# The computations of gmri2fem's hybrid_t1map, T1_to_R1 and concentration commands
+# on loaded arrays, with their dtypes.
+def reference_hybrid(ll, mixed, csf_mask, threshold):
+    hybrid = ll.astype(np.float64)
+    newmask = csf_mask * (ll > threshold) * (mixed > threshold)
+    hybrid[newmask] = mixed.astype(np.float64)[newmask]
+    return hybrid.astype(np.float32)
+
+
+def reference_r1(T1, scale, t1_low, t1_high):
+    valid_t1 = (t1_low <= T1) * (T1 <= t1_high)
+    R1map = np.nan * np.zeros_like(T1)
+    R1map[valid_t1] = scale / np.minimum(t1_high, np.maximum(t1_low, T1[valid_t1]))
+    return R1map
+
+
+def reference_concentration(T1, T1_0, mask, r1):
+    T1, T1_0 = T1.copy(), T1_0.copy()
+    mask_data = mask * (T1_0 > 1e-10) * (T1 > 1e-10)
+    T1 *= mask_data
+    T1_0 *= mask_data
+    C = np.nan * np.zeros_like(T1_0)
+    C[mask_data] = 1 / r1 * (1 / T1[mask_data] - 1 / T1_0[mask_data])
+    return C
+
+
+def synthetic_session(rng, shape):
+    ll = rng.uniform(100, 4000, size=shape).astype(np.float32)
+    mixed = rng.uniform(100, 5000, size=shape).astype(np.float32)
+    ll[rng.uniform(size=shape) < 0.05] = 0.0
+    return ll, mixed
+
+
+def test_kernels_match_reference():
+    rng = np.random.default_rng(0)
+    shape = (9, 8, 7)
+    csf_mask = rng.uniform(size=shape) > 0.5
+    mask = rng.uniform(size=shape) > 0.2
+    ll_0, mixed_0 = synthetic_session(rng, shape)
+    ll, mixed = synthetic_session(rng, shape)
+
+    hybrid = hybrid_t1(ll, mixed, csf_mask, 1500)
+    assert np.array_equal(hybrid, reference_hybrid(ll, mixed, csf_mask, 1500))
+    assert np.array_equal(t1_to_r1(hybrid, 200, 3000), reference_r1(hybrid, 1000, 200, 3000), equal_nan=True)
+    T1_0 = hybrid_t1(ll_0, mixed_0, csf_mask, 1500)
+    assert np.array_equal(
+        concentration(hybrid, T1_0, mask, 0.0032), reference_concentration(hybrid, T1_0, mask, 0.0032), equal_nan=True
+    )
+
+
+def test_process_session_in_slabs():
+    rng = np.random.default_rng(1)
+    shape = (10, 6, 5)
+    csf_mask = rng.uniform(size=shape) > 0.5
+    mask = rng.uniform(size=shape) > 0.2
+    reference = hybrid_t1(*synthetic_session(rng, shape), csf_mask, 1500)
+    ll, mixed = synthetic_session(rng, shape)
+
+    hybrid, C, R1 = process_session(ll, mixed, reference, csf_mask, mask, 1500, 0.0032, 200, 10000, chunk_size=3, with_R1=True)
+    expected = reference_hybrid(ll, mixed, csf_mask, 1500)
+    assert np.array_equal(hybrid, expected)
+    assert np.array_equal(C, reference_concentration(expected, reference, mask, 0.0032), equal_nan=True)
+    assert np.array_equal(R1, reference_r1(expected, 1000, 200, 10000), equal_nan=True)
+
+
+def test_cli_erodes_csf_mask(tmp_path):
+    skimage = pytest.importorskip("skimage.morphology")
+    rng = np.random.default_rng(2)
+    shape = (8, 7, 6)
+    affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    csf_mask = (rng.uniform(size=shape) > 0.2).astype(np.uint8)
+    mask = (rng.uniform(size=shape) > 0.1).astype(np.uint8)
+    save_nifti(tmp_path / "csf.nii.gz", csf_mask, affine)
+    save_nifti(tmp_path / "mask.nii.gz", mask, affine)
+    sessions = [synthetic_session(rng, shape) for _ in range(2)]
+    args = []
+    for idx, (ll, mixed) in enumerate(sessions):
+        save_nifti(tmp_path / f"ll{idx}.nii.gz", ll, affine)
+        save_nifti(tmp_path / f"mixed{idx}.nii.gz", mixed, affine)
+        args += ["--session", str(tmp_path / f"ll{idx}.nii.gz"), str(tmp_path / f"mixed{idx}.nii.gz")]
+        args += ["--hybrid", str(tmp_path / f"hybrid{idx}.nii.gz"), "--concentration", str(tmp_path / f"C{idx}.nii.gz")]
+
+    result = CliRunner().invoke(
+        t1_chain.main,
+        [
+            "--reference", str(tmp_path / "ll0.nii.gz"), str(tmp_path / "mixed0.nii.gz"),
+            *args,
+            "--csfmask", str(tmp_path / "csf.nii.gz"),
+            "--mask", str(tmp_path / "mask.nii.gz"),
+            "--threshold", "1500",
+            "--erode", "1",
+            "--chunk_size", "3",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    eroded = skimage.binary_erosion(csf_mask.astype(bool), skimage.ball(1))
+    T1_0 = reference_hybrid(*sessions[0], eroded, 1500)
+    for idx, (ll, mixed) in enumerate(sessions):
+        hybrid = reference_hybrid(ll, mixed, eroded, 1500)
+        assert np.array_equal(load_nifti(tmp_path / f"hybrid{idx}.nii.gz")[0], hybrid)
+        C = reference_concentration(hybrid, T1_0, mask.astype(bool), 0.0032)
+        assert np.array_equal(load_nifti(tmp_path / f"C{idx}.nii.gz")[0], C, equal_nan=True)
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from timetable import load_timetable, parse_timetable, write_timestamps
+
+HEADER = "subject\tsession\tsequence_label\tacquisition_relative_injection\n"
+
+
+def write(path, rows):
+    path.write_text(HEADER + "".join("\t".join(map(str, row)) + "\n" for row in rows))
+
+
+@pytest.fixture
+def timetable(tmp_path):
+    path = tmp_path / "timetable.tsv"
+    write(
+        path,
+        [
+            ("sub-01", "ses-02", "looklocker", 7200.5),
+            ("sub-01", "ses-01", "looklocker", -3600),
+            ("sub-01", "ses-01", "T1w", -3500),
+            ("sub-02", "ses-01", "looklocker", 100),
+        ],
+    )
+    return path
+
+
+def test_parse_and_lookup(timetable):
+    times = parse_timetable(timetable)
+    assert times.time("sub-01", "ses-02", "looklocker") == 7200.5
+    assert times.time("sub-01", "ses-01", "T1w") == -3500.0
+    assert times.sessions("sub-01", "looklocker") == ["ses-01", "ses-02"]
+    assert times.times("sub-01", "looklocker") == [-3600.0, 7200.5]
+    assert times.times("sub-02", "T1w") == []
+    with pytest.raises(KeyError, match="No 'T1w' entry for sub-01 ses-02"):
+        times.time("sub-01", "ses-02", "T1w")
+
+
+def test_duplicate_entries_are_rejected(tmp_path):
+    path = tmp_path / "timetable.tsv"
+    write(path, [("sub-01", "ses-01", "looklocker", 1.0), ("sub-01", "ses-01", "looklocker", 2.0)])
+    with pytest.raises(ValueError, match="Duplicate timetable entry"):
+        parse_timetable(path)
+
+
+def test_load_timetable_is_reparsed_when_modified(timetable):
+    first = load_timetable(timetable)
+    assert load_timetable(timetable) is first
+
+    write(timetable, [("sub-01", "ses-01", "looklocker", 42.0)])
+    stat = os.stat(timetable)
+    os.utime(timetable, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    second = load_timetable(timetable)
+    assert second is not first
+    assert second.times("sub-01", "looklocker") == [42.0]
+
+
+def test_write_timestamps(timetable, tmp_path):
+    output = tmp_path / "sub-01" / "timestamps_LL.txt"
+    write_timestamps(timetable, "sub-01", "looklocker", output)
+    assert output.read_text() == "-3600.0\n7200.5\n"
+    with pytest.raises(ValueError, match="No 'T1w' entries for sub-02"):
+        write_timestamps(timetable, "sub-02", "T1w", output)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from vtu_export import MeshData, cell_values, export
+
+
+def test_cell_values_follow_the_dofmap():
+    rng = np.random.default_rng(0)
+    num_cells = 5
+    cell_tensors = rng.normal(size=(num_cells, 9))
+    # Dofs numbered in an order unrelated to the cells.
+    cell_dofs = rng.permutation(num_cells * 9).reshape(num_cells, 9)
+    values = np.empty(num_cells * 9)
+    values[cell_dofs] = cell_tensors
+    assert np.array_equal(cell_values(values, cell_dofs), cell_tensors)
+
+    scalar_dofs = rng.permutation(num_cells)[:, None]
+    scalars = np.empty(num_cells)
+    scalars[scalar_dofs[:, 0]] = cell_tensors[:, 0]
+    assert np.array_equal(cell_values(scalars, scalar_dofs), cell_tensors[:, 0])
+
+
+@pytest.mark.parametrize("pieces", [1, 2])
+def test_export_round_trip(tmp_path, pieces):
+    vtk = pytest.importorskip("vtk")
+    from vtk.util.numpy_support import vtk_to_numpy
+
+    points = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 1]], dtype=np.float64)
+    cells = np.array([[0, 1, 2, 3], [1, 2, 3, 4]])
+    data = MeshData(
+        points,
+        cells,
+        point_data=lambda: [("concentration-0", np.arange(5, dtype=np.float64))],
+        cell_data=lambda: [("md", np.array([1.0, 2.0])), ("dt", np.arange(18.0).reshape(2, 9))],
+    )
+    output = tmp_path / ("data.vtu" if pieces == 1 else "data.pvtu")
+    export(data, output, pieces=pieces)
+
+    reader = vtk.vtkXMLUnstructuredGridReader() if pieces == 1 else vtk.vtkXMLPUnstructuredGridReader()
+    reader.SetFileName(str(output))
+    reader.Update()
+    grid = reader.GetOutput()
+    assert grid.GetNumberOfCells() == 2
+    cell_data = grid.GetCellData()
+    assert np.array_equal(vtk_to_numpy(cell_data.GetArray("md")), [1.0, 2.0])
+    assert np.array_equal(vtk_to_numpy(cell_data.GetArray("dt")), np.arange(18.0).reshape(2, 9))
@@ -0,0 +1,156 @@
+import hashlib
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import error
+
+import pytest
+
+import zenodo_download
+from zenodo_download import Settings, download_files, download_single_file
+
+PAYLOAD = bytes(range(256)) * 4096  # 1 MiB
+
+
+class FileServer(ThreadingHTTPServer):
+    """Serves PAYLOAD at every path, honouring Range requests. Records the
+    requests, the largest number of requests served at once, and can stall
+    before sending data."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.ranges = []
+        self.active = 0
+        self.max_active = 0
+        self.delay = 0.0
+        self.stall = 0.0
+        self.lock = threading.Lock()
+
+    def url(self, name="file.bin"):
+        return f"http://127.0.0.1:{self.server_address[1]}/{name}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.ranges.append(self.headers.get("Range"))
+        try:
+            time.sleep(server.delay)
+            start = 0
+            if self.headers.get("Range"):
+                start = int(self.headers["Range"].removeprefix("bytes=").rstrip("-"))
+                if start >= len(PAYLOAD):
+                    self.send_response(416)
+                    self.end_headers()
+                    return
+                self.send_response(206)
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(PAYLOAD) - start))
+            self.end_headers()
+            time.sleep(server.stall)
+            self.wfile.write(PAYLOAD[start:])
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def md5(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+
+def test_resume_from_part_file(server, tmp_path):
+    output = tmp_path / "file.bin"
+    half = len(PAYLOAD) // 2
+    (tmp_path / "file.bin.part").write_bytes(PAYLOAD[:half])
+
+    download_single_file(server.url(), output, Settings(), f"md5:{md5(PAYLOAD)}")
+
+    assert server.ranges == [f"bytes={half}-"]
+    assert output.read_bytes() == PAYLOAD
+    assert not (tmp_path / "file.bin.part").exists()
+
+
+def test_corrupt_part_file_is_downloaded_again(server, tmp_path):
+    output = tmp_path / "file.bin"
+    (tmp_path / "file.bin.part").write_bytes(b"\0" * 1000)
+
+    download_single_file(server.url(), output, Settings(), md5(PAYLOAD))
+
+    assert server.ranges == ["bytes=1000-", None]
+    assert output.read_bytes() == PAYLOAD
+
+
+def test_checksum_mismatch(server, tmp_path):
+    output = tmp_path / "file.bin"
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        download_single_file(server.url(), output, Settings(), md5(b"something else"))
+    assert not output.exists()
+    assert not (tmp_path / "file.bin.part").exists()
+
+
+def test_existing_output_is_not_downloaded_again(server, tmp_path):
+    output = tmp_path / "file.bin"
+    output.write_bytes(PAYLOAD)
+    download_single_file(server.url(), output, Settings(), md5(PAYLOAD))
+    assert server.ranges == []
+
+
+def test_parallel_download(server, tmp_path):
+    server.delay = 0.2
+    files = [
+        {"filename": f"file{idx}.bin", "links": {"download": server.url(f"file{idx}.bin")}, "checksum": f"md5:{md5(PAYLOAD)}"}
+        for idx in range(4)
+    ]
+
+    download_files(files, str(tmp_path / "out"), Settings(workers=4))
+
+    assert server.max_active > 1
+    for file in files:
+        assert (tmp_path / "out" / file["filename"]).read_bytes() == PAYLOAD
+
+
+def test_stalled_connection_times_out(server, tmp_path):
+    server.stall = 2.0
+    settings = Settings(retries=1, timeout=0.2)
+    start = time.perf_counter()
+    with pytest.raises((TimeoutError, error.URLError)):
+        download_single_file(server.url(), tmp_path / "file.bin", settings)
+    assert time.perf_counter() - start < 1.5
+    assert len(server.ranges) == 2
+
+
+def test_socket_timeout_is_retried(server, tmp_path, monkeypatch):
+    fetch = zenodo_download.fetch_to_part
+    calls = []
+
+    def flaky_fetch(url, part, settings):
+        calls.append(url)
+        if len(calls) == 1:
+            raise socket.timeout("timed out")
+        fetch(url, part, settings)
+
+    monkeypatch.setattr(zenodo_download, "fetch_to_part", flaky_fetch)
+    output = tmp_path / "file.bin"
+    download_single_file(server.url(), output, Settings(retries=1), md5(PAYLOAD))
+    assert len(calls) == 2
+    assert output.read_bytes() == PAYLOAD
@@ -1,12 +1,12 @@
 rule T1maps_all:
   input:
     hybrid_T1maps=[
-      f"mri_processed_data/{subject}/T1maps/{subject}_{session}_T1map_hybrid.nii.gz"
+      f"mri_processed_data/{subject}/T1maps/{subject}_{session}_T1map_hybrid{NII}"
       for subject in SUBJECTS
       for session in SESSIONS[subject]
     ],
     registered=[
-      f"mri_processed_data/{subject}/registered/{subject}_{session}_{T1_variant}_registered.nii.gz"
+      f"mri_processed_data/{subject}/registered/{subject}_{session}_{T1_variant}_registered{NII}"
       for subject in SUBJECTS
       for session in SESSIONS[subject]
       for T1_variant in ["acq-looklocker_R1map", "acq-looklocker_R1map_raw", "acq-mixed_R1map", "acq-mixed_R1map_raw"]
@@ -15,22 +15,22 @@ rule T1maps_all:
 rule T1map_estimation:
   input:
     LL=expand(
-      "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_T1map.nii.gz",
+      "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_T1map" + NII,
       subject="sub-01",
       session=[f"ses-{idx:02d}" for idx in range(1, 6)]
     ),
     mixed=expand(
-      "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-mixed_T1map.nii.gz",
+      "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-mixed_T1map" + NII,
       subject="sub-01",
       session=[f"ses-{idx:02d}" for idx in range(1, 6)]
     ),
     LL_R1=expand(
-      "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_R1map.nii.gz",
+      "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_R1map" + NII,
       subject="sub-01",
       session=[f"ses-{idx:02d}" for idx in range(1, 6)]
     ),
     mixed_R1=expand(
-      "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-mixed_R1map.nii.gz",
+      "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-mixed_R1map" + NII,
       subject="sub-01",
       session=[f"ses-{idx:02d}" for idx in range(1, 6)]
     ),
@@ -40,20 +40,48 @@ rule T1map_estimation_from_LL:
     LL="mri_dataset/{subject}/{session}/anat/{subject}_{session}_acq-looklocker_IRT1.nii.gz",
     timestamps="mri_dataset/{subject}/{session}/anat/{subject}_{session}_acq-looklocker_IRT1_trigger_times.txt"
   output:
-    T1raw="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_T1map_raw.nii.gz",
+    T1raw="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_T1map_raw" + NII,
   shell:
     "gmri2fem mri looklocker-t1map"
       " --input {input.LL}"
       " --timestamps {input.timestamps}"
       " --output {output.T1raw}"
 
+# Fit the Look-Locker T1 maps with the vectorized fitter on the rule's threads,
+# in the same head mask as gmri2fem. looklocker-residual also writes the relative
+# residual norm of every fit.
+if config.get("native-looklocker", False):
+  LL_RESIDUAL = "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_T1map_residual" + NII
+
+  rule T1map_estimation_from_LL_native:
+    input:
+      LL="mri_dataset/{subject}/{session}/anat/{subject}_{session}_acq-looklocker_IRT1.nii.gz",
+      timestamps="mri_dataset/{subject}/{session}/anat/{subject}_{session}_acq-looklocker_IRT1_trigger_times.txt"
+    output:
+      T1raw="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_T1map_raw" + NII,
+      **({"quality": LL_RESIDUAL} if config.get("looklocker-residual", False) else {}),
+    params:
+      quality=lambda wildcards, output: f"--quality {output.quality}" if "quality" in output.keys() else ""
+    threads: 8
+    shell:
+      "python scripts/looklocker_t1map.py"
+        " --input {input.LL}"
+        " --timestamps {input.timestamps}"
+        " --output {output.T1raw}"
+        " --head_mask"
+        " --fallback global"
+        " --workers {threads}"
+        " {params.quality}"
+
+  ruleorder: T1map_estimation_from_LL_native > T1map_estimation_from_LL
+
 
 rule T1map_LL_postprocessing:
   input:
     LL="mri_dataset/{subject}/{session}/anat/{subject}_{session}_acq-looklocker_IRT1.nii.gz",
-    T1="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_T1map_raw.nii.gz",
+    T1="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_T1map_raw" + NII,
   output:
-    "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_T1map.nii.gz",
+    "mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_T1map" + NII,
   params:
     T1_low=100,
     T1_high=6000
@@ -72,8 +100,8 @@ rule T1map_estimation_from_mixed:
     IR="mri_dataset/{subject}/{session}/mixed/{subject}_{session}_acq-mixed_IR-corrected-real.nii.gz",
     meta="mri_dataset/{subject}/{session}/mixed/{subject}_{session}_acq-mixed_meta.json"
   output:
-    T1map="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-mixed_T1map_raw.nii.gz",
-    T1map_post="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-mixed_T1map.nii.gz",
+    T1map="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-mixed_T1map_raw" + NII,
+    T1map_post="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-mixed_T1map" + NII,
   params:
     T1_low=100,
     T1_high=10000,
@@ -90,11 +118,11 @@ rule T1map_estimation_from_mixed:
 
 rule hybrid_T1maps:
   input:
-    ll="mri_processed_data/{subject}/registered/{subject}_{session}_acq-looklocker_T1map_registered.nii.gz",
-    mixed="mri_processed_data/{subject}/registered/{subject}_{session}_acq-mixed_T1map_registered.nii.gz",
+    ll="mri_processed_data/{subject}/registered/{subject}_{session}_acq-looklocker_T1map_registered" + NII,
+    mixed="mri_processed_data/{subject}/registered/{subject}_{session}_acq-mixed_T1map_registered" + NII,
     csfmask="mri_processed_data/{subject}/segmentations/{subject}_seg-csf_binary.nii.gz",
   output:
-    T1map="mri_processed_data/{subject}/T1maps/{subject}_{session}_T1map_hybrid.nii.gz",
+    T1map="mri_processed_data/{subject}/T1maps/{subject}_{session}_T1map_hybrid" + NII,
   shell:
     "gmri2fem mri hybrid-t1map"
       " --ll {input.ll}"
@@ -116,3 +144,38 @@ rule T1_to_R1:
     t1_high=10000
   shell:
     "gmri2fem mri t1-to-r1 --input {input} --output {output} --T1_low {params.t1_low} --T1_high {params.t1_high}"
+
+
+# Convert the registered T1 maps of all sessions of a subject (LL and mixed, raw and
+# processed) to R1 maps in one job instead of one T1_to_R1 job per file. The
+# sessions are those of the subject, so there is one rule per subject, and as rules
+# without wildcards they take precedence over T1_to_R1 and the reslice rules.
+if config.get("batch-R1", False):
+  BATCH_R1_VARIANTS = ["acq-looklocker_{}map", "acq-looklocker_{}map_raw", "acq-mixed_{}map", "acq-mixed_{}map_raw"]
+
+  for subject in SUBJECTS:
+    rule:
+      name: f"T1_to_R1_batch_{subject}"
+      input:
+        [
+          f"mri_processed_data/{subject}/registered/{subject}_{session}_{variant.format('T1')}_registered{NII}"
+          for session in SESSIONS[subject]
+          for variant in BATCH_R1_VARIANTS
+        ]
+      output:
+        [
+          f"mri_processed_data/{subject}/registered/{subject}_{session}_{variant.format('R1')}_registered{NII}"
+          for session in SESSIONS[subject]
+          for variant in BATCH_R1_VARIANTS
+        ]
+      params:
+        pairs=lambda wildcards, input, output: " ".join(f"--pair {T1} {R1}" for T1, R1 in zip(input, output)),
+        t1_low=200,
+        t1_high=10000
+      threads: 4
+      shell:
+        "python scripts/t1_to_r1.py"
+        " {params.pairs}"
+        " --T1_low {params.t1_low}"
+        " --T1_high {params.t1_high}"
+        " --workers {threads}"
@@ -15,7 +15,7 @@ rule T1w_signal_intensity_increase:
 
 rule normalize_T1w:
     input:
-        image="mri_processed_data/{subject}/registered/{subject}_{session}_T1w_registered.nii.gz",
+        image="mri_processed_data/{subject}/registered/{subject}_{session}_T1w_registered" + NII,
         refroi="mri_processed_data/{subject}/segmentations/{subject}_seg-refroi-left-orbital_binary.nii.gz",
     output:
         "mri_processed_data/{subject}/T1w_normalized/{subject}_{session}_T1w_normalized.nii.gz"
@@ -24,3 +24,21 @@ rule normalize_T1w:
         " --input {input.image}"
         " --refroi {input.refroi}"
         " --output {output}"
+
+# Normalize by the cached median of the session in the left orbital ROI, written
+# by orbital_refroi_native.
+if config.get("native-refroi", False):
+  rule normalize_T1w_cached:
+    input:
+      image="mri_processed_data/{subject}/registered/{subject}_{session}_T1w_registered" + NII,
+      refroi_stats="mri_processed_data/{subject}/segmentations/{subject}_seg-refroi-orbital_stats.json",
+    output:
+      "mri_processed_data/{subject}/T1w_normalized/{subject}_{session}_T1w_normalized.nii.gz"
+    shell:
+      "python scripts/normalize_t1w.py"
+      " --input {input.image}"
+      " --refroi_stats {input.refroi_stats}"
+      " --side left"
+      " --output {output}"
+
+  ruleorder: normalize_T1w_cached > normalize_T1w
@@ -1,10 +1,10 @@
 rule concentration_estimate:
   input:
-    image="mri_processed_data/{subject}/T1maps/{subject}_{session}_T1map_hybrid.nii.gz",
-    reference="mri_processed_data/{subject}/T1maps/{subject}_ses-01_T1map_hybrid.nii.gz",
+    image="mri_processed_data/{subject}/T1maps/{subject}_{session}_T1map_hybrid" + NII,
+    reference="mri_processed_data/{subject}/T1maps/{subject}_ses-01_T1map_hybrid" + NII,
     mask="mri_processed_data/{subject}/segmentations/{subject}_seg-intracranial_binary.nii.gz"
   output:
-    "mri_processed_data/{subject}/concentrations/{subject}_{session}_concentration.nii.gz"
+    "mri_processed_data/{subject}/concentrations/{subject}_{session}_concentration" + NII
   params:
     r1=0.0032
   shell:
@@ -14,3 +14,95 @@ rule concentration_estimate:
     " --output {output}"
     " --r1 {params.r1}"
     " --mask {input.mask}"
+
+
+
+# Hybrid T1 maps and concentrations of all sessions of a subject in one job, reading
+# the registered T1 maps and the masks once. Computes the images of the
+# hybrid_T1maps and concentration_estimate rules. The sessions are those of the
+# subject, so there is one rule per subject, and as rules without wildcards they
+# take precedence over the per-session rules.
+if config.get("fused-T1-chain", False):
+  for subject in SUBJECTS:
+    rule:
+      name: f"fused_T1_chain_{subject}"
+      input:
+        ll=[f"mri_processed_data/{subject}/registered/{subject}_{session}_acq-looklocker_T1map_registered{NII}" for session in SESSIONS[subject]],
+        mixed=[f"mri_processed_data/{subject}/registered/{subject}_{session}_acq-mixed_T1map_registered{NII}" for session in SESSIONS[subject]],
+        csfmask=f"mri_processed_data/{subject}/segmentations/{subject}_seg-csf_binary.nii.gz",
+        mask=f"mri_processed_data/{subject}/segmentations/{subject}_seg-intracranial_binary.nii.gz",
+      output:
+        hybrid=[f"mri_processed_data/{subject}/T1maps/{subject}_{session}_T1map_hybrid{NII}" for session in SESSIONS[subject]],
+        concentration=[f"mri_processed_data/{subject}/concentrations/{subject}_{session}_concentration{NII}" for session in SESSIONS[subject]],
+      params:
+        sessions=lambda wildcards, input: " ".join(f"--session {ll} {mixed}" for ll, mixed in zip(input.ll, input.mixed)),
+        outputs=lambda wildcards, output: " ".join(
+          f"--hybrid {hybrid} --concentration {concentration}"
+          for hybrid, concentration in zip(output.hybrid, output.concentration)
+        ),
+        r1=0.0032
+      shell:
+        "python scripts/t1_chain.py"
+        " --reference {input.ll[0]} {input.mixed[0]}"
+        " {params.sessions}"
+        " {params.outputs}"
+        " --csfmask {input.csfmask}"
+        " --mask {input.mask}"
+        " --threshold 1500"
+        " --erode 1"
+        " --r1 {params.r1}"
+
+
+# The store is created empty by concentration_timeline_store, and every session is
+# appended to it in place. The appends take the store as an ancient input, so that
+# appending a session does not make the other sessions outdated, while a new store
+# (after a change of the mask, or if it was removed) is filled again.
+TIMELINE_STORE = "mri_processed_data/{subject}/timeline/{subject}_concentration-timeline.h5"
+
+
+def previous_timeline_session(wildcards):
+  # Appends to the same store are chained, as HDF5 files do not support concurrent writers.
+  sessions = SESSIONS[wildcards.subject]
+  idx = sessions.index(wildcards.session)
+  if idx == 0:
+    return []
+  return f"mri_processed_data/{wildcards.subject}/timeline/.{wildcards.subject}_{sessions[idx - 1]}_appended"
+
+
+rule concentration_timeline_store:
+  input:
+    mask="mri_processed_data/{subject}/segmentations/{subject}_seg-intracranial_binary.nii.gz",
+  output:
+    TIMELINE_STORE
+  shell:
+    "python scripts/concentration_timeline.py"
+    " --store {output}"
+    " --mask {input.mask}"
+
+
+rule concentration_timeline_append:
+  input:
+    store=ancient(TIMELINE_STORE),
+    image="mri_processed_data/{subject}/concentrations/{subject}_{session}_concentration" + NII,
+    mask="mri_processed_data/{subject}/segmentations/{subject}_seg-intracranial_binary.nii.gz",
+    timetable="mri_dataset/timetable.tsv",
+    previous=previous_timeline_session,
+  output:
+    touch("mri_processed_data/{subject}/timeline/.{subject}_{session}_appended")
+  shell:
+    "python scripts/concentration_timeline.py"
+    " --store {input.store}"
+    " --image {input.image}"
+    " --mask {input.mask}"
+    " --timetable {input.timetable}"
+    " --timelabel looklocker"
+
+
+rule concentration_timeline:
+  input:
+    store=[TIMELINE_STORE.format(subject=subject) for subject in SUBJECTS],
+    appended=[
+      f"mri_processed_data/{subject}/timeline/.{subject}_{session}_appended"
+      for subject in SUBJECTS
+      for session in SESSIONS[subject]
+    ]
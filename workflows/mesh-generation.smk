@@ -11,11 +11,13 @@ rule convert_fs_surface_to_stl:
     )
   params: fs_license = "docker/license.txt"
   container: None
+  threads: 4
   shell:
     "python scripts/convert_surfaces.py"
     " -s $(dirname {input[0]})"
     " -o $(dirname {output[0]})"
     " -l {params.fs_license}"
+    " --workers {threads}"
 
 rule preprocess_surfaces:
   input:
@@ -65,6 +67,76 @@ rule generate_mesh:
     " --resolution {wildcards.res}"
     " --output {output.hdf}"
 
+# Surface processing and meshing are cached by the content of their inputs in
+# modeling/cache, so that a resolution sweep or a rerun on unchanged inputs reuses
+# previous results. The surface processing and the ventricle extraction run
+# concurrently in one job sharing a single read of aseg.mgz, see
+# scripts/process_surfaces.py.
+MESH_CACHE = "mri_processed_data/{subject}/modeling/cache"
+
+if config.get("mesh-cache", False):
+  rule preprocess_surfaces_cached:
+    input:
+      "mri_processed_data/fastsurfer/{subject}/mri/aseg.mgz",
+      expand(
+          "mri_processed_data/{{subject}}/modeling/surfaces/{surf}.stl",
+          surf=["lh_pial", "rh_pial", "lh_white", "rh_white"],
+      )
+    output:
+      "mri_processed_data/{subject}/modeling/surfaces/lh_pial_refined.stl",
+      "mri_processed_data/{subject}/modeling/surfaces/rh_pial_refined.stl",
+      "mri_processed_data/{subject}/modeling/surfaces/subcortical_gm.stl",
+      "mri_processed_data/{subject}/modeling/surfaces/white.stl",
+      "mri_processed_data/{subject}/modeling/surfaces/ventricles.stl",
+    params:
+      fs_dir=lambda wc, input: Path(input[0]).parent.parent,
+      surface_dir=lambda wc, output: Path(output[0]).parent,
+      inputs=lambda wc, input: " ".join([f"--input {f}" for f in input]),
+      outputs=lambda wc, output: " ".join([f"--output {f}" for f in output]),
+      cache_dir=MESH_CACHE,
+    threads: 6
+    shell:
+      "python scripts/mesh_cache.py"
+      " --cache_dir {params.cache_dir}"
+      " {params.inputs}"
+      " {params.outputs}"
+      " --"
+      " python scripts/process_surfaces.py"
+      " --fs_dir {params.fs_dir}"
+      " --surface_dir {params.surface_dir}"
+
+
+  rule generate_mesh_cached:
+    input:
+      "mri_processed_data/{subject}/modeling/surfaces/lh_pial_refined.stl",
+      "mri_processed_data/{subject}/modeling/surfaces/rh_pial_refined.stl",
+      "mri_processed_data/{subject}/modeling/surfaces/subcortical_gm.stl",
+      "mri_processed_data/{subject}/modeling/surfaces/ventricles.stl",
+      "mri_processed_data/{subject}/modeling/surfaces/white.stl",
+    output:
+      hdf="mri_processed_data/{subject}/modeling/resolution{res}/mesh.hdf",
+      xdmf="mri_processed_data/{subject}/modeling/resolution{res}/mesh_xdmfs/subdomains.xdmf"
+    params:
+      inputs=lambda wc, input: " ".join([f"--input {f}" for f in input]),
+      cache_dir=MESH_CACHE,
+    threads: 6
+    shell:
+      "python scripts/mesh_cache.py"
+      " --cache_dir {params.cache_dir}"
+      " {params.inputs}"
+      " --output {output.hdf}"
+      " --output $(dirname {output.xdmf})"
+      " --param resolution {wildcards.res}"
+      " --"
+      " gmri2fem brainmeshing meshgen"
+      " --surface_dir $(dirname {input[0]})"
+      " --resolution {wildcards.res}"
+      " --output {output.hdf}"
+
+  ruleorder: preprocess_surfaces_cached > preprocess_surfaces
+  ruleorder: preprocess_surfaces_cached > extract_ventricles
+  ruleorder: generate_mesh_cached > generate_mesh
+
 
 rule mesh_segmentation:
   input:
@@ -18,7 +18,7 @@ rule mri2fenics:
   input:
     mesh="mri_processed_data/{subject}/modeling/resolution{res}/mesh.hdf",
     concentrations= lambda wc: [
-      f"mri_processed_data/{{subject}}/concentrations/{{subject}}_{session}_concentration.nii.gz"
+      f"mri_processed_data/{{subject}}/concentrations/{{subject}}_{session}_concentration{NII}"
       for session in SESSIONS[wc.subject]
     ],
     csfmask="mri_processed_data/{subject}/segmentations/{subject}_seg-csf_binary.nii.gz",
@@ -45,6 +45,42 @@ rule mri2fenics:
     " --visualdir $(dirname {output.visual[0]})"
 
 
+# Map all sessions with one sparse sampling operator per (mesh, image grid, masks),
+# cached in mesh_sampling/ next to the mesh, instead of relocating the mesh in
+# the image for every session.
+if config.get("mesh-sampling-operator", False):
+  rule mri2fenics_operator:
+    input:
+      mesh="mri_processed_data/{subject}/modeling/resolution{res}/mesh.hdf",
+      concentrations= lambda wc: [
+        f"mri_processed_data/{{subject}}/concentrations/{{subject}}_{session}_concentration{NII}"
+        for session in SESSIONS[wc.subject]
+      ],
+      csfmask="mri_processed_data/{subject}/segmentations/{subject}_seg-csf_binary.nii.gz",
+      timetable="mri_dataset/timetable.tsv"
+    output:
+      hdf="mri_processed_data/{subject}/modeling/resolution{res}/concentrations.hdf",
+      visual=[
+        "mri_processed_data/{subject}/modeling/resolution{res}/visual/concentrations_internal.xdmf",
+        "mri_processed_data/{subject}/modeling/resolution{res}/visual/concentrations_boundary.xdmf",
+      ]
+    params:
+      femfamily="CG",
+      femdegree=1,
+    shell:
+      "python scripts/mesh_sampling.py"
+      " {input.concentrations}"
+      " --meshpath {input.mesh}"
+      " --csfmask_path {input.csfmask}"
+      " --timetable {input.timetable}"
+      " --output {output.hdf}"
+      " --femfamily {params.femfamily}"
+      " --femdegree {params.femdegree}"
+      " --visualdir $(dirname {output.visual[0]})"
+
+  ruleorder: mri2fenics_operator > mri2fenics
+
+
 rule dti2fenics:
   input:
     meshfile="mri_processed_data/{subject}/modeling/resolution{res}/mesh.hdf",
@@ -63,16 +99,67 @@ rule dti2fenics:
     " --mask {input.mask}"
     " --output {output.hdf}"
 
+# The nearest-voxel search of the sampling operator, with one median for MD and FA.
+if config.get("mesh-sampling-operator", False):
+  rule dti2fenics_operator:
+    input:
+      meshfile="mri_processed_data/{subject}/modeling/resolution{res}/mesh.hdf",
+      dti="mri_processed_data/{subject}/dwi/{subject}_ses-01_dDTI_cleaned.nii.gz",
+      md = "mri_processed_data/{subject}/registered/{subject}_ses-01_dDTI_MD_registered.nii.gz",
+      fa = "mri_processed_data/{subject}/registered/{subject}_ses-01_dDTI_FA_registered.nii.gz",
+      mask= "mri_processed_data/{subject}/segmentations/{subject}_seg-aseg_refined.nii.gz",
+    output:
+      hdf="mri_processed_data/{subject}/modeling/resolution{res}/dti.hdf",
+    shell:
+      "python scripts/dti_sampling.py"
+      " --mesh {input.meshfile}"
+      " --dti {input.dti}"
+      " --md {input.md}"
+      " --fa {input.fa}"
+      " --mask {input.mask}"
+      " --output {output.hdf}"
+
+  ruleorder: dti2fenics_operator > dti2fenics
+
 rule hdf2vtu:
     input:
         "mri_processed_data/{subject}/modeling/resolution{res}/data.hdf"
     output:
         "mri_processed_data/{subject}/modeling/resolution{res}/data.vtu"
     shell:
-        "gmri2fem i2m hdf2vtk"
+        "python scripts/vtu_export.py"
         " --input {input}"
         " --output {output}"
-        " --ascii"
+        " --compression zlib"
+
+rule hdf2pvtu:
+    input:
+        "mri_processed_data/{subject}/modeling/resolution{res}/data.hdf"
+    output:
+        pvtu="mri_processed_data/{subject}/modeling/resolution{res}/data.pvtu",
+        pieces=expand("mri_processed_data/{{subject}}/modeling/resolution{{res}}/data_{idx}.vtu", idx=range(4))
+    params:
+        pieces=4
+    shell:
+        "python scripts/vtu_export.py"
+        " --input {input}"
+        " --output {output.pvtu}"
+        " --compression zlib"
+        " --pieces {params.pieces}"
+
+rule hdf2vtu_timestep:
+    input:
+        "mri_processed_data/{subject}/modeling/resolution{res}/data.hdf"
+    output:
+        "mri_processed_data/{subject}/modeling/resolution{res}/data_timestep{idx}.vtu"
+    wildcard_constraints:
+        idx=r"\d+"
+    shell:
+        "python scripts/vtu_export.py"
+        " --input {input}"
+        " --output {output}"
+        " --compression zlib"
+        " --timestep {wildcards.idx}"
 
 rule hdf2vtk:
     input:
@@ -91,17 +178,13 @@ rule extract_concentration_times_LL:
     "mri_dataset/timetable.tsv"
   output:
     temp("mri_processed_{subject}/modeling/timestamps_LL.txt"),
-  shell:
-    "python scripts/extract_timestamps.py"
-      " --timetable {input}"
-      " --subject {wildcards.subject}"
-      " --sequence_label looklocker"
-      " --output {output}"
+  run:
+    write_timestamps(input[0], wildcards.subject, "looklocker", output[0])
 
 
 rule fenics2mri_workflow:
   input:
-    referenceimage="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+    referenceimage="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
     simulationfile="mri_processed_data/{subject}/modeling/resolution{res}/{funcname}.hdf",
     timestampfile="{subject}/timestamps_ll.txt",
   output:
@@ -1,17 +1,17 @@
 rule register_all:
   input:
     T1w=[
-        f"mri_processed_data/{subject}/registered/{subject}_{session}_T1w_registered.nii.gz"
+        f"mri_processed_data/{subject}/registered/{subject}_{session}_T1w_registered{NII}"
         for subject in SUBJECTS
         for session in SESSIONS[subject]
     ],
     T1map_LL=[
-        f"mri_processed_data/{subject}/registered/{subject}_{session}_acq-looklocker_T1map_registered.nii.gz"
+        f"mri_processed_data/{subject}/registered/{subject}_{session}_acq-looklocker_T1map_registered{NII}"
         for subject in SUBJECTS
         for session in SESSIONS[subject]
     ],
     T1map_mixed=[
-        f"mri_processed_data/{subject}/registered/{subject}_{session}_acq-mixed_{variant}_registered.nii.gz"
+        f"mri_processed_data/{subject}/registered/{subject}_{session}_acq-mixed_{variant}_registered{NII}"
         for subject in SUBJECTS
         for session in SESSIONS[subject]
         for variant in ["T1map", "T1map_raw", "R1map", "R1map_raw", "T1map_scanner", "R1map_scanner"]
@@ -27,9 +27,9 @@ rule reference_image:
   input:
     "mri_dataset/{subject}/ses-01/anat/{subject}_ses-01_T1w.nii.gz"
   output:
-    "mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz"
+    "mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII
   shell:
-    "cp {input} {output}"
+    "cp {input} {output}" if NII == ".nii.gz" else "gzip -dc {input} > {output}"
 
 
 rule register:
@@ -64,7 +64,7 @@ rule reslice:
 # T1w
 use rule register as register_T1w with:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
     moving="mri_dataset/{subject}/{session}/anat/{subject}_{session}_T1w.nii.gz"
   output:
     "mri_processed_data/{subject}/transforms/{subject}_{session}_T1w.mat"
@@ -72,17 +72,17 @@ use rule register as register_T1w with:
 
 use rule reslice as reslice_T1w with:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
     moving="mri_dataset/{subject}/{session}/anat/{subject}_{session}_T1w.nii.gz",
     transform="mri_processed_data/{subject}/transforms/{subject}_{session}_T1w.mat"
   output:
-    "mri_processed_data/{subject}/registered/{subject}_{session}_T1w_registered.nii.gz",
+    "mri_processed_data/{subject}/registered/{subject}_{session}_T1w_registered" + NII,
 
 
 # FLAIR
 use rule register as register_FLAIR with:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
     moving="mri_dataset/{subject}/{session}/anat/{subject}_{session}_FLAIR.nii.gz"
   output:
     "mri_processed_data/{subject}/transforms/{subject}_{session}_FLAIR.mat"
@@ -90,17 +90,17 @@ use rule register as register_FLAIR with:
 
 use rule reslice as reslice_FLAIR with:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
     moving="mri_dataset/{subject}/{session}/anat/{subject}_{session}_FLAIR.nii.gz",
     transform="mri_processed_data/{subject}/transforms/{subject}_{session}_FLAIR.mat"
   output:
-    "mri_processed_data/{subject}/registered/{subject}_{session}_FLAIR_registered.nii.gz",
+    "mri_processed_data/{subject}/registered/{subject}_{session}_FLAIR_registered" + NII,
 
 
 # T2w
 use rule register as register_T2w with:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
     moving="mri_dataset/{subject}/ses-01/anat/{subject}_ses-01_T2w.nii.gz"
   params:
     metric="NMI"
@@ -110,34 +110,34 @@ use rule register as register_T2w with:
 
 use rule reslice as reslice_T2w with:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
     moving="mri_dataset/{subject}/ses-01/anat/{subject}_ses-01_T2w.nii.gz",
     transform="mri_processed_data/{subject}/transforms/{subject}_{session}_T2w.mat"
   output:
-    "mri_processed_data/{subject}/registered/{subject}_{session}_T2w_registered.nii.gz",
+    "mri_processed_data/{subject}/registered/{subject}_{session}_T2w_registered" + NII,
 
 
 # LL
 use rule register as register_T1map_LL with:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
-    moving="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_R1map.nii.gz"
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
+    moving="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_R1map" + NII
   output:
     transform="mri_processed_data/{subject}/transforms/{subject}_{session}_acq-looklocker.mat"
 
 
 use rule reslice as reslice_T1map_LL with:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
-    moving="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_{T1_variant}.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
+    moving="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_{T1_variant}" + NII,
     transform="mri_processed_data/{subject}/transforms/{subject}_{session}_acq-looklocker.mat",
   output:
-    "mri_processed_data/{subject}/registered/{subject}_{session}_acq-looklocker_{T1_variant}_registered.nii.gz",
+    "mri_processed_data/{subject}/registered/{subject}_{session}_acq-looklocker_{T1_variant}_registered" + NII,
 
 # Mixed
 use rule register as register_mixed with:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T2w_registered.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T2w_registered" + NII,
     moving="mri_dataset/{subject}/{session}/mixed/{subject}_{session}_acq-mixed_SE-modulus.nii.gz"
   output:
     "mri_processed_data/{subject}/transforms/{subject}_{session}_acq-mixed.mat"
@@ -145,28 +145,28 @@ use rule register as register_mixed with:
 
 use rule reslice as reslice_mixed with:
   input: 
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
-    moving="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-mixed_{T1_variant}.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
+    moving="mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-mixed_{T1_variant}" + NII,
     transform="mri_processed_data/{subject}/transforms/{subject}_{session}_acq-mixed.mat"
   params:
     interp_mode="NN"
   output:
-    "mri_processed_data/{subject}/registered/{subject}_{session}_acq-mixed_{T1_variant}_registered.nii.gz",
+    "mri_processed_data/{subject}/registered/{subject}_{session}_acq-mixed_{T1_variant}_registered" + NII,
 
 use rule reslice as reslice_mixed_scanner with:
   input: 
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
     moving="mri_dataset/{subject}/{session}/mixed/{subject}_{session}_acq-mixed_T1map_scanner.nii.gz",
     transform="mri_processed_data/{subject}/transforms/{subject}_{session}_acq-mixed.mat"
   params:
     interp_mode="NN"
   output:
-    "mri_processed_data/{subject}/registered/{subject}_{session}_acq-mixed_T1map_scanner_registered.nii.gz",
+    "mri_processed_data/{subject}/registered/{subject}_{session}_acq-mixed_T1map_scanner_registered" + NII,
 
 # DTI
 use rule register as register_dti with:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T2w_registered.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T2w_registered" + NII,
     moving="mri_dataset/derivatives/{subject}/ses-01/dwi/{subject}_ses-01_dDTI_MD.nii.gz"
   params:
     metric="NMI"
@@ -175,7 +175,7 @@ use rule register as register_dti with:
 
 rule reslice_dti:
   input:
-    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+    fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
     moving="mri_dataset/derivatives/{subject}/ses-01/dwi/{subject}_ses-01_dDTI_MD.nii.gz",
     transform="mri_processed_data/{subject}/transforms/{subject}_ses-01_dDTI.mat"
   output:
@@ -198,3 +198,124 @@ rule reslice_dti:
       " --suffix _registered"
       " --interp_mode {params.interp_mode}"
 
+
+
+# Reslice all T1 map variants sharing a transform in one job, reusing the cached
+# nearest-neighbour sampling indices of the (transform, grid) pair.
+if config.get("reslice-once", False):
+  def reslice_images(input, output):
+    return " ".join(f"--image {moving} {resliced}" for moving, resliced in zip(input.moving, output))
+
+  rule reslice_T1map_LL_once:
+    input:
+      fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
+      moving=[f"mri_dataset/derivatives/{{subject}}/{{session}}/{{subject}}_{{session}}_acq-looklocker_{variant}{NII}" for variant in ["T1map", "T1map_raw"]],
+      transform="mri_processed_data/{subject}/transforms/{subject}_{session}_acq-looklocker.mat",
+    output:
+      [f"mri_processed_data/{{subject}}/registered/{{subject}}_{{session}}_acq-looklocker_{variant}_registered{NII}" for variant in ["T1map", "T1map_raw"]],
+    params:
+      images=lambda wildcards, input, output: reslice_images(input, output),
+      cache_dir="mri_processed_data/{subject}/transforms/reslice-cache",
+    shell:
+      "python scripts/reslice.py"
+      " --fixed {input.fixed}"
+      " --transform {input.transform}"
+      " {params.images}"
+      " --interp_mode NN"
+      " --cache_dir {params.cache_dir}"
+
+
+  use rule reslice_T1map_LL_once as reslice_mixed_once with:
+    input:
+      fixed="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
+      moving=[
+        *[f"mri_dataset/derivatives/{{subject}}/{{session}}/{{subject}}_{{session}}_acq-mixed_{variant}{NII}" for variant in ["T1map", "T1map_raw"]],
+        "mri_dataset/{subject}/{session}/mixed/{subject}_{session}_acq-mixed_T1map_scanner.nii.gz",
+      ],
+      transform="mri_processed_data/{subject}/transforms/{subject}_{session}_acq-mixed.mat",
+    output:
+      [f"mri_processed_data/{{subject}}/registered/{{subject}}_{{session}}_acq-mixed_{variant}_registered{NII}" for variant in ["T1map", "T1map_raw", "T1map_scanner"]],
+
+
+  ruleorder: reslice_T1map_LL_once > reslice_T1map_LL
+  ruleorder: reslice_mixed_once > reslice_mixed
+  ruleorder: reslice_mixed_once > reslice_mixed_scanner
+
+
+# Batch registration: all moving images of a subject are registered against the
+# same fixed image in one job, sharing the decompressed fixed image and one pool
+# of threads. Produces the same transforms as the individual rules above.
+if config.get("batch-registration", False):
+  def greedy_pairs(pairs):
+    return " ".join(f"--pair {moving} {transform} '{metric}'" for moving, transform, metric in pairs)
+
+  # The rules are defined per subject, as the sessions differ between subjects. Being
+  # free of wildcards, they take precedence over the per-image rules above.
+  for subject in SUBJECTS:
+    sessions = SESSIONS[subject]
+    T1w_reference_pairs = [
+      *[
+        (f"mri_dataset/{subject}/{session}/anat/{subject}_{session}_T1w.nii.gz",
+         f"mri_processed_data/{subject}/transforms/{subject}_{session}_T1w.mat", "NCC 5x5x5")
+        for session in sessions if session != "ses-01"
+      ],
+      (f"mri_dataset/{subject}/ses-01/anat/{subject}_ses-01_FLAIR.nii.gz",
+       f"mri_processed_data/{subject}/transforms/{subject}_ses-01_FLAIR.mat", "NCC 5x5x5"),
+      (f"mri_dataset/{subject}/ses-01/anat/{subject}_ses-01_T2w.nii.gz",
+       f"mri_processed_data/{subject}/transforms/{subject}_ses-01_T2w.mat", "NMI"),
+      *[
+        (f"mri_dataset/derivatives/{subject}/{session}/{subject}_{session}_acq-looklocker_R1map{NII}",
+         f"mri_processed_data/{subject}/transforms/{subject}_{session}_acq-looklocker.mat", "NCC 5x5x5")
+        for session in sessions
+      ],
+    ]
+    T2w_reference_pairs = [
+      *[
+        (f"mri_dataset/{subject}/{session}/mixed/{subject}_{session}_acq-mixed_SE-modulus.nii.gz",
+         f"mri_processed_data/{subject}/transforms/{subject}_{session}_acq-mixed.mat", "NCC 5x5x5")
+        for session in sessions
+      ],
+      (f"mri_dataset/derivatives/{subject}/ses-01/dwi/{subject}_ses-01_dDTI_MD.nii.gz",
+       f"mri_processed_data/{subject}/transforms/{subject}_ses-01_dDTI.mat", "NMI"),
+    ]
+
+    rule:
+      name: f"register_batch_T1w_reference_{subject}"
+      input:
+        fixed=f"mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered{NII}",
+        moving=[moving for moving, _, _ in T1w_reference_pairs],
+      output:
+        [transform for _, transform, _ in T1w_reference_pairs]
+      params:
+        pairs=greedy_pairs(T1w_reference_pairs),
+        jobs=3
+      threads: 12
+      resources:
+        mem_mb=40000
+      shell:
+        "python scripts/register_batch.py"
+        " --fixed {input.fixed}"
+        " {params.pairs}"
+        " --threads {threads}"
+        " --jobs {params.jobs}"
+
+
+    rule:
+      name: f"register_batch_T2w_reference_{subject}"
+      input:
+        fixed=f"mri_processed_data/{subject}/registered/{subject}_ses-01_T2w_registered{NII}",
+        moving=[moving for moving, _, _ in T2w_reference_pairs],
+      output:
+        [transform for _, transform, _ in T2w_reference_pairs]
+      params:
+        pairs=greedy_pairs(T2w_reference_pairs),
+        jobs=3
+      threads: 12
+      resources:
+        mem_mb=40000
+      shell:
+        "python scripts/register_batch.py"
+        " --fixed {input.fixed}"
+        " {params.pairs}"
+        " --threads {threads}"
+        " --jobs {params.jobs}"
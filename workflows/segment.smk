@@ -1,6 +1,6 @@
 rule segment_refinements:
   input:
-    reference="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered.nii.gz",
+    reference="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
     segmentation=f"{FS_DIR}/{{subject}}/mri/{{seg}}.mgz",
     csfmask="mri_processed_data/{subject}/segmentations/{subject}_seg-csf_binary.nii.gz",
   output:
@@ -18,6 +18,38 @@ rule segment_refinements:
     " --output_csfseg {output.csf_segmentation}"
     " --label_smoothing {params.label_smoothing}"
 
+# Refine all FreeSurfer segmentations in one job, sharing the resampling grid, the
+# CSF mask and a thread pool for the label smoothing. Produces the same images as
+# segment_refinements.
+if config.get("refine-once", False):
+  REFINED_SEGMENTATIONS = ["aseg", "aparc+aseg", "wmparc"]
+
+  rule segment_refinements_all:
+    input:
+      reference="mri_processed_data/{subject}/registered/{subject}_ses-01_T1w_registered" + NII,
+      segmentations=[f"{FS_DIR}/{{subject}}/mri/{seg}.mgz" for seg in REFINED_SEGMENTATIONS],
+      csfmask="mri_processed_data/{subject}/segmentations/{subject}_seg-csf_binary.nii.gz",
+    output:
+      refined=[f"mri_processed_data/{{subject}}/segmentations/{{subject}}_seg-{seg}_refined.nii.gz" for seg in REFINED_SEGMENTATIONS],
+      csf_segmentation=[f"mri_processed_data/{{subject}}/segmentations/{{subject}}_seg-csf-{seg}.nii.gz" for seg in REFINED_SEGMENTATIONS],
+    params:
+      segmentations=lambda wildcards, input, output: " ".join(
+        f"--seg {seg} {refined} {csfseg}"
+        for seg, refined, csfseg in zip(input.segmentations, output.refined, output.csf_segmentation)
+      ),
+      label_smoothing = 1.0
+    threads: 6
+    shell:
+      "python scripts/refine_segmentations.py"
+      " {params.segmentations}"
+      " --reference {input.reference}"
+      " --csfmask {input.csfmask}"
+      " --label_smoothing {params.label_smoothing}"
+      " --threads {threads}"
+
+  ruleorder: segment_refinements_all > segment_refinements
+
+
 rule intracranial_mask:
   input:
     csf="mri_processed_data/{subject}/segmentations/{subject}_seg-csf-aseg.nii.gz",
@@ -32,7 +64,7 @@ rule intracranial_mask:
 
 rule csfmask:
   input:
-    "mri_processed_data/{subject}/registered/{subject}_ses-01_T2w_registered.nii.gz",
+    "mri_processed_data/{subject}/registered/{subject}_ses-01_T2w_registered" + NII,
   output:
     "mri_processed_data/{subject}/segmentations/{subject}_seg-csf_binary.nii.gz",
   shell:
@@ -42,7 +74,7 @@ rule csfmask:
 rule orbital_refroi:
   input: 
     T1w = lambda wc: [
-      f"mri_processed_data/{{subject}}/registered/{{subject}}_{session}_T1w_registered.nii.gz"
+      f"mri_processed_data/{{subject}}/registered/{{subject}}_{session}_T1w_registered{NII}"
       for session in SESSIONS[wc.subject]
     ],
     segmentation= f"{FS_DIR}/{{subject}}/mri/aparc+aseg.mgz"
@@ -62,11 +94,39 @@ rule orbital_refroi:
     " --output {output[1]}"
     " --side \"right\""
 
+# Extract both orbital reference ROIs from one memory-mapped stack of the T1w
+# sessions, and cache the median intensity of every session in each ROI for
+# normalize_T1w_cached. Produces the same masks as orbital_refroi.
+if config.get("native-refroi", False):
+  rule orbital_refroi_native:
+    input:
+      T1w = lambda wc: [
+        f"mri_processed_data/{wc.subject}/registered/{wc.subject}_{session}_T1w_registered{NII}"
+        for session in SESSIONS[wc.subject]
+      ],
+      segmentation= f"{FS_DIR}/{{subject}}/mri/aparc+aseg.mgz"
+    output:
+      left="mri_processed_data/{subject}/segmentations/{subject}_seg-refroi-left-orbital_binary.nii.gz",
+      right="mri_processed_data/{subject}/segmentations/{subject}_seg-refroi-right-orbital_binary.nii.gz",
+      stats="mri_processed_data/{subject}/segmentations/{subject}_seg-refroi-orbital_stats.json",
+    params:
+      T1w=lambda wildcards, input: " ".join(f"--T1w {path}" for path in input.T1w)
+    shell:
+      "python scripts/orbital_refroi.py"
+      " {params.T1w}"
+      " --segmentation {input.segmentation}"
+      " --left {output.left}"
+      " --right {output.right}"
+      " --stats {output.stats}"
+
+  ruleorder: orbital_refroi_native > orbital_refroi
+
+
 rule extended_fs:
   input:
     aparc="mri_processed_data/{subject}/segmentations/{subject}_seg-aparc+aseg_refined.nii.gz",
     wmparc="mri_processed_data/{subject}/segmentations/{subject}_seg-wmparc_refined.nii.gz",
-    t2w="mri_processed_data/{subject}/registered/{subject}_ses-01_T2w_registered.nii.gz",
+    t2w="mri_processed_data/{subject}/registered/{subject}_ses-01_T2w_registered" + NII,
   output:
     "mri_processed_data/{subject}/segmentations/{subject}_seg-extended-fs.nii.gz"
   shell:
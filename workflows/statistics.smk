@@ -1,8 +1,8 @@
 rule concentration_stats:
     input:
       segmentation="mri_processed_data/{subject}/segmentations/{subject}_seg-extended-fs.nii.gz",
-      mris=lambda wc: [f"mri_processed_data/{wc.subject}/concentrations/{wc.subject}_{ses}_concentration.nii.gz"
-      for ses in SESSIONS[wc.subject] if Path(f"mri_processed_data/{wc.subject}/concentrations/{wc.subject}_{ses}_concentration.nii.gz").exists()],
+      mris=lambda wc: [f"mri_processed_data/{wc.subject}/concentrations/{wc.subject}_{ses}_concentration{NII}"
+      for ses in SESSIONS[wc.subject] if LISTING.exists(f"mri_processed_data/{wc.subject}/concentrations/{wc.subject}_{ses}_concentration{NII}")],
       timestamps="mri_dataset/timetable.tsv",
     output:
       "mri_processed_data/{subject}/statistics/{subject}_stats-concentration-extended-fs.csv"
@@ -16,3 +16,50 @@ rule concentration_stats:
       " --timetable {input.timestamps}"
       " --timelabel 'looklocker'"
 
+# Compute the statistics of all labels and sessions in one pass over the
+# segmentation, see scripts/region_stats.py.
+if config.get("native-stats", False):
+  rule concentration_stats_native:
+    input:
+      segmentation="mri_processed_data/{subject}/segmentations/{subject}_seg-extended-fs.nii.gz",
+      mris=lambda wc: [f"mri_processed_data/{wc.subject}/concentrations/{wc.subject}_{ses}_concentration{NII}"
+      for ses in SESSIONS[wc.subject] if LISTING.exists(f"mri_processed_data/{wc.subject}/concentrations/{wc.subject}_{ses}_concentration{NII}")],
+      timestamps="mri_dataset/timetable.tsv",
+    output:
+      "mri_processed_data/{subject}/statistics/{subject}_stats-concentration-extended-fs.csv"
+    params:
+      mris=lambda wildcards, input: " ".join([f"-m {f}" for f in input.mris]),
+      cache_dir="mri_processed_data/{subject}/statistics/label-index-cache",
+    shell:
+      "python scripts/region_stats.py"
+      " -s {input.segmentation}"
+      " {params.mris}"
+      " -o {output}"
+      " --timetable {input.timestamps}"
+      " --timelabel 'looklocker'"
+      " --cache_dir {params.cache_dir}"
+
+  ruleorder: concentration_stats_native > concentration_stats
+
+# Read the sessions of the region statistics from the concentration timeline store
+# of the subject (see scripts/concentration_timeline.py) instead of the images.
+if config.get("timeline-stats", False):
+  rule concentration_stats_timeline:
+    input:
+      segmentation="mri_processed_data/{subject}/segmentations/{subject}_seg-extended-fs.nii.gz",
+      store=ancient(TIMELINE_STORE),
+      appended=lambda wc: [f"mri_processed_data/{wc.subject}/timeline/.{wc.subject}_{ses}_appended" for ses in SESSIONS[wc.subject]],
+    output:
+      "mri_processed_data/{subject}/statistics/{subject}_stats-concentration-extended-fs.csv"
+    params:
+      cache_dir="mri_processed_data/{subject}/statistics/label-index-cache",
+    shell:
+      "python scripts/region_stats.py"
+      " -s {input.segmentation}"
+      " --timeline {input.store}"
+      " -o {output}"
+      " --cache_dir {params.cache_dir}"
+
+  ruleorder: concentration_stats_timeline > concentration_stats
+  if config.get("native-stats", False):
+    ruleorder: concentration_stats_timeline > concentration_stats_native
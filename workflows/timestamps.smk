@@ -1,24 +1,16 @@
 rule extract_concentration_times_T1w:
    input:
-       timetable="mri_dataset/timetable.csv"
+       timetable="mri_dataset/timetable.tsv"
    output:
        temp("mri_processed_data/{subject}/timestamps_T1w.txt")
-   shell:
-       "python scripts/extract_timestamps.py"
-       " --timetable {input}"
-       " --subject {wildcards.subject}"
-       " --sequence_label T1w"
-       " --output {output}"
+   run:
+       write_timestamps(input.timetable, wildcards.subject, "T1w", output[0])
 
 
 rule extract_concentration_times_LL:
    input:
-       timetable="mri_dataset/timetable.csv"
+       timetable="mri_dataset/timetable.tsv"
    output:
        temp("mri_processed_data/{subject}/timestamps_LL.txt")
-   shell:
-       "python scripts/extract_timestamps.py"
-       " --timetable {input}"
-       " --subject {wildcards.subject}"
-       " --sequence_label looklocker"
-       " --output {output}"
+   run:
+       write_timestamps(input.timetable, wildcards.subject, "looklocker", output[0])